@@ -1,12 +1,21 @@
 
 import os
+import shutil
+import tempfile
 import unittest
 import string
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
 import logging
+import math
 import numpy as np
+from vtk.util import numpy_support
+
+from CurveComparisonLibs.CurveComparisonSweep import CurveComparisonSweep, CurveComparisonSweepPool, createSurfaceGraph, computeRingLabels
+from CurveComparisonLibs.CurveComparisonOptimizer import CurveComparisonOptimizer
+from CurveComparisonLibs.CurveComparisonResultStore import CurveComparisonResultStore
+from CurveComparisonLibs import CurveComparisonMetrics
 
 class CurveComparison(ScriptedLoadableModule, VTKObservationMixin):
 
@@ -57,6 +66,12 @@ class CurveComparisonWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     self.ui.outputTableNodeSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.updateWidgetFromMRML)
 
+    self.ui.searchModeComboBox.addItem("Exhaustive binary sweep", self.logic.SEARCH_MODE_EXHAUSTIVE)
+    self.ui.searchModeComboBox.addItem("Adaptive search", self.logic.SEARCH_MODE_ADAPTIVE)
+    self.ui.searchModeComboBox.connect('currentIndexChanged(int)', self.updateWidgetFromMRML)
+    for columnName in self.logic.OBJECTIVE_COLUMN_NAMES:
+      self.ui.objectiveComboBox.addItem(columnName)
+
     self.updateWidgetFromMRML()
 
   def inputCurveNodeChanged(self):
@@ -123,16 +138,36 @@ class CurveComparisonWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.ui.showOverlayCheckBox.checked = (activeName == self.logic.ISO_REGIONS_ARRAY_NAME)
     self.ui.showOverlayCheckBox.enabled = not surfaceNode is None
 
+    adaptiveSearch = self.ui.searchModeComboBox.currentData == self.logic.SEARCH_MODE_ADAPTIVE
+    self.ui.objectiveComboBox.enabled = adaptiveSearch
+    self.ui.maximumEvaluationsSpinBox.enabled = adaptiveSearch
+
     self.ui.computeButton.enabled = (not currentTableNode is None and not currentCurveNode is None and
       not currentCurveNode.GetShortestDistanceSurfaceNode() is None and currentCurveNode.GetNumberOfControlPoints() >= 2)
 
   def onComputeButtonClicked(self):
+    progressDialog = None
     try:
       qt.QApplication.setOverrideCursor(qt.Qt.WaitCursor)
       slicer.app.pauseRender()
       inputCurveNode = self.ui.inputCurveNodeSelector.currentNode()
       outputTableNode = self.ui.outputTableNodeSelector.currentNode()
-      self.logic.runCurveOptimization(inputCurveNode, outputTableNode)
+
+      progressDialog = slicer.util.createProgressDialog(windowTitle="Curve comparison", labelText="Evaluating weights...")
+      def updateProgress(numberOfEvaluatedWeights, numberOfWeights):
+        progressDialog.maximum = numberOfWeights
+        progressDialog.value = numberOfEvaluatedWeights
+        slicer.app.processEvents()
+        return not progressDialog.wasCanceled
+
+      numberOfWorkers = self.ui.numberOfWorkersSpinBox.value
+      if self.ui.searchModeComboBox.currentData == self.logic.SEARCH_MODE_ADAPTIVE:
+        self.logic.runAdaptiveOptimization(inputCurveNode, outputTableNode, self.ui.objectiveComboBox.currentText,
+          self.ui.maximumEvaluationsSpinBox.value, numberOfWorkers, updateProgress)
+      else:
+        self.logic.runCurveOptimization(inputCurveNode, outputTableNode, numberOfWorkers, updateProgress)
+      if outputTableNode.GetTable().GetNumberOfRows() == 0:
+        return
 
       weight, distance = self.logic.getLowestAverageDistanceWeight(outputTableNode)
       self.ui.lowestAverageLineEdit.text = str(weight)
@@ -146,11 +181,18 @@ class CurveComparisonWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       weight, overlap = self.logic.getHighestISOOverlapWeight(outputTableNode)
       self.ui.highestISOOverlapLineEdit.text = str(weight)
 
-      optimizerCurve = slicer.mrmlScene.GetFirstNodeByName("CurveComparisonPreview")
       import json
       weight = json.loads(weight)
-      self.logic.setCurveNodeWeights(optimizerCurve, weight)
+      if numberOfWorkers >= self.logic.MINIMUM_NUMBER_OF_SWEEP_WORKERS:
+        # The sweep scores were computed from approximate paths. Score the weights again with the path of the preview
+        # curve, so that the table row matches the curve that is displayed.
+        self.logic.updateScoresFromPreviewCurve(inputCurveNode, outputTableNode, weight)
+      else:
+        optimizerCurve = slicer.mrmlScene.GetFirstNodeByName("CurveComparisonPreview")
+        self.logic.setCurveNodeWeights(optimizerCurve, weight)
     finally:
+      if progressDialog:
+        progressDialog.close()
       slicer.app.resumeRender()
       qt.QApplication.restoreOverrideCursor()
 
@@ -161,61 +203,276 @@ class CurveComparisonLogic(ScriptedLoadableModuleLogic, VTKObservationMixin):
   MAX_DISTANCE_COLUMN_NAME = "Max distance (mm)"
   OVERLAP_PERCENT_COLUMN_NAME = "Overlap percent (%)"
   ISO_OVERLAP_COLUMN_NAME = "ISO overlap"
+  HAUSDORFF_DISTANCE_COLUMN_NAME = "Hausdorff distance (mm)"
+  FRECHET_DISTANCE_COLUMN_NAME = "Frechet distance (mm)"
+  PERCENTILE_DISTANCE_COLUMN_NAME = "95th percentile distance (mm)"
+  GEODESIC_DISTANCE_COLUMN_NAME = "Average geodesic distance (mm)"
+  CURVE_COLUMN_NAME = "Curve"
+  SURFACE_COLUMN_NAME = "Surface"
+  NUMBER_OF_CURVES_COLUMN_NAME = "Number of curves"
+  STANDARD_DEVIATION_COLUMN_SUFFIX = " std"
+  SEARCH_MODE_EXHAUSTIVE = "Exhaustive"
+  SEARCH_MODE_ADAPTIVE = "Adaptive"
+  OBJECTIVE_COLUMN_NAMES = [
+    AVERAGE_DISTANCE_COLUMN_NAME,
+    MAX_DISTANCE_COLUMN_NAME,
+    OVERLAP_PERCENT_COLUMN_NAME,
+    ISO_OVERLAP_COLUMN_NAME,
+    HAUSDORFF_DISTANCE_COLUMN_NAME,
+    FRECHET_DISTANCE_COLUMN_NAME,
+    PERCENTILE_DISTANCE_COLUMN_NAME,
+    GEODESIC_DISTANCE_COLUMN_NAME,
+  ]
 
   ISO_REGIONS_ARRAY_NAME = "ISO-Regions"
+  POINT_IDS_ARRAY_NAME = "CurveComparisonPointIds"
 
   NUMBER_OF_ISO_REGIONS = 6
 
+  # Spacing and maximum number of points of the resampled curves that the Hausdorff, Frechet and percentile
+  # distances are computed from
+  METRICS_RESAMPLING_SPACING = 1.0
+  METRICS_MAXIMUM_NUMBER_OF_POINTS = 500
+
+  # Paths are only computed by worker processes if there are at least this many workers. With fewer workers, the
+  # preview curve node computes the paths, since a single worker would not be faster but would use the approximate solver.
+  MINIMUM_NUMBER_OF_SWEEP_WORKERS = 2
+
+  # Properties of the preview curve node that change the paths, but are not set by the weights
+  PREVIEW_SETTING_NAMES = [
+    "CurvaturePenalty",
+    "SulcalHeightPenalty",
+    "DistanceCurvaturePenalty",
+    "DistanceSulcalHeightPenalty",
+    "CurvatureSulcalHeightPenalty",
+    "DistanceCurvatureSulcalHeightPenalty",
+    "InvertScalars",
+  ]
+
   def __init__(self):
     ScriptedLoadableModuleLogic.__init__(self)
     VTKObservationMixin.__init__(self)
+    self.surfaceGraphCache = {} # Key is the model node ID, value is (polydata MTime, graph row pointers, graph indices)
+    self.surfaceLocatorCache = {} # Key is the model node ID, value is (surface key, world polydata, point locator)
+    self.isoRegionOverlayKeys = {} # Key is the model node ID, value is the key of the curve that the overlay was created from
+    self.resultStore = CurveComparisonResultStore(self.getDefaultResultStoreDirectory())
+
+  def getDefaultResultStoreDirectory(self):
+    return os.path.join(slicer.app.cachePath, "CurveComparison", "Results")
 
-  def runCurveOptimization(self, inputCurveNode, outputTableNode):
+  def setResultStoreDirectory(self, directory):
     """
-    :param inputCurveNode: User placed curve node to be optimized
+    Set the directory that the scores of evaluated weights are stored in. If None, the scores are only kept in memory.
     """
-    inputCurvePolyData = vtk.vtkPolyData()
-    inputCurvePolyData.SetPoints(inputCurveNode.GetCurvePointsWorld())
+    self.resultStore.setDirectory(directory)
 
-    inputPointLocator = vtk.vtkPointLocator()
-    inputPointLocator.SetDataSet(inputCurvePolyData)
-    inputPointLocator.BuildLocator()
+  def clearResultStore(self):
+    self.resultStore.clear()
 
-    transformFilter = vtk.vtkTransformPolyDataFilter()
-    transformFilter.SetInputData(inputCurveNode.GetShortestDistanceSurfaceNode().GetPolyData())
-    modelToWorldTransform = vtk.vtkGeneralTransform()
-    slicer.vtkMRMLTransformNode.GetTransformBetweenNodes(inputCurveNode.GetShortestDistanceSurfaceNode().GetParentTransformNode(), None, modelToWorldTransform)
-    transformFilter.SetTransform(modelToWorldTransform)
-    transformFilter.Update()
-
-    inputPolyDataLocator = vtk.vtkPointLocator()
-    inputPolyDataLocator.SetDataSet(transformFilter.GetOutput())
-    inputPolyDataLocator.BuildLocator()
-
-    self.createISORegionOverlay(inputCurveNode)
+  def runCurveOptimization(self, inputCurveNode, outputTableNode, numberOfWorkers=0, progressCallback=None):
+    """
+    Evaluate all of the binary weight vectors, and write the scores for each of them to the output table.
+    :param inputCurveNode: User placed curve node to be optimized
+    :param outputTableNode: Table node that the scores are written to
+    :param numberOfWorkers: Number of worker processes used to compute the paths (see computeWeightScores).
+      If less than MINIMUM_NUMBER_OF_SWEEP_WORKERS, the path for each weight vector is computed by the preview curve
+      node, one after another.
+    :param progressCallback: Function called with the number of evaluated weight vectors and the total number of
+      weight vectors. If the function returns False, the optimization is cancelled.
+    """
+    optimizationContext = self.prepareOptimization(inputCurveNode, outputTableNode)
+    weightsList = [self.binaryArray(i, 8) for i in range(1, pow(2, 8))]
+    scores = self.computeWeightScores(optimizationContext, weightsList, numberOfWorkers, progressCallback)
+    for weights, weightScores in zip(weightsList, scores):
+      self.addScoresToTable(outputTableNode, weights, weightScores)
+    outputTableNode.GetTable().Modified()
+
+  def runAdaptiveOptimization(self, inputCurveNode, outputTableNode, objectiveColumnName, maximumEvaluations=64,
+      numberOfWorkers=0, progressCallback=None):
+    """
+    Search the continuous weight space for the weights with the best score, using a budgeted pattern search
+    (see CurveComparisonOptimizer). Each weight vector that is evaluated is written to the output table.
+    :param objectiveColumnName: Name of the score column that is optimized. Distances are minimized and overlaps are maximized.
+    :param maximumEvaluations: Maximum number of weight vectors that are evaluated
+    :param progressCallback: Function called with the number of evaluated weight vectors and the maximum number of
+      evaluations. If the function returns False, the optimization is cancelled.
+    :return: Tuple containing the best weights and their score
+    """
+    if not objectiveColumnName in self.OBJECTIVE_COLUMN_NAMES:
+      logging.error("runAdaptiveOptimization: Invalid objective: " + objectiveColumnName)
+      return None, None
+
+    optimizationContext = self.prepareOptimization(inputCurveNode, outputTableNode)
+
+    def evaluateWeightsList(weightsList):
+      numberOfPreviousEvaluations = outputTableNode.GetTable().GetNumberOfRows()
+      def updateProgress(numberOfEvaluatedWeights, numberOfWeights):
+        if progressCallback is None:
+          return True
+        return progressCallback(numberOfPreviousEvaluations + numberOfEvaluatedWeights, maximumEvaluations)
+      scores = self.computeWeightScores(optimizationContext, weightsList, numberOfWorkers, updateProgress)
+      for weights, weightScores in zip(weightsList, scores):
+        self.addScoresToTable(outputTableNode, weights, weightScores)
+      outputTableNode.GetTable().Modified()
+      return [weightScores[objectiveColumnName] for weightScores in scores]
+
+    maximize = objectiveColumnName in [self.OVERLAP_PERCENT_COLUMN_NAME, self.ISO_OVERLAP_COLUMN_NAME]
+    optimizer = CurveComparisonOptimizer(evaluateWeightsList, 8, maximumEvaluations, maximize)
+    # Start from the weight vectors that only use a single term
+    initialWeightsList = [self.binaryArray(pow(2, i), 8) for i in range(8)]
+    bestWeights, bestScore = optimizer.run(initialWeightsList)
+    logging.info("Best weights for {0}: {1} ({2} evaluations)".format(objectiveColumnName, bestWeights, optimizer.getNumberOfEvaluations()))
+    return bestWeights, bestScore
+
+  def runBatchComparison(self, curveSurfacePairs, outputTableNode, aggregateTableNode=None, numberOfWorkers=0,
+      progressCallback=None):
+    """
+    Evaluate all of the binary weight vectors for many curves, so that the weights can be chosen for a whole cohort.
+    The surface of each curve and the ISO region overlay of each surface are restored after the curve is compared.
+    :param curveSurfacePairs: List of (curve node, surface model node) tuples. If the surface is None, the current
+      surface of the curve is used.
+    :param outputTableNode: Table node that the scores of each curve and weight vector are written to, with one row
+      per curve and weight vector
+    :param aggregateTableNode: Table node that the statistics of each weight vector are written to (see createAggregateTable)
+    :param numberOfWorkers: Number of worker processes used to compute the paths (see computeWeightScores).
+      The worker processes are started once and used for all of the curves.
+    :param progressCallback: Function called with the number of evaluated weight vectors and the total number of
+      weight vectors for all curves. If the function returns False, the comparison is cancelled.
+    :return: True if all of the curves were compared, False if the comparison was cancelled
+    """
+    weightsList = [self.binaryArray(i, 8) for i in range(1, pow(2, 8))]
+    self.createOutputTable(outputTableNode, [self.CURVE_COLUMN_NAME, self.SURFACE_COLUMN_NAME])
+    curveArray = outputTableNode.GetTable().GetColumnByName(self.CURVE_COLUMN_NAME)
+    surfaceArray = outputTableNode.GetTable().GetColumnByName(self.SURFACE_COLUMN_NAME)
 
-    weightArray = vtk.vtkStringArray()
-    weightArray.SetName(self.WEIGHTS_COLUMN_NAME)
+    sweepPool = None
+    pythonExecutable = self.getPythonExecutable()
+    if numberOfWorkers >= self.MINIMUM_NUMBER_OF_SWEEP_WORKERS and pythonExecutable is not None:
+      sweepPool = CurveComparisonSweepPool(numberOfWorkers, pythonExecutable)
 
-    averageDistanceArray = vtk.vtkDoubleArray()
-    averageDistanceArray.SetName(self.AVERAGE_DISTANCE_COLUMN_NAME)
+    completed = True
+    try:
+      for pairIndex, (curveNode, surfaceNode) in enumerate(curveSurfacePairs):
+        originalSurfaceNode = curveNode.GetShortestDistanceSurfaceNode()
+        if surfaceNode is None:
+          surfaceNode = originalSurfaceNode
+        if surfaceNode is None or curveNode.GetNumberOfControlPoints() < 2:
+          logging.warning("runBatchComparison: Skipping {0}, the curve needs a surface and at least two control points".format(curveNode.GetName()))
+          continue
 
-    maxDistanceArray = vtk.vtkDoubleArray()
-    maxDistanceArray.SetName(self.MAX_DISTANCE_COLUMN_NAME)
+        numberOfPreviousWeights = pairIndex * len(weightsList)
+        def updateProgress(numberOfEvaluatedWeights, numberOfWeights):
+          if progressCallback is None:
+            return True
+          return progressCallback(numberOfPreviousWeights + numberOfEvaluatedWeights, len(curveSurfacePairs) * len(weightsList))
+
+        originalISORegions = self.getISORegionOverlayValues(surfaceNode)
+        if surfaceNode != originalSurfaceNode:
+          curveNode.SetAndObserveShortestDistanceSurfaceNode(surfaceNode)
+        try:
+          optimizationContext = self.prepareOptimization(curveNode, None)
+          scores = self.computeWeightScores(optimizationContext, weightsList, numberOfWorkers, updateProgress, sweepPool)
+        finally:
+          if surfaceNode != originalSurfaceNode:
+            curveNode.SetAndObserveShortestDistanceSurfaceNode(originalSurfaceNode)
+          self.restoreISORegionOverlay(surfaceNode, originalISORegions)
+
+        for weights, weightScores in zip(weightsList, scores):
+          curveArray.InsertNextValue(curveNode.GetName())
+          surfaceArray.InsertNextValue(surfaceNode.GetName())
+          self.addScoresToTable(outputTableNode, weights, weightScores)
+        if len(scores) < len(weightsList):
+          completed = False
+          break
+    finally:
+      if sweepPool:
+        sweepPool.shutdown()
+    outputTableNode.GetTable().Modified()
 
-    overlapPercentArray = vtk.vtkDoubleArray()
-    overlapPercentArray.SetName(self.OVERLAP_PERCENT_COLUMN_NAME)
+    if aggregateTableNode:
+      self.createAggregateTable(outputTableNode, aggregateTableNode)
+    return completed
 
-    isoOverlapArray = vtk.vtkDoubleArray()
-    isoOverlapArray.SetName(self.ISO_OVERLAP_COLUMN_NAME)
+  def createAggregateTable(self, outputTableNode, aggregateTableNode):
+    """
+    Compute the statistics of the scores of each weight vector over all of the curves in the output table.
+    The mean of each score is written to a column with the same name as in the output table, so the weights can be
+    selected from the aggregate table in the same way (ex. getLowestAverageDistanceWeight).
+    The standard deviation of each score is written to a column with STANDARD_DEVIATION_COLUMN_SUFFIX.
+    """
+    table = outputTableNode.GetTable()
+    weightsArray = table.GetColumnByName(self.WEIGHTS_COLUMN_NAME)
+    weightStrings = np.array([weightsArray.GetValue(i) for i in range(weightsArray.GetNumberOfValues())], dtype=object)
+
+    aggregateWeightsArray = vtk.vtkStringArray()
+    aggregateWeightsArray.SetName(self.WEIGHTS_COLUMN_NAME)
+    numberOfCurvesArray = vtk.vtkIntArray()
+    numberOfCurvesArray.SetName(self.NUMBER_OF_CURVES_COLUMN_NAME)
+    aggregateTable = vtk.vtkTable()
+    aggregateTable.AddColumn(aggregateWeightsArray)
+    aggregateTable.AddColumn(numberOfCurvesArray)
+
+    if len(weightStrings) > 0:
+      uniqueWeightStrings, firstIndices, groupIndices = np.unique(weightStrings.astype(str), return_index=True, return_inverse=True)
+      # Keep the weights in the order that they were evaluated
+      groupOrder = np.argsort(firstIndices)
+      groupIndices = np.argsort(groupOrder)[groupIndices]
+      uniqueWeightStrings = uniqueWeightStrings[groupOrder]
+    else:
+      uniqueWeightStrings = np.zeros(0, dtype=str)
+      groupIndices = np.zeros(0, dtype=np.int64)
+    numberOfGroups = len(uniqueWeightStrings)
+    counts = np.bincount(groupIndices, minlength=numberOfGroups)
+
+    for weightString in uniqueWeightStrings:
+      aggregateWeightsArray.InsertNextValue(str(weightString))
+    for count in counts:
+      numberOfCurvesArray.InsertNextValue(int(count))
+
+    for columnName in self.OBJECTIVE_COLUMN_NAMES:
+      values = numpy_support.vtk_to_numpy(table.GetColumnByName(columnName)).astype(np.float64)
+      means = np.bincount(groupIndices, weights=values, minlength=numberOfGroups) / np.maximum(counts, 1)
+      squaredMeans = np.bincount(groupIndices, weights=values * values, minlength=numberOfGroups) / np.maximum(counts, 1)
+      standardDeviations = np.sqrt(np.maximum(squaredMeans - means * means, 0.0))
+      for name, columnValues in [(columnName, means), (columnName + self.STANDARD_DEVIATION_COLUMN_SUFFIX, standardDeviations)]:
+        columnArray = numpy_support.numpy_to_vtk(columnValues, deep=True, array_type=vtk.VTK_DOUBLE)
+        columnArray.SetName(name)
+        aggregateTable.AddColumn(columnArray)
+
+    aggregateTableNode.SetAndObserveTable(aggregateTable)
+
+  def prepareOptimization(self, inputCurveNode, outputTableNode):
+    """
+    Create the locators, ISO region overlay, output table and preview curve used to evaluate weights.
+    The surface locator and the ISO region overlay are reused if the surface and curve have not changed.
+    :param outputTableNode: Table node that the scores are written to. If None, the table is not created.
+    :return: Dictionary containing the objects used by computeWeightScores
+    """
+    inputCurvePolyData = vtk.vtkPolyData()
+    inputCurvePolyData.SetPoints(inputCurveNode.GetCurvePointsWorld())
 
-    table = vtk.vtkTable()
-    table.AddColumn(weightArray)
-    table.AddColumn(averageDistanceArray)
-    table.AddColumn(maxDistanceArray)
-    table.AddColumn(overlapPercentArray)
-    table.AddColumn(isoOverlapArray)
-    outputTableNode.SetAndObserveTable(table)
+    inputPointLocator = self.createPointLocator(inputCurvePolyData)
+
+    surfaceModelNode = inputCurveNode.GetShortestDistanceSurfaceNode()
+    surfacePolyData_World = self.getSurfacePolyDataWorld(surfaceModelNode)
+    surfaceKey = self.getSurfaceKey(surfacePolyData_World)
+    cachedSurfaceKey, cachedSurfacePolyData, cachedLocator = self.surfaceLocatorCache.get(surfaceModelNode.GetID(), (None, None, None))
+    if cachedSurfaceKey == surfaceKey:
+      surfacePolyData_World = cachedSurfacePolyData
+      inputPolyDataLocator = cachedLocator
+    else:
+      inputPolyDataLocator = self.createPointLocator(surfacePolyData_World)
+      self.surfaceLocatorCache[surfaceModelNode.GetID()] = (surfaceKey, surfacePolyData_World, inputPolyDataLocator)
+
+    curvePoints_World = numpy_support.vtk_to_numpy(inputCurvePolyData.GetPoints().GetData())
+    inputKey = self.resultStore.getInputKey(surfaceKey, curvePoints_World, str(self.NUMBER_OF_ISO_REGIONS))
+
+    isoRegionsArray = surfaceModelNode.GetPolyData().GetPointData().GetArray(self.ISO_REGIONS_ARRAY_NAME)
+    if isoRegionsArray is None or self.isoRegionOverlayKeys.get(surfaceModelNode.GetID()) != inputKey:
+      self.createISORegionOverlay(inputCurveNode)
+      self.isoRegionOverlayKeys[surfaceModelNode.GetID()] = inputKey
+    if outputTableNode:
+      self.createOutputTable(outputTableNode)
 
     optimizerCurve = slicer.mrmlScene.GetFirstNodeByName("CurveComparisonPreview")
     if optimizerCurve is None:
@@ -234,10 +491,259 @@ class CurveComparisonLogic(ScriptedLoadableModuleLogic, VTKObservationMixin):
     points.InsertNextPoint(endPoint_World)
     optimizerCurve.SetControlPointPositionsWorld(points)
 
-    for i in range(1, pow(2, 8)):
-      weights = self.binaryArray(i, 8)
-      self.evaluateWeights(inputCurveNode, optimizerCurve, weights, inputPointLocator, inputPolyDataLocator, outputTableNode)
-    table.Modified()
+    return {
+      "inputCurveNode": inputCurveNode,
+      "optimizerCurveNode": optimizerCurve,
+      "inputCurveLocator": inputPointLocator,
+      "inputPolyDataLocator": inputPolyDataLocator,
+      "surfacePolyData": surfacePolyData_World,
+      "startPointId": inputPolyDataLocator.FindClosestPoint(startPoint_World),
+      "endPointId": inputPolyDataLocator.FindClosestPoint(endPoint_World),
+      "sweep": None,
+      "inputKey": inputKey,
+      "geodesicDistances": None,
+      }
+
+  def getSurfaceKey(self, surfacePolyData):
+    """
+    Returns a hash of the surface geometry and of the overlays that are used to compute the paths.
+    """
+    pointData = surfacePolyData.GetPointData()
+    inputArrays = [
+      numpy_support.vtk_to_numpy(surfacePolyData.GetPoints().GetData()),
+      numpy_support.vtk_to_numpy(surfacePolyData.GetPolys().GetOffsetsArray()),
+      numpy_support.vtk_to_numpy(surfacePolyData.GetPolys().GetConnectivityArray()),
+      ]
+    for arrayName in ["curv", "sulc"]:
+      scalarArray = pointData.GetArray(arrayName)
+      inputArrays.append(numpy_support.vtk_to_numpy(scalarArray) if scalarArray else None)
+    return self.resultStore.getInputKey(*inputArrays)
+
+  def createPointLocator(self, polyData):
+    """
+    Create a locator that can be used to find the closest points of the polydata for many points at once
+    (see findClosestPointIds).
+    """
+    self.addPointIdsArray(polyData)
+    pointLocator = vtk.vtkStaticPointLocator()
+    pointLocator.SetDataSet(polyData)
+    pointLocator.BuildLocator()
+    return pointLocator
+
+  def addPointIdsArray(self, polyData):
+    pointIdsArray = polyData.GetPointData().GetArray(self.POINT_IDS_ARRAY_NAME)
+    if pointIdsArray and pointIdsArray.GetNumberOfTuples() == polyData.GetNumberOfPoints():
+      return
+    pointIdsArray = numpy_support.numpy_to_vtk(np.arange(polyData.GetNumberOfPoints()), deep=True, array_type=vtk.VTK_ID_TYPE)
+    pointIdsArray.SetName(self.POINT_IDS_ARRAY_NAME)
+    polyData.GetPointData().AddArray(pointIdsArray)
+
+  def findClosestPointIds(self, pointLocator, points_World):
+    """
+    Find the closest point of the locator's dataset for each of the points, using a single query.
+    :param pointLocator: Point locator. If it is not a vtkStaticPointLocator (ex. created by createPointLocator), a
+      temporary static locator is built, since the query is multi-threaded.
+    :param points_World: vtkPoints to find the closest points for
+    :return: numpy array containing the ID of the closest point for each point
+    """
+    polyData = pointLocator.GetDataSet()
+    self.addPointIdsArray(polyData)
+
+    queryPolyData = vtk.vtkPolyData()
+    queryPolyData.SetPoints(points_World)
+
+    # The Voronoi kernel copies the values of the closest source point
+    pointInterpolator = vtk.vtkPointInterpolator()
+    pointInterpolator.SetInputData(queryPolyData)
+    pointInterpolator.SetSourceData(polyData)
+    pointInterpolator.SetKernel(vtk.vtkVoronoiKernel())
+    if pointLocator.IsA("vtkStaticPointLocator"):
+      pointInterpolator.SetLocator(pointLocator)
+    pointInterpolator.PassPointArraysOff()
+    pointInterpolator.PassCellArraysOff()
+    pointInterpolator.PassFieldArraysOff()
+    pointInterpolator.Update()
+    closestPointIdsArray = pointInterpolator.GetOutput().GetPointData().GetArray(self.POINT_IDS_ARRAY_NAME)
+    return numpy_support.vtk_to_numpy(closestPointIdsArray).astype(np.int64)
+
+  def computeWeightScores(self, optimizationContext, weightsList, numberOfWorkers=0, progressCallback=None, sweepPool=None):
+    """
+    Compute the path for each of the weight vectors and score it against the input curve.
+    :param optimizationContext: Dictionary returned by prepareOptimization
+    Scores that are in the result store are reused, and only the missing weight vectors are evaluated.
+    :param numberOfWorkers: Number of worker processes used to compute the paths (see runParallelSweep).
+      If less than MINIMUM_NUMBER_OF_SWEEP_WORKERS, the paths are computed by the preview curve node, one after another.
+    :param sweepPool: Pool of worker processes that is used by runParallelSweep. If None, a pool is created for each call.
+    :return: List containing the scores for each weight vector. If cancelled, only the scores for the weight vectors
+      that were evaluated before the cancellation are returned.
+    """
+    inputKey = self.getSolverInputKey(optimizationContext, numberOfWorkers)
+    scores = {} # Key is the index of the weights, value is the scores of the path
+    missingIndices = []
+    for i, weights in enumerate(weightsList):
+      storedScores = self.resultStore.getScores(inputKey, weights)
+      if storedScores is None:
+        missingIndices.append(i)
+      else:
+        scores[i] = storedScores
+    if len(scores) > 0:
+      logging.info("Reusing stored scores for {0} of {1} weight vectors".format(len(scores), len(weightsList)))
+
+    missingWeightsList = [weightsList[i] for i in missingIndices]
+    numberOfStoredScores = len(scores)
+    def updateProgress(numberOfEvaluatedWeights, numberOfWeights):
+      if progressCallback is None:
+        return True
+      return progressCallback(numberOfStoredScores + numberOfEvaluatedWeights, len(weightsList))
+
+    inputCurveNode = optimizationContext["inputCurveNode"]
+    inputCurveLocator = optimizationContext["inputCurveLocator"]
+    inputPolyDataLocator = optimizationContext["inputPolyDataLocator"]
+    if len(missingWeightsList) > 0 and optimizationContext["geodesicDistances"] is None:
+      # The geodesic distances to the input curve are the same for all of the weights
+      optimizationContext["geodesicDistances"] = self.computeGeodesicDistances(inputCurveNode, inputPolyDataLocator)
+    geodesicDistances = optimizationContext["geodesicDistances"]
+
+    if len(missingWeightsList) == 0:
+      missingScores = {}
+    elif numberOfWorkers >= self.MINIMUM_NUMBER_OF_SWEEP_WORKERS:
+      missingScores = self.runParallelSweep(optimizationContext, missingWeightsList, numberOfWorkers, updateProgress, sweepPool)
+    else:
+      missingScores = {}
+      optimizerCurveNode = optimizationContext["optimizerCurveNode"]
+      for i, weights in enumerate(missingWeightsList):
+        if updateProgress(i, len(missingWeightsList)) is False:
+          break
+        self.setCurveNodeWeights(optimizerCurveNode, weights)
+        missingScores[i] = self.computeScores(inputCurveNode, optimizerCurveNode.GetCurvePointsWorld(), inputCurveLocator,
+          inputPolyDataLocator, geodesicDistances=geodesicDistances)
+
+    for missingIndex, weightScores in missingScores.items():
+      weights = missingWeightsList[missingIndex]
+      self.resultStore.setScores(inputKey, weights, weightScores)
+      scores[missingIndices[missingIndex]] = weightScores
+    try:
+      self.resultStore.write()
+    except (IOError, OSError) as e:
+      logging.warning("computeWeightScores: Could not write the result store: " + str(e))
+
+    # Only return the consecutive scores from the start of the list, so that the scores match the weights
+    orderedScores = []
+    while len(orderedScores) in scores:
+      orderedScores.append(scores[len(orderedScores)])
+    return orderedScores
+
+  def getSolverInputKey(self, optimizationContext, numberOfWorkers):
+    """
+    Returns the key of the inputs and of the solver that computes the paths, since the sweep and the preview curve
+    node can find different paths for the same weights. The paths of the preview curve node also depend on its
+    penalties and scalar inversion, which are not set by the weights.
+    """
+    if numberOfWorkers >= self.MINIMUM_NUMBER_OF_SWEEP_WORKERS:
+      return self.resultStore.getInputKey(optimizationContext["inputKey"], "sweep")
+    optimizerCurveNode = optimizationContext["optimizerCurveNode"]
+    previewSettings = [float(getattr(optimizerCurveNode, "Get" + name)()) for name in self.PREVIEW_SETTING_NAMES]
+    return self.resultStore.getInputKey(optimizationContext["inputKey"], "preview", np.array(previewSettings))
+
+  def runParallelSweep(self, optimizationContext, weightsList, numberOfWorkers, progressCallback=None, sweepPool=None):
+    """
+    Compute the paths for the weight vectors in a pool of worker processes, and score them against the input curve.
+    The workers share a read-only copy of the surface graph and cost terms (see CurveComparisonSweep), so the paths
+    are computed without the preview curve node.
+    The cost function of the workers is an approximation of the vtkMRMLMarkupsFreeSurferCurveNode cost function
+    (see getEdgeCosts), so the paths and scores can differ from the ones computed by the preview curve.
+    :return: Dictionary containing the scores, with the index of the weights as the key
+    """
+    logging.warning("runParallelSweep: Paths are computed with an approximation of the FreeSurfer curve cost function")
+    inputCurveNode = optimizationContext["inputCurveNode"]
+    surfacePolyData_World = optimizationContext["surfacePolyData"]
+    points = numpy_support.vtk_to_numpy(surfacePolyData_World.GetPoints().GetData())
+
+    sweep = optimizationContext["sweep"]
+    if sweep is None:
+      pointData = surfacePolyData_World.GetPointData()
+      triangles = self.getSurfaceTriangles(surfacePolyData_World)
+      scalars = []
+      for arrayName in ["curv", "sulc"]:
+        scalarArray = pointData.GetArray(arrayName)
+        if scalarArray is None:
+          logging.warning("runParallelSweep: Surface has no {0} array".format(arrayName))
+          scalars.append(np.zeros(len(points)))
+        else:
+          scalars.append(numpy_support.vtk_to_numpy(scalarArray))
+      curvature, sulcalHeight = scalars
+      sweep = CurveComparisonSweep(points, triangles, curvature, sulcalHeight,
+        optimizationContext["startPointId"], optimizationContext["endPointId"])
+      optimizationContext["sweep"] = sweep
+
+    scores = {} # Key is the index of the weights, value is the scores of the path
+    def onPathComputed(index, weights, path):
+      pathPoints_World = vtk.vtkPoints()
+      pathPoints_World.SetData(numpy_support.numpy_to_vtk(points[path], deep=True))
+      scores[index] = self.computeScores(inputCurveNode, pathPoints_World,
+        optimizationContext["inputCurveLocator"], optimizationContext["inputPolyDataLocator"], np.array(path, dtype=np.int64),
+        optimizationContext["geodesicDistances"])
+      if progressCallback:
+        return progressCallback(len(scores), len(weightsList))
+      return True
+
+    pythonExecutable = self.getPythonExecutable()
+    if pythonExecutable is None and numberOfWorkers > 1:
+      # Without PythonSlicer, the default executable of the spawned processes is the Slicer application
+      logging.warning("runParallelSweep: Could not find PythonSlicer, the paths are computed in the current process")
+      numberOfWorkers = 1
+    sweep.run(weightsList, numberOfWorkers, onPathComputed, pythonExecutable, sweepPool)
+    return scores
+
+  def getSurfacePolyDataWorld(self, modelNode):
+    """
+    Returns the polydata of the model, transformed to world coordinates.
+    """
+    transformFilter = vtk.vtkTransformPolyDataFilter()
+    transformFilter.SetInputData(modelNode.GetPolyData())
+    modelToWorldTransform = vtk.vtkGeneralTransform()
+    slicer.vtkMRMLTransformNode.GetTransformBetweenNodes(modelNode.GetParentTransformNode(), None, modelToWorldTransform)
+    transformFilter.SetTransform(modelToWorldTransform)
+    transformFilter.Update()
+    return transformFilter.GetOutput()
+
+  def getSurfaceTriangles(self, polyData):
+    """
+    Returns the triangles of the polydata as an (N x 3) numpy array.
+    """
+    triangleFilter = vtk.vtkTriangleFilter()
+    triangleFilter.SetInputData(polyData)
+    triangleFilter.PassVertsOff()
+    triangleFilter.PassLinesOff()
+    triangleFilter.Update()
+    polys = triangleFilter.GetOutput().GetPolys()
+    return numpy_support.vtk_to_numpy(polys.GetConnectivityArray()).reshape(-1, 3)
+
+  def getPythonExecutable(self):
+    """
+    Returns the Python executable used to start the sweep worker processes, or None if PythonSlicer can't be found.
+    """
+    executableName = "PythonSlicer.exe" if os.name == "nt" else "PythonSlicer"
+    return shutil.which(executableName, path=os.path.join(slicer.app.slicerHome, "bin"))
+
+  def createOutputTable(self, outputTableNode, keyColumnNames=None):
+    """
+    :param keyColumnNames: Names of additional string columns that are added before the weights (ex. the curve name)
+    """
+    weightArray = vtk.vtkStringArray()
+    weightArray.SetName(self.WEIGHTS_COLUMN_NAME)
+
+    table = vtk.vtkTable()
+    for keyColumnName in keyColumnNames or []:
+      keyArray = vtk.vtkStringArray()
+      keyArray.SetName(keyColumnName)
+      table.AddColumn(keyArray)
+    table.AddColumn(weightArray)
+    for columnName in self.OBJECTIVE_COLUMN_NAMES:
+      scoreArray = vtk.vtkDoubleArray()
+      scoreArray.SetName(columnName)
+      table.AddColumn(scoreArray)
+    outputTableNode.SetAndObserveTable(table)
 
   def setCurveNodeWeights(self, freeSurferCurveNode, weights):
     freeSurferCurveNode.SetDistanceWeight(weights[0])
@@ -309,68 +815,134 @@ class CurveComparisonLogic(ScriptedLoadableModuleLogic, VTKObservationMixin):
   def evaluateWeights(self, inputCurveNode, optimizerCurveNode, weights, inputCurveLocator, inputPolyDataLocator, outputTableNode):
     # [d,   c,   h,  dc,  dh,  ch, dch,   p]
     self.setCurveNodeWeights(optimizerCurveNode, weights)
+    scores = self.computeScores(inputCurveNode, optimizerCurveNode.GetCurvePointsWorld(), inputCurveLocator, inputPolyDataLocator)
+    self.addScoresToTable(outputTableNode, weights, scores)
 
+  def computeScores(self, inputCurveNode, optimizerPoints_World, inputCurveLocator, inputPolyDataLocator,
+      optimizerSurfacePointIds=None, geodesicDistances=None):
+    """
+    Compare the optimizer curve points to the input curve.
+    The closest input curve and surface points are found with one query for all of the optimizer curve points, and the
+    scores are computed with array operations.
+    :param optimizerSurfacePointIds: IDs of the surface points of the optimizer curve, if known (ex. the sweep paths).
+      If None, the closest surface points are found using inputPolyDataLocator.
+    :param geodesicDistances: Distance along the surface from each surface point to the input curve
+      (see computeGeodesicDistances). If None, the distances are computed.
+    :return: Dictionary containing the score for each of the OBJECTIVE_COLUMN_NAMES and the ISO region sums
+    """
     polyData = inputCurveNode.GetShortestDistanceSurfaceNode().GetPolyData()
 
     pointData = polyData.GetPointData()
-    isoRegionsArray = pointData.GetArray(self.ISO_REGIONS_ARRAY_NAME)
+    isoRegions = numpy_support.vtk_to_numpy(pointData.GetArray(self.ISO_REGIONS_ARRAY_NAME))
 
+    numberOfPoints = optimizerPoints_World.GetNumberOfPoints()
     isoRegionSum = np.zeros(self.NUMBER_OF_ISO_REGIONS + 1)
+    if numberOfPoints == 0:
+      logging.warning("computeScores: Optimizer curve has no points")
+      scores = dict([(columnName, 0.0) for columnName in self.OBJECTIVE_COLUMN_NAMES])
+      scores["isoRegionSum"] = isoRegionSum
+      return scores
+
+    optimizerPoints = numpy_support.vtk_to_numpy(optimizerPoints_World.GetData()).astype(np.float64)
+    inputPoints = numpy_support.vtk_to_numpy(inputCurveLocator.GetDataSet().GetPoints().GetData()).astype(np.float64)
+
+    closestInputPointIds = self.findClosestPointIds(inputCurveLocator, optimizerPoints_World)
+    distances2 = np.sum((optimizerPoints - inputPoints[closestInputPointIds]) ** 2, axis=1)
+    averageDistance2 = np.mean(distances2)
+    maxDistance2 = np.max(distances2)
+    overlapPercent = np.count_nonzero(distances2 == 0.0) / numberOfPoints
+
+    if optimizerSurfacePointIds is None:
+      optimizerSurfacePointIds = self.findClosestPointIds(inputPolyDataLocator, optimizerPoints_World)
+    pointIsoRegions = isoRegions[optimizerSurfacePointIds].astype(np.int64)
+    pointIsoRegions = pointIsoRegions[(pointIsoRegions >= 0) & (pointIsoRegions <= self.NUMBER_OF_ISO_REGIONS)]
+    isoRegionSum += np.bincount(pointIsoRegions, minlength=self.NUMBER_OF_ISO_REGIONS + 1)
 
-    optimizerPoints_World = optimizerCurveNode.GetCurvePointsWorld()
-    averageDistance2 = 0.0
-    maxDistance2 = 0.0
-    overlapPercent = 0.0
-    for i in range(optimizerPoints_World.GetNumberOfPoints()):
-      optimizerPoint_World = optimizerPoints_World.GetPoint(i)
-      closestInputPointID = inputCurveLocator.FindClosestPoint(optimizerPoint_World)
-      closestPoint_World = inputCurveNode.GetCurvePointsWorld().GetPoint(closestInputPointID)
-      distance2 = vtk.vtkMath.Distance2BetweenPoints(optimizerPoint_World, closestPoint_World)
-      averageDistance2 += (distance2/optimizerPoints_World.GetNumberOfPoints())
-      if distance2 > maxDistance2:
-        maxDistance2 = distance2
-      if distance2 == 0.0:
-        overlapPercent += 1.0 / optimizerPoints_World.GetNumberOfPoints()
-
-      polyDataPointID = inputPolyDataLocator.FindClosestPoint(optimizerPoint_World)
-      isoRegion = isoRegionsArray.GetValue(polyDataPointID)
-      if isoRegion < 0 or isoRegion > self.NUMBER_OF_ISO_REGIONS:
-        continue
-      isoRegionSum[isoRegion] += 1
-
-    import math
+    penalty = 1.0 / self.NUMBER_OF_ISO_REGIONS
+    isoRegionIndices = np.arange(1, self.NUMBER_OF_ISO_REGIONS + 1)
+    fr = isoRegionSum[1:] / numberOfPoints
+    isoOverlap = np.mean(1 - (fr * (1 + (penalty * (isoRegionIndices - 1)))))
+
+    resampledOptimizerPoints = CurveComparisonMetrics.resampleCurve(optimizerPoints,
+      self.METRICS_RESAMPLING_SPACING, self.METRICS_MAXIMUM_NUMBER_OF_POINTS)
+    resampledInputPoints = CurveComparisonMetrics.resampleCurve(inputPoints,
+      self.METRICS_RESAMPLING_SPACING, self.METRICS_MAXIMUM_NUMBER_OF_POINTS)
+    if geodesicDistances is None:
+      geodesicDistances = self.computeGeodesicDistances(inputCurveNode, inputPolyDataLocator)
+
+    return {
+      self.AVERAGE_DISTANCE_COLUMN_NAME: math.sqrt(averageDistance2),
+      self.MAX_DISTANCE_COLUMN_NAME: math.sqrt(maxDistance2),
+      self.OVERLAP_PERCENT_COLUMN_NAME: float(overlapPercent),
+      self.ISO_OVERLAP_COLUMN_NAME: float(isoOverlap),
+      self.HAUSDORFF_DISTANCE_COLUMN_NAME: float(CurveComparisonMetrics.computeHausdorffDistance(resampledOptimizerPoints, resampledInputPoints)),
+      self.FRECHET_DISTANCE_COLUMN_NAME: float(CurveComparisonMetrics.computeFrechetDistance(resampledOptimizerPoints, resampledInputPoints)),
+      self.PERCENTILE_DISTANCE_COLUMN_NAME: float(CurveComparisonMetrics.computePercentileDistance(resampledOptimizerPoints, resampledInputPoints)),
+      self.GEODESIC_DISTANCE_COLUMN_NAME: float(CurveComparisonMetrics.computeAverageGeodesicDistance(geodesicDistances, optimizerSurfacePointIds)),
+      "isoRegionSum": isoRegionSum,
+      }
+
+  def computeGeodesicDistances(self, inputCurveNode, inputPolyDataLocator):
+    """
+    Compute the distance along the surface edges from each surface point to the closest point of the input curve.
+    :param inputPolyDataLocator: Locator of the surface in world coordinates (see prepareOptimization)
+    :return: numpy array containing the distance for each surface point
+    """
+    indptr, indices = self.getSurfaceGraph(inputCurveNode.GetShortestDistanceSurfaceNode())
+    points_World = numpy_support.vtk_to_numpy(inputPolyDataLocator.GetDataSet().GetPoints().GetData()).astype(np.float64)
+    sourcePointIds = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    edgeLength = np.linalg.norm(points_World[indices] - points_World[sourcePointIds], axis=1)
+    curvePointIds = self.findClosestPointIds(inputPolyDataLocator, inputCurveNode.GetCurvePointsWorld())
+    return CurveComparisonMetrics.computeGeodesicDistanceField(indptr, indices, edgeLength, curvePointIds)
+
+  def updateScoresFromPreviewCurve(self, inputCurveNode, outputTableNode, weights):
+    """
+    Compute the scores of the weights with the path of the preview curve node, and replace the scores in the row of the
+    weights in the output table. After an approximate sweep, this makes the scores of the weights match the path that
+    is displayed by the preview curve.
+    :return: Scores of the preview curve path, or None if they could not be computed
+    """
+    optimizationContext = self.prepareOptimization(inputCurveNode, None)
+    scores = self.computeWeightScores(optimizationContext, [weights])
+    # The preview curve is not updated if the scores were already in the result store
+    self.setCurveNodeWeights(optimizationContext["optimizerCurveNode"], weights)
+    if len(scores) == 0:
+      return None
+
+    table = outputTableNode.GetTable()
+    weightsArray = table.GetColumnByName(self.WEIGHTS_COLUMN_NAME)
+    rowIndex = -1
+    for i in range(weightsArray.GetNumberOfValues()):
+      if weightsArray.GetValue(i) == str(weights):
+        rowIndex = i
+        break
+    if rowIndex < 0:
+      self.addScoresToTable(outputTableNode, weights, scores[0])
+    else:
+      for columnName in self.OBJECTIVE_COLUMN_NAMES:
+        table.GetColumnByName(columnName).SetTuple1(rowIndex, scores[0][columnName])
+      logging.info("Preview curve scores for {0}: {1}".format(str(weights),
+        ", ".join(["{0}: {1}".format(columnName, scores[0][columnName]) for columnName in self.OBJECTIVE_COLUMN_NAMES])))
+    table.Modified()
+    return scores[0]
 
+  def addScoresToTable(self, outputTableNode, weights, scores):
+    """
+    Append a row containing the weights and their scores to the output table.
+    """
     weightsArray = outputTableNode.GetTable().GetColumnByName(self.WEIGHTS_COLUMN_NAME)
     weightsArray.InsertNextValue(str(weights))
 
-    averageDistance = math.sqrt(averageDistance2)
-    averageDistanceArray = outputTableNode.GetTable().GetColumnByName(self.AVERAGE_DISTANCE_COLUMN_NAME)
-    averageDistanceArray.InsertNextTuple1(averageDistance)
+    for columnName in self.OBJECTIVE_COLUMN_NAMES:
+      scoreArray = outputTableNode.GetTable().GetColumnByName(columnName)
+      scoreArray.InsertNextTuple1(scores[columnName])
 
-    maxDistance = math.sqrt(maxDistance2)
-    maxDistanceArray = outputTableNode.GetTable().GetColumnByName(self.MAX_DISTANCE_COLUMN_NAME)
-    maxDistanceArray.InsertNextTuple1(math.sqrt(maxDistance))
-
-    overlapPercentArray = outputTableNode.GetTable().GetColumnByName(self.OVERLAP_PERCENT_COLUMN_NAME)
-    overlapPercentArray.InsertNextTuple1(overlapPercent)
-
-    isoOverlap = 0.0
-    penalty = 1.0 / self.NUMBER_OF_ISO_REGIONS
-    for isoRegion in range(1, self.NUMBER_OF_ISO_REGIONS+1):
-      regionSum = isoRegionSum[isoRegion]
-      fr = regionSum / optimizerPoints_World.GetNumberOfPoints()
-      subtotal = (1 - (fr * (1 + (penalty * (isoRegion - 1)))))
-      isoOverlap += subtotal
-    isoOverlap /= self.NUMBER_OF_ISO_REGIONS
-
-    isoOverlapArray = outputTableNode.GetTable().GetColumnByName(self.ISO_OVERLAP_COLUMN_NAME)
-    isoOverlapArray.InsertNextTuple1(isoOverlap)
-
-    logging.info("{0}: Average distance: {1}, Max distance: {2}, Overlap percent: {3}, ISO Overlap: {4} ||| {5}".format(
-      str(weights), str(averageDistance), str(maxDistance), str(overlapPercent), str(isoOverlap), str(isoRegionSum)))
+    scoreStrings = ["{0}: {1}".format(columnName, scores[columnName]) for columnName in self.OBJECTIVE_COLUMN_NAMES]
+    logging.info("{0}: {1} ||| {2}".format(str(weights), ", ".join(scoreStrings), str(scores["isoRegionSum"])))
 
   def createISORegionOverlay(self, curveNode):
     """
+    Label the surface points by their number of edges from the curve, up to NUMBER_OF_ISO_REGIONS.
     :param curve: The curve that the overlay will be created from (vtkMRMLMarkupsCurveNode)
     """
     modelNode = curveNode.GetShortestDistanceSurfaceNode()
@@ -379,19 +951,15 @@ class CurveComparisonLogic(ScriptedLoadableModuleLogic, VTKObservationMixin):
       # No polydata. Nothing to compute overlay on.
       return
 
-    transformFilter = vtk.vtkTransformPolyDataFilter()
-    transformFilter.SetInputData(polyData)
-    modelToWorldTransform = vtk.vtkGeneralTransform()
-    slicer.vtkMRMLTransformNode.GetTransformBetweenNodes(modelNode.GetParentTransformNode(), None, modelToWorldTransform)
-    transformFilter.SetTransform(modelToWorldTransform)
-    transformFilter.Update()
-    polyData = transformFilter.GetOutput()
-
-    pointLocator = vtk.vtkPointLocator()
-    pointLocator.SetDataSet(transformFilter.GetOutput())
-    pointLocator.BuildLocator()
-
+    pointLocator = self.createPointLocator(self.getSurfacePolyDataWorld(modelNode))
     curvePoints = curveNode.GetCurvePointsWorld()
+    if curvePoints is None or curvePoints.GetNumberOfPoints() == 0:
+      curvePointIds = np.zeros(0, dtype=np.int64)
+    else:
+      curvePointIds = self.findClosestPointIds(pointLocator, curvePoints)
+
+    indptr, indices = self.getSurfaceGraph(modelNode)
+    isoRegions = computeRingLabels(indptr, indices, curvePointIds, self.NUMBER_OF_ISO_REGIONS)
 
     pointData = polyData.GetPointData()
     isoRegionsArray = pointData.GetArray(self.ISO_REGIONS_ARRAY_NAME)
@@ -399,45 +967,60 @@ class CurveComparisonLogic(ScriptedLoadableModuleLogic, VTKObservationMixin):
       isoRegionsArray = vtk.vtkIdTypeArray()
       isoRegionsArray.SetName(self.ISO_REGIONS_ARRAY_NAME)
     isoRegionsArray.SetNumberOfValues(polyData.GetNumberOfPoints())
-    isoRegionsArray.Fill(-1)
+    numpy_support.vtk_to_numpy(isoRegionsArray)[:] = isoRegions
+    isoRegionsArray.Modified()
     modelNode.AddPointScalars(isoRegionsArray)
 
-    visitedPoints = []
-    previousISORegion = []
-    for regionIndex in range(self.NUMBER_OF_ISO_REGIONS+1):
-      currentISORegion = []
-      if regionIndex == 0:
-        for i in range(curvePoints.GetNumberOfPoints()):
-          curvePoint_World = curvePoints.GetPoint(i)
-          currentISORegion.append(pointLocator.FindClosestPoint(curvePoint_World))
-      else:
-        currentISORegion = self.getAdjacentPoints(polyData, previousISORegion)
-
-      for isoPointID in currentISORegion:
-        if isoPointID in visitedPoints:
-          continue
-        isoRegionsArray.SetValue(isoPointID, regionIndex)
+    if modelNode.GetDisplayNode():
+      modelNode.GetDisplayNode().Modified()
 
-      visitedPoints += currentISORegion
-      previousISORegion = currentISORegion
+  def getISORegionOverlayValues(self, modelNode):
+    """
+    Returns a copy of the ISO region overlay of the model, or None if the model doesn't have an overlay.
+    """
+    polyData = modelNode.GetPolyData()
+    isoRegionsArray = polyData.GetPointData().GetArray(self.ISO_REGIONS_ARRAY_NAME) if polyData else None
+    if isoRegionsArray is None:
+      return None
+    return numpy_support.vtk_to_numpy(isoRegionsArray).copy()
 
+  def restoreISORegionOverlay(self, modelNode, isoRegions):
+    """
+    Restore the ISO region overlay returned by getISORegionOverlayValues.
+    :param isoRegions: Values of the overlay. If None, the overlay is removed from the model.
+    """
+    polyData = modelNode.GetPolyData()
+    if polyData is None:
+      return
+    pointData = polyData.GetPointData()
+    isoRegionsArray = pointData.GetArray(self.ISO_REGIONS_ARRAY_NAME)
+    if isoRegions is None:
+      if isoRegionsArray is not None:
+        pointData.RemoveArray(self.ISO_REGIONS_ARRAY_NAME)
+    elif isoRegionsArray is not None and isoRegionsArray.GetNumberOfValues() == len(isoRegions):
+      numpy_support.vtk_to_numpy(isoRegionsArray)[:] = isoRegions
+      isoRegionsArray.Modified()
+    # The overlay no longer matches the curve that it was last created from
+    self.isoRegionOverlayKeys.pop(modelNode.GetID(), None)
     if modelNode.GetDisplayNode():
       modelNode.GetDisplayNode().Modified()
 
-  def getAdjacentPoints(self, inputPolydata, inputPointIDs):
-    pointIDs = []
-    cellIdList = vtk.vtkIdList()
-    pointIdList = vtk.vtkIdList()
-    for pointID in inputPointIDs:
-      inputPolydata.GetPointCells(pointID, cellIdList)
-      for cellIndex in range(cellIdList.GetNumberOfIds()):
-        inputPolydata.GetCellPoints(cellIdList.GetId(cellIndex), pointIdList)
-        for pointIndex in range(pointIdList.GetNumberOfIds()):
-          pointID = pointIdList.GetId(pointIndex)
-          if pointID in inputPointIDs or pointID in pointIDs:
-            continue
-          pointIDs.append(pointID)
-    return pointIDs
+  def getSurfaceGraph(self, modelNode):
+    """
+    Returns the vertex adjacency of the model surface in compressed sparse row format (see createSurfaceGraph).
+    The adjacency is cached until the polydata of the model is modified.
+    """
+    polyData = modelNode.GetPolyData()
+    # Only the geometry is checked, since the point data is modified when the ISO regions are updated
+    polyDataMTime = (polyData.GetPoints().GetMTime(), polyData.GetPolys().GetMTime(), polyData.GetNumberOfPoints())
+    cachedMTime, indptr, indices = self.surfaceGraphCache.get(modelNode.GetID(), (None, None, None))
+    if cachedMTime == polyDataMTime:
+      return indptr, indices
+
+    points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())
+    indptr, indices, edgeLength = createSurfaceGraph(points, self.getSurfaceTriangles(polyData))
+    self.surfaceGraphCache[modelNode.GetID()] = (polyDataMTime, indptr, indices)
+    return indptr, indices
 
   def binaryArray(self, num, m):
     """
@@ -445,3 +1028,259 @@ class CurveComparisonLogic(ScriptedLoadableModuleLogic, VTKObservationMixin):
     From: https://stackoverflow.com/a/47521145
     """
     return (np.array(list(np.binary_repr(num).zfill(m))).astype(np.int8)).tolist()
+
+class CurveComparisonTest(ScriptedLoadableModuleTest):
+  """
+  This is the test case for your scripted module.
+  Uses ScriptedLoadableModuleTest base class, available at:
+  https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
+  """
+
+  def setUp(self):
+    """ Do whatever is needed to reset the state - typically a scene clear will be enough.
+    """
+    slicer.mrmlScene.Clear()
+
+  def runTest(self):
+    """Run as few or as many tests as needed here.
+    """
+    self.setUp()
+    self.test_SweepPaths()
+    self.setUp()
+    self.test_Optimizer()
+    self.setUp()
+    self.test_ClosestPointIds()
+    self.setUp()
+    self.test_RingLabels()
+    self.setUp()
+    self.test_ResultStore()
+    self.setUp()
+    self.test_CurveMetrics()
+
+  def createGridSurface(self, numberOfRows, numberOfColumns, spacing=1.0):
+    """
+    Create a flat triangulated grid in the XY plane.
+    :return: Tuple containing the numpy arrays of the points (N x 3) and triangles (M x 3). The ID of the point in row
+      i and column j is i * numberOfColumns + j.
+    """
+    rows, columns = np.meshgrid(np.arange(numberOfRows), np.arange(numberOfColumns), indexing="ij")
+    points = np.stack([columns.ravel() * spacing, rows.ravel() * spacing, np.zeros(rows.size)], axis=1)
+    triangles = []
+    for row in range(numberOfRows - 1):
+      for column in range(numberOfColumns - 1):
+        pointId = row * numberOfColumns + column
+        triangles.append([pointId, pointId + 1, pointId + numberOfColumns])
+        triangles.append([pointId + 1, pointId + numberOfColumns + 1, pointId + numberOfColumns])
+    return points, np.array(triangles, dtype=np.int64)
+
+  def test_SweepPaths(self):
+    """
+    Compute sweep paths on a flat grid in the current process, and check that the distance weight finds the straight
+    path between the end points.
+    """
+    self.delayDisplay("Starting the sweep test")
+
+    points, triangles = self.createGridSurface(5, 5)
+    scalars = np.zeros(len(points))
+    startPointId = 2 * 5
+    endPointId = 2 * 5 + 4
+    sweep = CurveComparisonSweep(points, triangles, scalars, scalars, startPointId, endPointId)
+
+    distanceWeights = [1.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
+    self.assertEqual(sweep.computePath(distanceWeights), [10, 11, 12, 13, 14])
+
+    results = {}
+    def resultCallback(index, weights, path):
+      results[index] = path
+    weightsList = [distanceWeights, [1.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0]]
+    self.assertTrue(sweep.run(weightsList, 1, resultCallback))
+    self.assertEqual(sorted(results.keys()), [0, 1])
+    for path in results.values():
+      self.assertEqual(path[0], startPointId)
+      self.assertEqual(path[-1], endPointId)
+
+    # Returning False from the callback cancels the remaining paths
+    self.assertFalse(sweep.run(weightsList, 1, lambda index, weights, path: False))
+
+    self.delayDisplay('Test passed')
+
+  def test_Optimizer(self):
+    """
+    Minimize a quadratic objective with the pattern search, and check the evaluation budget and cancellation.
+    """
+    self.delayDisplay("Starting the optimizer test")
+
+    targetWeights = np.array([0.25, 0.75])
+    evaluatedWeightsList = []
+    def evaluateFunction(weightsList):
+      evaluatedWeightsList.extend(weightsList)
+      return [float(np.sum((np.array(weights) - targetWeights) ** 2)) for weights in weightsList]
+
+    optimizer = CurveComparisonOptimizer(evaluateFunction, numberOfWeights=2, maximumEvaluations=64)
+    bestWeights, bestValue = optimizer.run([[1.0, 0.0], [0.5, 0.5]])
+    np.testing.assert_allclose(bestWeights, targetWeights)
+    self.assertAlmostEqual(bestValue, 0.0)
+    self.assertLessEqual(optimizer.getNumberOfEvaluations(), 64)
+    # Weight vectors are never evaluated twice
+    self.assertEqual(len(evaluatedWeightsList), len(set([tuple(weights) for weights in evaluatedWeightsList])))
+
+    optimizer = CurveComparisonOptimizer(evaluateFunction, numberOfWeights=2, maximumEvaluations=3)
+    optimizer.run([[1.0, 0.0], [0.5, 0.5]])
+    self.assertEqual(optimizer.getNumberOfEvaluations(), 3)
+
+    # The search stops if the evaluation function returns fewer values than requested
+    optimizer = CurveComparisonOptimizer(lambda weightsList: [], numberOfWeights=2)
+    self.assertEqual(optimizer.run([[1.0, 0.0]]), (None, None))
+    self.assertTrue(optimizer.cancelled)
+
+    optimizer = CurveComparisonOptimizer(evaluateFunction, numberOfWeights=2, maximize=True)
+    bestWeights, bestValue = optimizer.run([[0.5, 0.5]])
+    np.testing.assert_allclose(bestWeights, [1.0, 0.0])
+    self.assertAlmostEqual(bestValue, 1.125)
+
+    self.delayDisplay('Test passed')
+
+  def test_ClosestPointIds(self):
+    """
+    Find the closest surface points of many points with a single query, and compare them to a brute force search.
+    """
+    self.delayDisplay("Starting the closest point test")
+
+    surfacePoints = self.createGridSurface(10, 10)[0]
+    polyData = vtk.vtkPolyData()
+    polyData.SetPoints(vtk.vtkPoints())
+    polyData.GetPoints().SetData(numpy_support.numpy_to_vtk(surfacePoints, deep=True))
+
+    queryPoints = np.random.RandomState(0).uniform(-1.0, 10.0, (200, 3))
+    vtkQueryPoints = vtk.vtkPoints()
+    vtkQueryPoints.SetData(numpy_support.numpy_to_vtk(queryPoints, deep=True))
+
+    logic = CurveComparisonLogic()
+    pointLocator = logic.createPointLocator(polyData)
+    closestPointIds = logic.findClosestPointIds(pointLocator, vtkQueryPoints)
+
+    distances = np.linalg.norm(queryPoints[:, np.newaxis, :] - surfacePoints[np.newaxis, :, :], axis=2)
+    expectedDistances = distances.min(axis=1)
+    np.testing.assert_allclose(distances[np.arange(len(queryPoints)), closestPointIds], expectedDistances, atol=1e-6)
+
+    # Locators that are not static are replaced by a temporary static locator
+    pointLocator = vtk.vtkPointLocator()
+    pointLocator.SetDataSet(polyData)
+    pointLocator.BuildLocator()
+    closestPointIds = logic.findClosestPointIds(pointLocator, vtkQueryPoints)
+    np.testing.assert_allclose(distances[np.arange(len(queryPoints)), closestPointIds], expectedDistances, atol=1e-6)
+
+    self.delayDisplay('Test passed')
+
+  def test_RingLabels(self):
+    """
+    Label the rings around a seed point of a grid, and compare them to the number of edges from the seed.
+    """
+    self.delayDisplay("Starting the ring label test")
+
+    numberOfRows = 7
+    numberOfColumns = 7
+    points, triangles = self.createGridSurface(numberOfRows, numberOfColumns)
+    indptr, indices, edgeLength = createSurfaceGraph(points, triangles)
+    self.assertEqual(len(indptr), len(points) + 1)
+    np.testing.assert_allclose(edgeLength[edgeLength > 1.0], np.sqrt(2.0))
+
+    seedPointId = 3 * numberOfColumns + 3
+    labels = computeRingLabels(indptr, indices, [seedPointId], 2)
+
+    # The diagonal edges of the grid connect points whose row and column offsets have opposite signs
+    rows, columns = np.divmod(np.arange(len(points)), numberOfColumns)
+    rowOffsets = rows - 3
+    columnOffsets = columns - 3
+    sameSign = rowOffsets * columnOffsets > 0
+    numberOfEdges = np.where(sameSign, np.abs(rowOffsets) + np.abs(columnOffsets),
+      np.maximum(np.abs(rowOffsets), np.abs(columnOffsets)))
+    expectedLabels = np.where(numberOfEdges <= 2, numberOfEdges, -1)
+    np.testing.assert_array_equal(labels, expectedLabels)
+
+    # Rings are measured from the closest of multiple seeds
+    labels = computeRingLabels(indptr, indices, [0, len(points) - 1], 1)
+    self.assertEqual(labels[0], 0)
+    self.assertEqual(labels[len(points) - 1], 0)
+    self.assertEqual(labels[1], 1)
+    self.assertEqual(labels[len(points) - 2], 1)
+    self.assertEqual(labels[seedPointId], -1)
+
+    self.delayDisplay('Test passed')
+
+  def test_ResultStore(self):
+    """
+    Store scores in a result directory, read them with a new store, and check that the least recently used result
+    files are removed.
+    """
+    self.delayDisplay("Starting the result store test")
+
+    directory = tempfile.mkdtemp()
+    try:
+      resultStore = CurveComparisonResultStore(directory, maximumNumberOfInputs=2)
+      inputKey = resultStore.getInputKey(np.array([[0.0, 1.0, 2.0]]), None, "preview")
+      self.assertNotEqual(inputKey, resultStore.getInputKey(np.array([[0.0, 1.0, 2.0]]), None, "sweep"))
+      self.assertNotEqual(inputKey, resultStore.getInputKey(np.array([[0.0, 1.0, 3.0]]), None, "preview"))
+
+      weights = [1.0, 0.0, 0.5, 0.0, 0.0, 0.0, 0.0, 0.0]
+      self.assertIsNone(resultStore.getScores(inputKey, weights))
+      resultStore.setScores(inputKey, weights, {"averageDistance": 1.5, "isoRegionSum": np.array([1, 2, 3])})
+      resultStore.write()
+      self.assertEqual(len(resultStore.getResultPaths()), 1)
+
+      resultStore = CurveComparisonResultStore(directory, maximumNumberOfInputs=2)
+      scores = resultStore.getScores(inputKey, weights)
+      self.assertEqual(scores["averageDistance"], 1.5)
+      np.testing.assert_array_equal(scores["isoRegionSum"], [1, 2, 3])
+      self.assertIsNone(resultStore.getScores(inputKey, [0.0] * 8))
+
+      # Only the modified inputs are written, and the oldest result files are removed
+      inputResultPath = resultStore.getInputResultPath(inputKey)
+      os.utime(inputResultPath, (0, 0))
+      for index in range(2):
+        otherInputKey = resultStore.getInputKey(str(index))
+        resultStore.setScores(otherInputKey, weights, {"averageDistance": index, "isoRegionSum": []})
+      resultStore.write()
+      self.assertEqual(len(resultStore.getResultPaths()), 2)
+      self.assertFalse(os.path.exists(inputResultPath))
+
+      resultStore.clear()
+      self.assertEqual(resultStore.getResultPaths(), [])
+      self.assertEqual(resultStore.getNumberOfResults(), 0)
+    finally:
+      shutil.rmtree(directory, ignore_errors=True)
+
+    self.delayDisplay('Test passed')
+
+  def test_CurveMetrics(self):
+    """
+    Compare the Hausdorff, Frechet, percentile and geodesic distances of simple curves with their known values.
+    """
+    self.delayDisplay("Starting the curve metrics test")
+
+    resampledPoints = CurveComparisonMetrics.resampleCurve([[0.0, 0.0, 0.0], [10.0, 0.0, 0.0]], 1.0)
+    self.assertEqual(len(resampledPoints), 11)
+    np.testing.assert_allclose(resampledPoints[:, 0], np.arange(11.0))
+    self.assertEqual(len(CurveComparisonMetrics.resampleCurve([[0.0, 0.0, 0.0], [10.0, 0.0, 0.0]], 1.0, 5)), 5)
+
+    pointsA = resampledPoints
+    pointsB = pointsA + np.array([0.0, 2.0, 0.0])
+    self.assertAlmostEqual(CurveComparisonMetrics.computeHausdorffDistance(pointsA, pointsB), 2.0)
+    self.assertAlmostEqual(CurveComparisonMetrics.computeFrechetDistance(pointsA, pointsB), 2.0)
+    self.assertAlmostEqual(CurveComparisonMetrics.computePercentileDistance(pointsA, pointsB), 2.0)
+
+    # The Frechet distance takes the direction of the curves into account, while the Hausdorff distance does not
+    self.assertAlmostEqual(CurveComparisonMetrics.computeHausdorffDistance(pointsA, pointsA[::-1]), 0.0)
+    self.assertAlmostEqual(CurveComparisonMetrics.computeFrechetDistance(pointsA, pointsA[::-1]), 10.0)
+
+    # Curves with different numbers of points
+    self.assertAlmostEqual(CurveComparisonMetrics.computeFrechetDistance(pointsA, pointsB[::2]), np.sqrt(5.0))
+
+    points, triangles = self.createGridSurface(3, 3)
+    indptr, indices, edgeLength = createSurfaceGraph(points, triangles)
+    geodesicDistances = CurveComparisonMetrics.computeGeodesicDistanceField(indptr, indices, edgeLength, [0, 1, 2])
+    np.testing.assert_allclose(geodesicDistances, [0.0, 0.0, 0.0, 1.0, 1.0, 1.0, 2.0, 2.0, 2.0])
+    self.assertAlmostEqual(CurveComparisonMetrics.computeAverageGeodesicDistance(geodesicDistances, [6, 7, 3]), 5.0 / 3.0)
+    self.assertEqual(CurveComparisonMetrics.computeAverageGeodesicDistance(geodesicDistances, []), 0.0)
+
+    self.delayDisplay('Test passed')
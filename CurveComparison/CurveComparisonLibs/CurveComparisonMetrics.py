@@ -0,0 +1,125 @@
+import heapq
+import numpy as np
+
+# Metrics comparing a candidate curve to the input curve. The curves are resampled to the same point spacing, so the
+# metrics don't depend on how densely each curve is sampled.
+
+def resampleCurve(points, spacing, maximumNumberOfPoints=None):
+  """
+  Resample a polyline to points that are evenly spaced along its length.
+  :param points: numpy array (N x 3) of the polyline points
+  :param spacing: Distance between the resampled points
+  :param maximumNumberOfPoints: If specified, the spacing is increased for long curves so that the number of points
+    is limited. The pairwise metrics scale with the product of the number of points on both curves.
+  :return: numpy array (M x 3) of the resampled points, including the first and last points
+  """
+  points = np.asarray(points, dtype=np.float64)
+  if len(points) < 2:
+    return points.copy()
+  segmentLengths = np.linalg.norm(np.diff(points, axis=0), axis=1)
+  arcLengths = np.concatenate([[0.0], np.cumsum(segmentLengths)])
+  curveLength = arcLengths[-1]
+  if curveLength <= 0.0 or spacing <= 0.0:
+    return points[[0, -1]].copy()
+  numberOfSegments = max(1, int(np.ceil(curveLength / spacing)))
+  if maximumNumberOfPoints:
+    numberOfSegments = min(numberOfSegments, max(1, maximumNumberOfPoints - 1))
+  sampleLengths = np.linspace(0.0, curveLength, numberOfSegments + 1)
+  return np.stack([np.interp(sampleLengths, arcLengths, points[:, axis]) for axis in range(3)], axis=1)
+
+def getClosestDistances(sourcePoints, targetPoints, chunkSize=1024):
+  """
+  Find the distance from each source point to the closest target point.
+  :return: numpy array containing the distance for each source point
+  """
+  sourcePoints = np.asarray(sourcePoints, dtype=np.float64)
+  targetPoints = np.asarray(targetPoints, dtype=np.float64)
+  distances = np.empty(len(sourcePoints))
+  # Compare the source points in chunks to limit the size of the distance matrix
+  for start in range(0, len(sourcePoints), chunkSize):
+    chunk = sourcePoints[start:start + chunkSize]
+    distances2 = np.sum((chunk[:, np.newaxis, :] - targetPoints[np.newaxis, :, :]) ** 2, axis=2)
+    distances[start:start + chunkSize] = np.sqrt(distances2.min(axis=1))
+  return distances
+
+def computeHausdorffDistance(pointsA, pointsB):
+  """
+  Symmetric Hausdorff distance: the largest distance from a point on either curve to the closest point on the other.
+  """
+  return max(getClosestDistances(pointsA, pointsB).max(), getClosestDistances(pointsB, pointsA).max())
+
+def computePercentileDistance(pointsA, pointsB, percentile=95.0):
+  """
+  Percentile of the distances from the points on both curves to the closest point on the other curve.
+  Less sensitive to a few outlying points than the Hausdorff distance.
+  """
+  distances = np.concatenate([getClosestDistances(pointsA, pointsB), getClosestDistances(pointsB, pointsA)])
+  return np.percentile(distances, percentile)
+
+def computeFrechetDistance(pointsA, pointsB):
+  """
+  Discrete Fréchet distance between two curves, which takes the order of the points into account.
+  The coupling table is filled one anti-diagonal at a time, since each cell only depends on the previous two diagonals.
+  """
+  pointsA = np.asarray(pointsA, dtype=np.float64)
+  pointsB = np.asarray(pointsB, dtype=np.float64)
+  numberOfPointsA = len(pointsA)
+  numberOfPointsB = len(pointsB)
+  distances = np.sqrt(np.sum((pointsA[:, np.newaxis, :] - pointsB[np.newaxis, :, :]) ** 2, axis=2))
+
+  coupling = np.full((numberOfPointsA, numberOfPointsB), np.inf)
+  for diagonal in range(numberOfPointsA + numberOfPointsB - 1):
+    i = np.arange(max(0, diagonal - numberOfPointsB + 1), min(diagonal, numberOfPointsA - 1) + 1)
+    j = diagonal - i
+    if diagonal == 0:
+      coupling[0, 0] = distances[0, 0]
+      continue
+    previous = np.full(len(i), np.inf)
+    hasPreviousI = i > 0
+    hasPreviousJ = j > 0
+    hasPreviousIJ = hasPreviousI & hasPreviousJ
+    previous[hasPreviousI] = np.minimum(previous[hasPreviousI], coupling[i[hasPreviousI] - 1, j[hasPreviousI]])
+    previous[hasPreviousJ] = np.minimum(previous[hasPreviousJ], coupling[i[hasPreviousJ], j[hasPreviousJ] - 1])
+    previous[hasPreviousIJ] = np.minimum(previous[hasPreviousIJ], coupling[i[hasPreviousIJ] - 1, j[hasPreviousIJ] - 1])
+    coupling[i, j] = np.maximum(previous, distances[i, j])
+  return coupling[-1, -1]
+
+def computeGeodesicDistanceField(indptr, indices, edgeLength, seedPointIds):
+  """
+  Compute the distance along the surface edges from every point to the closest seed point, using a multi-source
+  Dijkstra search. The field only depends on the input curve, so it can be computed once and used for every candidate.
+  :param seedPointIds: IDs of the surface points of the input curve
+  :return: numpy array containing the distance of each point, or inf for points that can't be reached
+  """
+  numberOfPoints = len(indptr) - 1
+  distances = np.full(numberOfPoints, np.inf)
+  visited = np.zeros(numberOfPoints, dtype=bool)
+
+  indptr = indptr.tolist()
+  indices = indices.tolist()
+  edgeLength = edgeLength.tolist()
+  heap = []
+  for seedPointId in np.unique(np.asarray(seedPointIds, dtype=np.int64)).tolist():
+    distances[seedPointId] = 0.0
+    heap.append((0.0, seedPointId))
+  heapq.heapify(heap)
+  while heap:
+    distance, pointId = heapq.heappop(heap)
+    if visited[pointId]:
+      continue
+    visited[pointId] = True
+    for edgeId in range(indptr[pointId], indptr[pointId + 1]):
+      neighbourId = indices[edgeId]
+      neighbourDistance = distance + edgeLength[edgeId]
+      if neighbourDistance < distances[neighbourId]:
+        distances[neighbourId] = neighbourDistance
+        heapq.heappush(heap, (neighbourDistance, neighbourId))
+  return distances
+
+def computeAverageGeodesicDistance(geodesicDistances, surfacePointIds):
+  """
+  Average distance along the surface from the surface points of a candidate curve to the input curve.
+  """
+  if len(surfacePointIds) == 0:
+    return 0.0
+  return np.mean(geodesicDistances[np.asarray(surfacePointIds, dtype=np.int64)])
@@ -0,0 +1,111 @@
+import logging
+import numpy as np
+
+class CurveComparisonOptimizer():
+  """
+  Searches the continuous weight space for the weights with the best objective value, using a budgeted pattern search.
+  At each iteration, every weight of the current best vector is increased and decreased by the step size. If none of
+  the neighbouring vectors improve the objective, the step size is halved. The search stops when the step size is
+  smaller than the minimum step, or when the maximum number of evaluations is reached.
+  The neighbours of an iteration are evaluated together, so they can be computed in parallel, and weight vectors that
+  have already been evaluated are never evaluated again.
+  """
+
+  def __init__(self, evaluateFunction, numberOfWeights=8, maximumEvaluations=64, maximize=False,
+      initialStep=0.5, minimumStep=1.0/32.0, lowerBound=0.0, upperBound=1.0):
+    """
+    :param evaluateFunction: Function that takes a list of weight vectors, and returns a list containing the objective
+      value of each of them. If the evaluation is cancelled, the returned list is shorter than the input list.
+    :param maximumEvaluations: Maximum number of weight vectors that are evaluated
+    :param maximize: If True, higher objective values are better. Otherwise, lower values are better.
+    """
+    self.evaluateFunction = evaluateFunction
+    self.numberOfWeights = numberOfWeights
+    self.maximumEvaluations = maximumEvaluations
+    self.maximize = maximize
+    self.initialStep = initialStep
+    self.minimumStep = minimumStep
+    self.lowerBound = lowerBound
+    self.upperBound = upperBound
+    self.evaluatedWeights = {} # Key is the rounded weight vector, value is the objective value
+    self.cancelled = False
+
+  def getKey(self, weights):
+    return tuple([round(float(weight), 6) for weight in weights])
+
+  def getNumberOfEvaluations(self):
+    return len(self.evaluatedWeights)
+
+  def isBetter(self, value, otherValue):
+    if otherValue is None:
+      return value is not None
+    if value is None:
+      return False
+    return value > otherValue if self.maximize else value < otherValue
+
+  def evaluate(self, weightsList):
+    """
+    Evaluate the weight vectors that have not been evaluated yet, up to the maximum number of evaluations.
+    :return: List containing the objective value of each weight vector, or None if it could not be evaluated
+    """
+    newWeightsList = []
+    newKeys = set()
+    for weights in weightsList:
+      key = self.getKey(weights)
+      if key in self.evaluatedWeights or key in newKeys:
+        continue
+      if self.getNumberOfEvaluations() + len(newWeightsList) >= self.maximumEvaluations:
+        break
+      newKeys.add(key)
+      newWeightsList.append(list(key))
+
+    if len(newWeightsList) > 0 and not self.cancelled:
+      values = self.evaluateFunction(newWeightsList)
+      if len(values) < len(newWeightsList):
+        self.cancelled = True
+      for weights, value in zip(newWeightsList, values):
+        self.evaluatedWeights[self.getKey(weights)] = value
+
+    return [self.evaluatedWeights.get(self.getKey(weights)) for weights in weightsList]
+
+  def getNeighbours(self, weights, step):
+    neighbours = []
+    for weightIndex in range(self.numberOfWeights):
+      for direction in [1.0, -1.0]:
+        neighbour = np.array(weights, dtype=np.float64)
+        neighbour[weightIndex] = np.clip(neighbour[weightIndex] + direction * step, self.lowerBound, self.upperBound)
+        # At least one weight must be non-zero for the path cost to be defined
+        if not np.any(neighbour > 0.0):
+          continue
+        neighbours.append(neighbour.tolist())
+    return neighbours
+
+  def run(self, initialWeightsList):
+    """
+    Search for the best weights, starting from the best of the initial weight vectors.
+    :return: Tuple containing the best weights and their objective value
+    """
+    bestWeights = None
+    bestValue = None
+    for weights, value in zip(initialWeightsList, self.evaluate(initialWeightsList)):
+      if self.isBetter(value, bestValue):
+        bestWeights = list(self.getKey(weights))
+        bestValue = value
+    if bestWeights is None:
+      return None, None
+
+    step = self.initialStep
+    while (step >= self.minimumStep and self.getNumberOfEvaluations() < self.maximumEvaluations
+        and not self.cancelled):
+      neighbours = self.getNeighbours(bestWeights, step)
+      improved = False
+      for weights, value in zip(neighbours, self.evaluate(neighbours)):
+        if self.isBetter(value, bestValue):
+          bestWeights = list(self.getKey(weights))
+          bestValue = value
+          improved = True
+      if not improved:
+        step /= 2.0
+      logging.debug("CurveComparisonOptimizer: Best {0}: {1}, step: {2}".format(bestWeights, bestValue, step))
+
+    return bestWeights, bestValue
@@ -0,0 +1,171 @@
+import hashlib
+import json
+import logging
+import os
+import numpy as np
+
+class CurveComparisonResultStore():
+  """
+  Stores the scores of evaluated weight vectors, so that they are not computed again when the same curve is compared
+  on the same surface. Results are keyed by a hash of the inputs (see getInputKey) and the weight vector.
+  If a directory is specified, the results of each input key are written to a separate JSON file in the directory, so
+  they are kept between sessions. Only the files of input keys with new results are written, and the files of the
+  least recently used input keys are removed when there are more than maximumNumberOfInputs files.
+  """
+
+  # Increment if the way that paths or scores are computed changes, so that older results are not used
+  RESULT_STORE_VERSION = 3
+  RESULT_FILE_EXTENSION = ".json"
+
+  def __init__(self, directory=None, maximumNumberOfInputs=256):
+    self.directory = None
+    self.maximumNumberOfInputs = maximumNumberOfInputs
+    self.results = {} # Key is the input key, value is a dictionary of the scores with the weights key as the key
+    self.modifiedInputKeys = set()
+    self.setDirectory(directory)
+
+  def setDirectory(self, directory):
+    """
+    Set the directory that the results are stored in. Results of the previous directory that were not written are discarded.
+    :param directory: Path of the directory. If None, results are only kept in memory.
+    """
+    if self.directory == directory:
+      return
+    self.directory = directory
+    self.results = {}
+    self.modifiedInputKeys = set()
+
+  def getNumberOfResults(self):
+    """
+    Returns the number of results that have been read or added in this session.
+    """
+    return sum([len(inputResults) for inputResults in self.results.values()])
+
+  def getInputKey(self, *inputArrays):
+    """
+    Returns a hash of the contents of the input arrays (ex. curve points, surface points and triangles, overlays).
+    Arrays that are None are hashed as empty, and strings (ex. other input keys) are hashed as text.
+    """
+    inputHash = hashlib.sha256()
+    inputHash.update(str(self.RESULT_STORE_VERSION).encode("utf-8"))
+    for inputArray in inputArrays:
+      inputHash.update(b"\0")
+      if inputArray is None:
+        continue
+      if isinstance(inputArray, str):
+        inputHash.update(inputArray.encode("utf-8"))
+        continue
+      inputArray = np.ascontiguousarray(inputArray)
+      inputHash.update(str((inputArray.dtype.str, inputArray.shape)).encode("utf-8"))
+      inputHash.update(inputArray.tobytes())
+    return inputHash.hexdigest()
+
+  def getWeightsKey(self, weights):
+    return json.dumps([round(float(weight), 6) for weight in weights])
+
+  def getInputResultPath(self, inputKey):
+    if self.directory is None:
+      return None
+    return os.path.join(self.directory, inputKey + self.RESULT_FILE_EXTENSION)
+
+  def getInputResults(self, inputKey):
+    """
+    Returns the dictionary of the results of the input key, reading them from the directory the first time.
+    """
+    inputResults = self.results.get(inputKey)
+    if inputResults is None:
+      inputResults = self.readInputResults(inputKey)
+      self.results[inputKey] = inputResults
+    return inputResults
+
+  def getScores(self, inputKey, weights):
+    """
+    :return: Dictionary containing the stored scores, or None if the weights have not been evaluated for the inputs
+    """
+    scores = self.getInputResults(inputKey).get(self.getWeightsKey(weights))
+    if scores is None:
+      return None
+    scores = dict(scores)
+    scores["isoRegionSum"] = np.array(scores["isoRegionSum"])
+    return scores
+
+  def setScores(self, inputKey, weights, scores):
+    storedScores = {}
+    for name, value in scores.items():
+      storedScores[name] = np.asarray(value).tolist()
+    self.getInputResults(inputKey)[self.getWeightsKey(weights)] = storedScores
+    self.modifiedInputKeys.add(inputKey)
+
+  def clear(self):
+    """
+    Remove all of the results, including the result files in the directory.
+    """
+    self.results = {}
+    self.modifiedInputKeys = set()
+    for resultPath in self.getResultPaths():
+      try:
+        os.remove(resultPath)
+      except OSError:
+        logging.warning("CurveComparisonResultStore: Could not remove " + resultPath)
+
+  def getResultPaths(self):
+    if self.directory is None or not os.path.isdir(self.directory):
+      return []
+    return [os.path.join(self.directory, fileName) for fileName in os.listdir(self.directory)
+      if fileName.endswith(self.RESULT_FILE_EXTENSION)]
+
+  def readInputResults(self, inputKey):
+    resultPath = self.getInputResultPath(inputKey)
+    if resultPath is None or not os.path.exists(resultPath):
+      return {}
+    try:
+      with open(resultPath, "r") as resultFile:
+        store = json.load(resultFile)
+    except (IOError, OSError, ValueError):
+      logging.warning("CurveComparisonResultStore: Could not read " + resultPath)
+      return {}
+    if store.get("version") != self.RESULT_STORE_VERSION:
+      logging.info("CurveComparisonResultStore: Ignoring results from a different version in " + resultPath)
+      return {}
+    try:
+      # Update the modification time so that recently used results are removed last
+      os.utime(resultPath, None)
+    except OSError:
+      pass
+    return store.get("results", {})
+
+  def write(self):
+    """
+    Write the results of the input keys that were modified since they were last written, and remove the least
+    recently used result files if there are more than maximumNumberOfInputs.
+    """
+    if self.directory is None or not self.modifiedInputKeys:
+      return
+    if not os.path.exists(self.directory):
+      os.makedirs(self.directory)
+    for inputKey in sorted(self.modifiedInputKeys):
+      resultPath = self.getInputResultPath(inputKey)
+      # Write to a temporary file first so that the results are not corrupted if the process is terminated
+      temporaryPath = resultPath + ".tmp"
+      with open(temporaryPath, "w") as resultFile:
+        json.dump({"version": self.RESULT_STORE_VERSION, "results": self.results[inputKey]}, resultFile)
+      os.replace(temporaryPath, resultPath)
+    self.modifiedInputKeys = set()
+    self.removeExpiredResults()
+
+  def removeExpiredResults(self):
+    """
+    Remove the least recently used result files until there are at most maximumNumberOfInputs files.
+    """
+    if self.maximumNumberOfInputs is None:
+      return
+    resultPaths = self.getResultPaths()
+    numberOfExpiredPaths = len(resultPaths) - self.maximumNumberOfInputs
+    if numberOfExpiredPaths <= 0:
+      return
+    resultPaths.sort(key=os.path.getmtime)
+    for resultPath in resultPaths[:numberOfExpiredPaths]:
+      try:
+        os.remove(resultPath)
+      except OSError:
+        logging.warning("CurveComparisonResultStore: Could not remove " + resultPath)
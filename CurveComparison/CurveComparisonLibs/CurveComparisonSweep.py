@@ -0,0 +1,318 @@
+import heapq
+import logging
+import multiprocessing
+from concurrent import futures
+from multiprocessing import shared_memory
+import numpy as np
+
+# This module is imported by the sweep worker processes, so it should only depend on numpy and the standard library.
+
+SWEEP_GRAPH_ARRAY_NAMES = [
+  "indptr",
+  "indices",
+  "edgeLength",
+  "edgeCurvature",
+  "edgeSulcalHeight",
+  "edgeDirection",
+  ]
+
+def createSurfaceGraph(points, triangles):
+  """
+  Create the edge graph of a triangle surface in compressed sparse row format.
+  :param points: numpy array (N x 3) of the surface point coordinates
+  :param triangles: numpy array (M x 3) of the point IDs of each triangle
+  :return: Tuple containing the row pointers (N + 1), the destination point of each edge, and the length of each edge
+  """
+  triangles = np.asarray(triangles, dtype=np.int64)
+  edges = np.concatenate([triangles[:, [0, 1]], triangles[:, [1, 2]], triangles[:, [2, 0]]])
+  edges = np.concatenate([edges, edges[:, ::-1]])
+  edges = np.unique(edges, axis=0)
+
+  numberOfPoints = len(points)
+  indptr = np.zeros(numberOfPoints + 1, dtype=np.int64)
+  np.cumsum(np.bincount(edges[:, 0], minlength=numberOfPoints), out=indptr[1:])
+  indices = edges[:, 1].copy()
+  edgeLength = np.linalg.norm(points[edges[:, 1]] - points[edges[:, 0]], axis=1)
+  return indptr, indices, edgeLength
+
+def getNeighbourIds(indptr, indices, pointIds):
+  """
+  Returns the destination points of all of the edges that start at the points (may contain duplicates).
+  """
+  pointIds = np.asarray(pointIds, dtype=np.int64)
+  starts = indptr[pointIds]
+  counts = indptr[pointIds + 1] - starts
+  # Index of each edge within the edges of its point
+  edgeOffsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+  return indices[np.repeat(starts, counts) + edgeOffsets]
+
+def computeRingLabels(indptr, indices, seedPointIds, numberOfRings):
+  """
+  Label each point of the graph with its number of edges from the closest seed point, using a multi-source
+  breadth-first search.
+  :param seedPointIds: IDs of the points in ring 0
+  :param numberOfRings: Number of rings around the seed points that are labelled
+  :return: numpy array containing the ring of each point, or -1 for points that are further than numberOfRings
+  """
+  labels = np.full(len(indptr) - 1, -1, dtype=np.int64)
+  frontier = np.unique(np.asarray(seedPointIds, dtype=np.int64))
+  labels[frontier] = 0
+  for ring in range(1, numberOfRings + 1):
+    if len(frontier) == 0:
+      break
+    neighbourIds = np.unique(getNeighbourIds(indptr, indices, frontier))
+    frontier = neighbourIds[labels[neighbourIds] < 0]
+    labels[frontier] = ring
+  return labels
+
+def normalizeScalars(values):
+  """
+  Rescale the values to the range [0, 1].
+  """
+  values = np.asarray(values, dtype=np.float64)
+  if len(values) == 0:
+    return values
+  valueRange = values.max() - values.min()
+  if valueRange <= 0.0:
+    return np.zeros_like(values)
+  return (values - values.min()) / valueRange
+
+def createSweepGraphArrays(points, triangles, curvature, sulcalHeight, startPointId, endPointId):
+  """
+  Create the read-only arrays used to compute the cost of each edge for any weight vector.
+  The scalar terms are evaluated at the destination point of each edge. The direction term is 0 for edges that point
+  from the start towards the end point and 1 for edges that point the opposite way.
+  """
+  points = np.asarray(points, dtype=np.float64)
+  indptr, indices, edgeLength = createSurfaceGraph(points, triangles)
+
+  sourceIds = np.repeat(np.arange(len(points)), np.diff(indptr))
+  edgeVectors = points[indices] - points[sourceIds]
+  startToEnd = points[endPointId] - points[startPointId]
+  startToEndLength = np.linalg.norm(startToEnd)
+  edgeDirection = np.zeros(len(indices))
+  if startToEndLength > 0.0:
+    with np.errstate(invalid="ignore", divide="ignore"):
+      cosines = np.dot(edgeVectors, startToEnd / startToEndLength) / edgeLength
+    edgeDirection = 0.5 * (1.0 - np.nan_to_num(cosines))
+
+  return {
+    "indptr": indptr,
+    "indices": indices,
+    "edgeLength": edgeLength,
+    "edgeCurvature": normalizeScalars(curvature)[indices],
+    "edgeSulcalHeight": normalizeScalars(sulcalHeight)[indices],
+    "edgeDirection": edgeDirection,
+    }
+
+def getEdgeCosts(graphArrays, weights):
+  """
+  Compute the cost of every edge for the weight vector.
+  This is an approximation of the vtkMRMLMarkupsFreeSurferCurveNode cost function: the curvature and sulcal height are
+  rescaled to [0, 1], the penalty weights and scalar inversion are not used, and the direction term is based on the
+  direction from the start to the end point. Paths can differ from the paths computed by the curve node.
+  :param weights: [d, c, h, dc, dh, ch, dch, p] weights for the distance (d), curvature (c), sulcal height (h) and
+    direction (p) terms, as used by the FreeSurfer curve.
+  """
+  d, c, h, dc, dh, ch, dch, p = [float(weight) for weight in weights]
+  distance = graphArrays["edgeLength"]
+  curvature = graphArrays["edgeCurvature"]
+  sulcalHeight = graphArrays["edgeSulcalHeight"]
+  return (d * distance + c * curvature + h * sulcalHeight
+    + dc * distance * curvature + dh * distance * sulcalHeight + ch * curvature * sulcalHeight
+    + dch * distance * curvature * sulcalHeight + p * graphArrays["edgeDirection"])
+
+def findShortestPath(indptr, indices, edgeCosts, startPointId, endPointId):
+  """
+  Find the lowest cost path between two points of the graph using Dijkstra's algorithm.
+  :return: List of point IDs from the start to the end point, or an empty list if the end point can't be reached
+  """
+  numberOfPoints = len(indptr) - 1
+  costs = np.full(numberOfPoints, np.inf)
+  previousIds = np.full(numberOfPoints, -1, dtype=np.int64)
+  visited = np.zeros(numberOfPoints, dtype=bool)
+
+  indptr = indptr.tolist()
+  indices = indices.tolist()
+  edgeCosts = edgeCosts.tolist()
+  costs[startPointId] = 0.0
+  heap = [(0.0, startPointId)]
+  while heap:
+    cost, pointId = heapq.heappop(heap)
+    if visited[pointId]:
+      continue
+    visited[pointId] = True
+    if pointId == endPointId:
+      break
+    for edgeId in range(indptr[pointId], indptr[pointId + 1]):
+      neighbourId = indices[edgeId]
+      neighbourCost = cost + edgeCosts[edgeId]
+      if neighbourCost < costs[neighbourId]:
+        costs[neighbourId] = neighbourCost
+        previousIds[neighbourId] = pointId
+        heapq.heappush(heap, (neighbourCost, neighbourId))
+
+  if not visited[endPointId]:
+    return []
+  path = [endPointId]
+  while path[-1] != startPointId:
+    path.append(int(previousIds[path[-1]]))
+  path.reverse()
+  return path
+
+class CurveComparisonSharedArrays():
+  """
+  Copies numpy arrays to shared memory, so that they can be read by the worker processes without copying.
+  """
+
+  def __init__(self, arrays):
+    self.sharedMemoryBlocks = []
+    self.descriptor = {} # Key is the array name, value is the shared memory name, shape and data type
+    for name, array in arrays.items():
+      array = np.ascontiguousarray(array)
+      sharedMemory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+      sharedArray = np.ndarray(array.shape, dtype=array.dtype, buffer=sharedMemory.buf)
+      sharedArray[...] = array
+      self.sharedMemoryBlocks.append(sharedMemory)
+      self.descriptor[name] = (sharedMemory.name, array.shape, array.dtype.str)
+
+  def release(self):
+    for sharedMemory in self.sharedMemoryBlocks:
+      sharedMemory.close()
+      sharedMemory.unlink()
+    self.sharedMemoryBlocks = []
+
+def attachSharedArrays(descriptor):
+  """
+  Returns the shared memory blocks and numpy arrays described by CurveComparisonSharedArrays.descriptor.
+  """
+  sharedMemoryBlocks = []
+  arrays = {}
+  for name, (sharedMemoryName, shape, dtype) in descriptor.items():
+    sharedMemory = shared_memory.SharedMemory(name=sharedMemoryName)
+    sharedMemoryBlocks.append(sharedMemory)
+    array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=sharedMemory.buf)
+    array.flags.writeable = False
+    arrays[name] = array
+  return sharedMemoryBlocks, arrays
+
+# State of the worker process, set by attachSweepWorker
+_workerSharedMemoryBlocks = []
+_workerGraphArrays = None
+_workerDescriptor = None
+
+def attachSweepWorker(descriptor):
+  """
+  Attach the worker process to the shared arrays of a sweep. The arrays stay attached until the worker is used for
+  another sweep, so they are only attached once for all of the paths of a sweep.
+  """
+  global _workerSharedMemoryBlocks, _workerGraphArrays, _workerDescriptor
+  if _workerDescriptor == descriptor:
+    return
+  for sharedMemory in _workerSharedMemoryBlocks:
+    sharedMemory.close()
+  _workerSharedMemoryBlocks, _workerGraphArrays = attachSharedArrays(descriptor)
+  _workerDescriptor = descriptor
+
+def computeSweepPath(descriptor, startPointId, endPointId, index, weights):
+  """
+  Compute the path for the weights in a worker process.
+  :return: Tuple containing the index and weights of the task, and the point IDs of the path
+  """
+  attachSweepWorker(descriptor)
+  edgeCosts = getEdgeCosts(_workerGraphArrays, weights)
+  path = findShortestPath(_workerGraphArrays["indptr"], _workerGraphArrays["indices"], edgeCosts,
+    startPointId, endPointId)
+  return index, weights, path
+
+class CurveComparisonSweepPool():
+  """
+  Pool of worker processes for computing sweep paths. The pool can be used for the sweeps of many curves, so that the
+  worker processes are only started once (ex. when comparing a cohort of curves).
+  """
+
+  def __init__(self, numberOfWorkers, pythonExecutable=None):
+    """
+    :param numberOfWorkers: Number of worker processes
+    :param pythonExecutable: Python executable used to start the worker processes. Must be specified when running
+      embedded in an application (ex. PythonSlicer in Slicer), since the default executable is the application itself.
+    """
+    context = multiprocessing.get_context("spawn")
+    if pythonExecutable:
+      context.set_executable(pythonExecutable)
+    self.numberOfWorkers = numberOfWorkers
+    self.executor = futures.ProcessPoolExecutor(max_workers=numberOfWorkers, mp_context=context)
+
+  def shutdown(self):
+    self.executor.shutdown(wait=True)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exceptionType, exceptionValue, traceback):
+    self.shutdown()
+
+class CurveComparisonSweep():
+  """
+  Computes the shortest surface paths between two points for many weight vectors, using a pool of worker processes.
+  The surface graph and the terms of the cost function are stored once in shared memory, and each worker only
+  computes the edge costs for its weights and finds the path.
+  The cost function is an approximation of the FreeSurfer curve cost function (see getEdgeCosts).
+  """
+
+  def __init__(self, points, triangles, curvature, sulcalHeight, startPointId, endPointId):
+    self.startPointId = int(startPointId)
+    self.endPointId = int(endPointId)
+    self.graphArrays = createSweepGraphArrays(points, triangles, curvature, sulcalHeight, self.startPointId, self.endPointId)
+
+  def computePath(self, weights):
+    """
+    Compute the path for the weights in the current process.
+    """
+    edgeCosts = getEdgeCosts(self.graphArrays, weights)
+    return findShortestPath(self.graphArrays["indptr"], self.graphArrays["indices"], edgeCosts,
+      self.startPointId, self.endPointId)
+
+  def run(self, weightsList, numberOfWorkers, resultCallback, pythonExecutable=None, sweepPool=None):
+    """
+    Compute the paths for all of the weight vectors.
+    :param weightsList: List of weight vectors
+    :param numberOfWorkers: Number of worker processes. If less than 2, the paths are computed in the current process.
+    :param resultCallback: Function called with the index, weights and path point IDs of each result, in the order
+      that they are completed. If the function returns False, the remaining tasks are cancelled.
+    :param pythonExecutable: Python executable used to start the worker processes (see CurveComparisonSweepPool)
+    :param sweepPool: Pool of worker processes that is used to compute the paths. If None, a pool is created for this
+      sweep and shut down when the sweep is completed.
+    :return: True if all of the paths were computed, False if the sweep was cancelled
+    """
+    if numberOfWorkers < 2:
+      for index, weights in enumerate(weightsList):
+        if resultCallback(index, weights, self.computePath(weights)) is False:
+          return False
+      return True
+
+    ownedSweepPool = None
+    if sweepPool is None:
+      ownedSweepPool = CurveComparisonSweepPool(numberOfWorkers, pythonExecutable)
+      sweepPool = ownedSweepPool
+
+    sharedArrays = CurveComparisonSharedArrays(self.graphArrays)
+    try:
+      pendingFutures = [sweepPool.executor.submit(computeSweepPath, sharedArrays.descriptor, self.startPointId,
+        self.endPointId, index, weights) for index, weights in enumerate(weightsList)]
+      try:
+        for future in futures.as_completed(pendingFutures):
+          index, weights, path = future.result()
+          if resultCallback(index, weights, path) is False:
+            logging.info("Curve comparison sweep cancelled")
+            return False
+        return True
+      finally:
+        # Tasks that are still pending when the sweep is cancelled or fails are not run
+        for pendingFuture in pendingFutures:
+          pendingFuture.cancel()
+        futures.wait(pendingFutures)
+    finally:
+      if ownedSweepPool:
+        ownedSweepPool.shutdown()
+      sharedArrays.release()
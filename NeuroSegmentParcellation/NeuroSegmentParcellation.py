@@ -372,38 +372,32 @@ class NeuroSegmentParcellationWidget(ScriptedLoadableModuleWidget, VTKObservatio
     if nodeType is None:
       return
 
+    if (nodeName == "ViewI" and nodeType == self.logic.INFLATED_NODE_ATTRIBUTE_VALUE or
+        nodeName == "ViewP" and nodeType == self.logic.PIAL_NODE_ATTRIBUTE_VALUE or
+        nodeName == "ViewO" and nodeType == self.logic.ORIG_NODE_ATTRIBUTE_VALUE):
+      return
+
     origNode = None
-    pialNode = None
-    inflatedNode = None
     if nodeType == self.logic.ORIG_NODE_ATTRIBUTE_VALUE:
       origNode = currentPlaceNode
-      pialNode = self.logic.getDerivedControlPointsNode(origNode, self.logic.PIAL_NODE_ATTRIBUTE_VALUE)
-      inflatedNode = self.logic.getDerivedControlPointsNode(origNode, self.logic.INFLATED_NODE_ATTRIBUTE_VALUE)
-    elif nodeType == self.logic.PIAL_NODE_ATTRIBUTE_VALUE:
-      origNode = currentPlaceNode.GetNodeReference("OrigMarkup")
-      pialNode = currentPlaceNode
-      inflatedNode = self.logic.getDerivedControlPointsNode(origNode, self.logic.INFLATED_NODE_ATTRIBUTE_VALUE)
-    elif nodeType == self.logic.INFLATED_NODE_ATTRIBUTE_VALUE:
+    elif nodeType == self.logic.PIAL_NODE_ATTRIBUTE_VALUE or nodeType == self.logic.INFLATED_NODE_ATTRIBUTE_VALUE:
       origNode = currentPlaceNode.GetNodeReference("OrigMarkup")
-      pialNode = self.logic.getDerivedControlPointsNode(origNode, self.logic.PIAL_NODE_ATTRIBUTE_VALUE)
-      inflatedNode = currentPlaceNode
+    if origNode is None:
+      return
 
-    if (nodeName == "ViewI" and nodeType == self.logic.INFLATED_NODE_ATTRIBUTE_VALUE or
-        nodeName == "ViewP" and nodeType == self.logic.PIAL_NODE_ATTRIBUTE_VALUE or
-        nodeName == "ViewO" and nodeType == self.logic.ORIG_NODE_ATTRIBUTE_VALUE):
+    # Derived markups are only created as nodes once they are needed for placing points on the pial or inflated surface
+    placeNode = origNode
+    if nodeName == "ViewI":
+      placeNode = self.logic.materializeDerivedMarkups(origNode, self.logic.INFLATED_NODE_ATTRIBUTE_VALUE)
+    elif nodeName == "ViewP":
+      placeNode = self.logic.materializeDerivedMarkups(origNode, self.logic.PIAL_NODE_ATTRIBUTE_VALUE)
+    if placeNode is None:
       return
 
     interactionNode.SetCurrentInteractionMode(interactionNode.Select)
     interactionNode.SetPlaceModePersistence(True)
-    if nodeName == "ViewI":
-      selectionNode.SetActivePlaceNodeID(inflatedNode.GetID())
-      selectionNode.SetActivePlaceNodeClassName(inflatedNode.GetClassName())
-    elif nodeName == "ViewP":
-      selectionNode.SetActivePlaceNodeID(pialNode.GetID())
-      selectionNode.SetActivePlaceNodeClassName(pialNode.GetClassName())
-    else:
-      selectionNode.SetActivePlaceNodeID(origNode.GetID())
-      selectionNode.SetActivePlaceNodeClassName(origNode.GetClassName())
+    selectionNode.SetActivePlaceNodeID(placeNode.GetID())
+    selectionNode.SetActivePlaceNodeClassName(placeNode.GetClassName())
     interactionNode.SetCurrentInteractionMode(interactionNode.Place)
 
   def cleanup(self):
@@ -781,9 +775,7 @@ class NeuroSegmentParcellationWidget(ScriptedLoadableModuleWidget, VTKObservatio
     self.ui.importOverlayComboBox.clear()
     origModelNode = self.logic.getOrigModelNode(self.parameterNode)
     if origModelNode:
-      overlays = self.logic.getPointScalarOverlays(origModelNode)
-      for overlay in overlays:
-        overlayName = overlay.GetName()
+      for overlayName in self.logic.getPointScalarOverlayNames(origModelNode):
         self.ui.importOverlayComboBox.addItem(overlayName)
     currentOverlayIndex = self.ui.importOverlayComboBox.findText(currentOverlayText)
     self.ui.importOverlayComboBox.currentIndex = currentOverlayIndex
@@ -948,6 +940,9 @@ class NeuroSegmentParcellationTest(ScriptedLoadableModuleTest):
     self.setUp()
 
     self.meshParseTool1()
+    self.test_QueryValidation()
+    self.test_BatchManifest()
+    self.test_BatchCheckpoint()
 
   def setupSphere(self, radius):
 
@@ -1032,3 +1027,140 @@ class NeuroSegmentParcellationTest(ScriptedLoadableModuleTest):
 
     testDuration = time.time() - startTime
     logging.info("Test duration: %f", testDuration)
+
+  def test_QueryValidation(self):
+    """
+    Invalid statements should be reported as errors on their line instead of raising exceptions.
+    """
+    from NeuroSegmentParcellationLibs.NeuroSegmentParcellationVisitor import NeuroSegmentParcellationVisitor
+    logic = NeuroSegmentParcellationLogic()
+
+    def getErrorLines(queryString):
+      issues = NeuroSegmentParcellationVisitor(logic).validateQuery(queryString)
+      return [issue["lineno"] for issue in issues if issue["severity"] == "error"]
+
+    self.assertEqual(getErrorLines("_Curves = [A]\nB = A\nB.color = [1.0, 0.0, 0.0]"), [])
+    self.assertEqual(getErrorLines("_InvertScalars = True\n_Curves = [A]\nB = A"), [])
+
+    invalidStatements = [
+      "A.color = [1, 2]",
+      "A.color = []",
+      "a.b.color = [1, 0, 0]",
+      "_InvertScalars = x",
+      "_DistanceWeightingValues = foo",
+      "_DistanceWeightingValues = [1, 2]",
+      "_DistanceWeightingPenalties = foo",
+      "B = A | unknown_of(A)",
+    ]
+    for invalidStatement in invalidStatements:
+      queryString = "_Curves = [A]\n%s\nB = A" % invalidStatement
+      self.assertEqual(getErrorLines(queryString), [2], invalidStatement)
+
+    self.assertEqual(getErrorLines("_Curves = [A]\nB = A | C"), [2])
+    self.assertEqual(getErrorLines("_Curves = [A]\nB = A |"), [2])
+
+  def test_BatchManifest(self):
+    """
+    Read a batch manifest, and check that relative paths, the default query and the default overlays are resolved.
+    """
+    import json
+    import shutil
+    import tempfile
+    logic = NeuroSegmentParcellationLogic()
+
+    manifestDirectory = tempfile.mkdtemp()
+    try:
+      surfaceDirectory = os.path.join(manifestDirectory, "subject01", "surf")
+      os.makedirs(surfaceDirectory)
+      for fileName in ["lh.orig", "lh.pial", "lh.inflated", "lh.curv"]:
+        open(os.path.join(surfaceDirectory, fileName), "w").close()
+
+      manifest = {
+        "query": "parcellation.qry",
+        "subjects": [
+          {
+            "name": "subject01",
+            "orig": "subject01/surf/lh.orig",
+            "pial": "subject01/surf/lh.pial",
+            "inflated": "subject01/surf/lh.inflated",
+            "markups": ["subject01/markups/CentralSulcus.mrk.json"],
+          },
+          {
+            "name": "subject02",
+            "orig": "subject02/surf/lh.orig",
+            "overlays": ["subject02/surf/lh.thickness"],
+            "query": "subject02/parcellation.qry",
+            "cache": "subject02/surfaces.npz",
+          },
+        ]
+      }
+      manifestPath = os.path.join(manifestDirectory, "manifest.json")
+      with open(manifestPath, "w") as manifestFile:
+        json.dump(manifest, manifestFile)
+
+      subjects = logic.loadBatchManifest(manifestPath)
+      self.assertEqual([subject["name"] for subject in subjects], ["subject01", "subject02"])
+      self.assertEqual(subjects[0]["query"], os.path.join(manifestDirectory, "parcellation.qry"))
+      self.assertEqual(subjects[0]["pial"], os.path.join(surfaceDirectory, "lh.pial"))
+      self.assertEqual(subjects[0]["markups"], [os.path.join(manifestDirectory, "subject01", "markups", "CentralSulcus.mrk.json")])
+      # Only the default overlays that exist next to the orig surface are used
+      self.assertEqual(subjects[0]["overlays"], [os.path.join(surfaceDirectory, "lh.curv")])
+      self.assertIsNone(subjects[0]["cache"])
+
+      self.assertEqual(subjects[1]["query"], os.path.join(manifestDirectory, "subject02", "parcellation.qry"))
+      self.assertEqual(subjects[1]["overlays"], [os.path.join(manifestDirectory, "subject02", "surf", "lh.thickness")])
+      self.assertEqual(subjects[1]["cache"], os.path.join(manifestDirectory, "subject02", "surfaces.npz"))
+      self.assertIsNone(subjects[1]["pial"])
+      self.assertEqual(subjects[1]["markups"], [])
+
+      with open(manifestPath, "w") as manifestFile:
+        json.dump({"subjects": [{"orig": "lh.orig"}]}, manifestFile)
+      with self.assertRaises(ValueError):
+        logic.loadBatchManifest(manifestPath)
+    finally:
+      shutil.rmtree(manifestDirectory, ignore_errors=True)
+
+  def test_BatchCheckpoint(self):
+    """
+    Write and read a batch checkpoint, and check that stages are only complete if their inputs and outputs are unchanged.
+    """
+    import shutil
+    import tempfile
+    logic = NeuroSegmentParcellationLogic()
+
+    subjectOutputDirectory = tempfile.mkdtemp()
+    try:
+      inputPath = os.path.join(subjectOutputDirectory, "lh.orig")
+      with open(inputPath, "w") as inputFile:
+        inputFile.write("surface")
+      inputHash = logic.getBatchFileHash([inputPath, None])
+      self.assertEqual(inputHash, logic.getBatchFileHash([inputPath, None]))
+      self.assertNotEqual(inputHash, logic.getBatchFileHash([None, inputPath]))
+
+      self.assertEqual(logic.readBatchCheckpoint(subjectOutputDirectory), {"stages": {}})
+
+      stageKey = logic.getBatchStageKey(inputHash, "labels")
+      self.assertNotEqual(stageKey, logic.getBatchStageKey(inputHash, "cuts"))
+      outputPath = "labels.tsv"
+      open(os.path.join(subjectOutputDirectory, outputPath), "w").close()
+      logic.writeBatchCheckpoint(subjectOutputDirectory, {"stages": {"labels": {"key": stageKey, "outputs": [outputPath]}}})
+
+      checkpoint = logic.readBatchCheckpoint(subjectOutputDirectory)
+      self.assertTrue(logic.isBatchStageComplete(checkpoint, "labels", stageKey, subjectOutputDirectory))
+      self.assertFalse(logic.isBatchStageComplete(checkpoint, "cuts", stageKey, subjectOutputDirectory))
+
+      # The stage must be run again if the inputs change
+      with open(inputPath, "w") as inputFile:
+        inputFile.write("modified surface")
+      modifiedStageKey = logic.getBatchStageKey(logic.getBatchFileHash([inputPath, None]), "labels")
+      self.assertFalse(logic.isBatchStageComplete(checkpoint, "labels", modifiedStageKey, subjectOutputDirectory))
+
+      # The stage must be run again if an output was removed
+      os.remove(os.path.join(subjectOutputDirectory, outputPath))
+      self.assertFalse(logic.isBatchStageComplete(checkpoint, "labels", stageKey, subjectOutputDirectory))
+
+      with open(os.path.join(subjectOutputDirectory, logic.BATCH_CHECKPOINT_FILE_NAME), "w") as checkpointFile:
+        checkpointFile.write("{")
+      self.assertEqual(logic.readBatchCheckpoint(subjectOutputDirectory), {"stages": {}})
+    finally:
+      shutil.rmtree(subjectOutputDirectory, ignore_errors=True)
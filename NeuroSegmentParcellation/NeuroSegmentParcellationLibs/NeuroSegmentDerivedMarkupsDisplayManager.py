@@ -0,0 +1,273 @@
+import vtk, qt, slicer
+import logging
+from slicer.util import VTKObservationMixin
+import numpy as np
+from vtk.util import numpy_support
+
+class NeuroSegmentDerivedMarkupsPipeline():
+  """
+  Actor that displays the derived geometry of one surface type (ex. pial) in a single 3D view.
+  The polydata is shared by all of the views that display the same surface type.
+  """
+
+  def __init__(self, viewNodeID, polyData):
+    self.viewNodeID = viewNodeID
+
+    self.mapper = vtk.vtkPolyDataMapper()
+    self.mapper.SetInputData(polyData)
+    self.mapper.SetScalarModeToUseCellData()
+    self.mapper.SetColorModeToDirectScalars()
+
+    self.property = vtk.vtkProperty()
+    self.property.SetLineWidth(3.0)
+    self.property.SetPointSize(8.0)
+    self.property.SetRenderPointsAsSpheres(True)
+    self.property.SetRenderLinesAsTubes(True)
+
+    self.actor = vtk.vtkActor()
+    self.actor.SetMapper(self.mapper)
+    self.actor.SetProperty(self.property)
+    self.actor.PickableOff()
+
+  def addActor(self):
+    renderer = self.getRenderer()
+    if renderer is None:
+      return
+    renderer.AddActor(self.actor)
+
+  def removeActor(self):
+    renderer = self.getRenderer()
+    if renderer is None:
+      return
+    renderer.RemoveActor(self.actor)
+
+  def getThreeDView(self):
+    layoutManager = slicer.app.layoutManager()
+    if layoutManager is None:
+      return None
+    for i in range(layoutManager.threeDViewCount):
+      threeDWidget = layoutManager.threeDWidget(i)
+      if threeDWidget.mrmlViewNode().GetID() == self.viewNodeID:
+        return threeDWidget.threeDView()
+    return None
+
+  def getRenderer(self):
+    threeDView = self.getThreeDView()
+    if threeDView is None:
+      return None
+    return threeDView.renderWindow().GetRenderers().GetFirstRenderer()
+
+  def scheduleRender(self):
+    threeDView = self.getThreeDView()
+    if threeDView:
+      threeDView.scheduleRender()
+
+class NeuroSegmentDerivedMarkupsDisplayManager(VTKObservationMixin):
+  """
+  Displays the pial and inflated versions of the input curves without creating derived markups nodes.
+  The positions of the derived curves and control points are provided by the points function, which maps the orig
+  curve to the other surfaces. All of the curves of a surface type are combined into a single polydata, and are
+  displayed with one actor per 3D view.
+  """
+
+  def __init__(self):
+    VTKObservationMixin.__init__(self)
+
+    # Function that returns the derived curve and control points (numpy arrays in world coordinates) for a curve node
+    # and surface type, or None if the curve should not be displayed for that surface type
+    self.pointsFunction = None
+    self.curveNodes = []
+    self.nodeTypeViewIDs = {} # Key is surface type, value is list of view node IDs
+    self.controlPointVisibility = True
+
+    self.nodeTypePolyData = {} # Key is surface type, value is the polydata containing the geometry of all curves
+    self.viewPipelines = {} # Key is (view node ID, surface type), value is pipeline
+    self.curvePointsCache = {} # Key is (curve node ID, surface type), value is (curve MTime, curve and control points)
+    self.updatePending = False
+
+    layoutManager = slicer.app.layoutManager()
+    if layoutManager:
+      # There is no layout manager when running without the main window (ex. batch processing)
+      layoutManager.connect('layoutChanged(int)', self.updatePipelines)
+
+  def setPointsFunction(self, pointsFunction):
+    self.pointsFunction = pointsFunction
+    self.invalidate()
+
+  def setCurveNodes(self, curveNodes):
+    """
+    Set the curves that are displayed on the derived surfaces.
+    """
+    curveNodes = [curveNode for curveNode in curveNodes if curveNode and curveNode.IsA("vtkMRMLMarkupsCurveNode")]
+    if [curveNode.GetID() for curveNode in curveNodes] == [curveNode.GetID() for curveNode in self.curveNodes]:
+      return
+
+    for curveNode in self.curveNodes:
+      self.removeObserver(curveNode, vtk.vtkCommand.ModifiedEvent, self.onCurveNodeModified)
+      self.removeObserver(curveNode, slicer.vtkMRMLMarkupsNode.PointModifiedEvent, self.onCurveNodeModified)
+      self.removeObserver(curveNode, slicer.vtkMRMLDisplayableNode.DisplayModifiedEvent, self.onCurveNodeModified)
+    self.curveNodes = curveNodes
+    for curveNode in self.curveNodes:
+      self.addObserver(curveNode, vtk.vtkCommand.ModifiedEvent, self.onCurveNodeModified)
+      self.addObserver(curveNode, slicer.vtkMRMLMarkupsNode.PointModifiedEvent, self.onCurveNodeModified)
+      self.addObserver(curveNode, slicer.vtkMRMLDisplayableNode.DisplayModifiedEvent, self.onCurveNodeModified)
+    self.invalidate()
+
+  def setNodeTypeViewIDs(self, nodeType, viewIDs):
+    """
+    Set the views in which the curves are displayed on the specified surface type.
+    """
+    viewIDs = list(viewIDs)
+    if self.nodeTypeViewIDs.get(nodeType) == viewIDs:
+      return
+    self.nodeTypeViewIDs[nodeType] = viewIDs
+    self.updatePipelines()
+
+  def setControlPointVisibility(self, visible):
+    if self.controlPointVisibility == visible:
+      return
+    self.controlPointVisibility = visible
+    self.scheduleUpdate()
+
+  def invalidate(self):
+    """
+    Discard the cached curve positions. Should be called when the surfaces used to map the curves are changed.
+    """
+    self.curvePointsCache = {}
+    self.scheduleUpdate()
+
+  def onCurveNodeModified(self, curveNode, event=None):
+    self.scheduleUpdate()
+
+  def scheduleUpdate(self):
+    """
+    Update the geometry once control returns to the event loop, so that many curve modifications are only processed once.
+    """
+    if self.updatePending:
+      return
+    self.updatePending = True
+    qt.QTimer.singleShot(0, self.updateGeometry)
+
+  def updatePipelines(self):
+    """
+    Create or remove the pipelines to match the 3D views in the current layout.
+    """
+    viewNodeIDs = set()
+    layoutManager = slicer.app.layoutManager()
+    if layoutManager:
+      for i in range(layoutManager.threeDViewCount):
+        viewNodeIDs.add(layoutManager.threeDWidget(i).mrmlViewNode().GetID())
+
+    requiredKeys = set()
+    for nodeType, nodeTypeViewIDs in self.nodeTypeViewIDs.items():
+      for viewNodeID in nodeTypeViewIDs:
+        if viewNodeID in viewNodeIDs:
+          requiredKeys.add((viewNodeID, nodeType))
+
+    for key in set(self.viewPipelines.keys()) - requiredKeys:
+      pipeline = self.viewPipelines.pop(key)
+      pipeline.removeActor()
+      pipeline.scheduleRender()
+
+    for key in requiredKeys - set(self.viewPipelines.keys()):
+      viewNodeID, nodeType = key
+      if not nodeType in self.nodeTypePolyData:
+        self.nodeTypePolyData[nodeType] = vtk.vtkPolyData()
+      pipeline = NeuroSegmentDerivedMarkupsPipeline(viewNodeID, self.nodeTypePolyData[nodeType])
+      pipeline.addActor()
+      self.viewPipelines[key] = pipeline
+
+    self.scheduleUpdate()
+
+  def getCurvePoints(self, curveNode, nodeType):
+    """
+    Returns the derived curve and control points for the curve, computing them only if the curve was modified.
+    """
+    curvePoints_World = curveNode.GetCurvePointsWorld()
+    curveMTime = (curveNode.GetMTime(), curvePoints_World.GetMTime() if curvePoints_World else 0)
+    key = (curveNode.GetID(), nodeType)
+    cachedMTime, cachedPoints = self.curvePointsCache.get(key, (None, None))
+    if cachedMTime == curveMTime:
+      return cachedPoints
+
+    points = None
+    if self.pointsFunction is not None:
+      points = self.pointsFunction(curveNode, nodeType)
+    self.curvePointsCache[key] = (curveMTime, points)
+    return points
+
+  def updateGeometry(self):
+    """
+    Update the combined polydata of each surface type from the derived positions of the curves.
+    """
+    self.updatePending = False
+    nodeTypes = set([nodeType for (viewNodeID, nodeType) in self.viewPipelines.keys()])
+    for nodeType in nodeTypes:
+      self.updateNodeTypeGeometry(nodeType)
+    for pipeline in self.viewPipelines.values():
+      pipeline.scheduleRender()
+
+  def updateNodeTypeGeometry(self, nodeType):
+    pointArrays = []
+    lineOffsets = [0]
+    lineConnectivity = []
+    lineColors = []
+    vertexIds = []
+    vertexColors = []
+    numberOfPoints = 0
+    for curveNode in self.curveNodes:
+      if not curveNode.GetDisplayVisibility() or curveNode.GetDisplayNode() is None:
+        continue
+      points = self.getCurvePoints(curveNode, nodeType)
+      if points is None:
+        continue
+      curvePoints, controlPoints = points
+      color = np.array(curveNode.GetDisplayNode().GetSelectedColor()) * 255
+
+      if len(curvePoints) > 1:
+        curvePointIds = np.arange(numberOfPoints, numberOfPoints + len(curvePoints))
+        if curveNode.GetCurveClosed():
+          curvePointIds = np.append(curvePointIds, numberOfPoints)
+        lineConnectivity.append(curvePointIds)
+        lineOffsets.append(lineOffsets[-1] + len(curvePointIds))
+        lineColors.append(color)
+        pointArrays.append(curvePoints)
+        numberOfPoints += len(curvePoints)
+
+      if self.controlPointVisibility and len(controlPoints) > 0:
+        vertexIds.append(np.arange(numberOfPoints, numberOfPoints + len(controlPoints)))
+        vertexColors.append(np.tile(color, (len(controlPoints), 1)))
+        pointArrays.append(controlPoints)
+        numberOfPoints += len(controlPoints)
+
+    polyData = self.nodeTypePolyData[nodeType]
+    polyData.Initialize()
+    if numberOfPoints == 0:
+      polyData.Modified()
+      return
+
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(np.concatenate(pointArrays).astype(np.float32), deep=True))
+    polyData.SetPoints(points)
+
+    verts = vtk.vtkCellArray()
+    if len(vertexIds) > 0:
+      vertexConnectivity = np.concatenate(vertexIds).astype(numpy_support.ID_TYPE_CODE)
+      vertexOffsets = np.arange(len(vertexConnectivity) + 1, dtype=numpy_support.ID_TYPE_CODE)
+      verts.SetData(numpy_support.numpy_to_vtkIdTypeArray(vertexOffsets, deep=True),
+        numpy_support.numpy_to_vtkIdTypeArray(vertexConnectivity, deep=True))
+    polyData.SetVerts(verts)
+
+    lines = vtk.vtkCellArray()
+    if len(lineConnectivity) > 0:
+      lines.SetData(numpy_support.numpy_to_vtkIdTypeArray(np.array(lineOffsets, dtype=numpy_support.ID_TYPE_CODE), deep=True),
+        numpy_support.numpy_to_vtkIdTypeArray(np.concatenate(lineConnectivity).astype(numpy_support.ID_TYPE_CODE), deep=True))
+    polyData.SetLines(lines)
+
+    # Cell data is ordered with the vertices before the lines
+    colors = np.concatenate(vertexColors + [np.array(lineColors).reshape(-1, 3)]).astype(np.uint8)
+    colorArray = numpy_support.numpy_to_vtk(colors, deep=True, array_type=vtk.VTK_UNSIGNED_CHAR)
+    colorArray.SetName("Colors")
+    polyData.GetCellData().SetScalars(colorArray)
+    polyData.Modified()
+
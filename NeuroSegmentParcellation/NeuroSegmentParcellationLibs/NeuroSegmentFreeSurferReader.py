@@ -0,0 +1,292 @@
+import os
+import collections
+import logging
+import numpy as np
+import vtk, slicer
+from vtk.util import numpy_support
+
+FREESURFER_TRIANGLE_FILE_MAGIC = 0xFFFFFE
+FREESURFER_NEW_CURV_FILE_MAGIC = 0xFFFFFF
+
+def readFreeSurferSurfaceBlocks(path):
+  """
+  Memory-map the vertex and face blocks of a FreeSurfer triangle surface file (ex. lh.orig, lh.pial, lh.inflated).
+  Coordinates are returned as stored in the file (surface RAS), as with the FreeSurfer surface reader.
+  :param path: Path to the surface file
+  :return: Tuple containing the vertices (N x 3 big-endian float32) and faces (M x 3 big-endian int32) memory maps
+  """
+  with open(path, "rb") as surfaceFile:
+    magic = int.from_bytes(surfaceFile.read(3), "big")
+    if magic != FREESURFER_TRIANGLE_FILE_MAGIC:
+      raise ValueError("Not a FreeSurfer triangle surface file: " + path)
+    # The "created by" line is followed by an empty line
+    surfaceFile.readline()
+    surfaceFile.readline()
+    numberOfVertices, numberOfFaces = np.frombuffer(surfaceFile.read(8), dtype=">i4")
+    vertexOffset = surfaceFile.tell()
+
+  vertices = np.memmap(path, dtype=">f4", mode="r", offset=vertexOffset, shape=(numberOfVertices, 3))
+  faceOffset = vertexOffset + vertices.nbytes
+  faces = np.memmap(path, dtype=">i4", mode="r", offset=faceOffset, shape=(numberOfFaces, 3))
+  return vertices, faces
+
+def readFreeSurferCurvBlock(path):
+  """
+  Memory-map the values of a FreeSurfer overlay in the "new" curv format (ex. lh.curv, lh.sulc, lh.thickness).
+  :param path: Path to the overlay file
+  :return: Big-endian float32 memory map containing one value per vertex
+  """
+  with open(path, "rb") as curvFile:
+    magic = int.from_bytes(curvFile.read(3), "big")
+    if magic != FREESURFER_NEW_CURV_FILE_MAGIC:
+      raise ValueError("Not a FreeSurfer curv file: " + path)
+    numberOfVertices, numberOfFaces, valuesPerVertex = np.frombuffer(curvFile.read(12), dtype=">i4")
+    valueOffset = curvFile.tell()
+  if valuesPerVertex != 1:
+    raise ValueError("Only one value per vertex is supported: " + path)
+  return np.memmap(path, dtype=">f4", mode="r", offset=valueOffset, shape=(numberOfVertices,))
+
+def createFreeSurferSurfacePolyData(path):
+  """
+  Create a polydata from a FreeSurfer surface file.
+  The vertex and face blocks are memory-mapped and converted to native byte order once. The VTK point and cell arrays
+  reference the converted numpy arrays rather than copying them again.
+  """
+  vertices, faces = readFreeSurferSurfaceBlocks(path)
+
+  points = vtk.vtkPoints()
+  points.SetData(numpy_support.numpy_to_vtk(vertices.astype(np.float32), deep=False))
+
+  offsets = np.arange(0, faces.size + 1, 3, dtype=numpy_support.ID_TYPE_CODE)
+  connectivity = faces.astype(numpy_support.ID_TYPE_CODE).ravel()
+  polys = vtk.vtkCellArray()
+  polys.SetData(numpy_support.numpy_to_vtkIdTypeArray(offsets, deep=False),
+    numpy_support.numpy_to_vtkIdTypeArray(connectivity, deep=False))
+
+  polyData = vtk.vtkPolyData()
+  polyData.SetPoints(points)
+  polyData.SetPolys(polys)
+  return polyData
+
+def isFreeSurferCurvFile(path):
+  """
+  Returns True if the file is a FreeSurfer overlay in the "new" curv format.
+  """
+  try:
+    with open(path, "rb") as curvFile:
+      return int.from_bytes(curvFile.read(3), "big") == FREESURFER_NEW_CURV_FILE_MAGIC
+  except (IOError, OSError):
+    return False
+
+def findFreeSurferOverlayPaths(surfacePath):
+  """
+  Returns the paths of the overlay files of the same hemisphere next to the surface file (ex. lh.orig -> lh.curv,
+  lh.sulc, lh.thickness, ...). Only the first bytes of the files are read.
+  """
+  if not surfacePath:
+    return []
+  surfaceDirectory = os.path.dirname(surfacePath)
+  hemisphere = os.path.basename(surfacePath).split(".")[0]
+  try:
+    fileNames = sorted(os.listdir(surfaceDirectory))
+  except OSError:
+    return []
+  overlayPaths = []
+  for fileName in fileNames:
+    if not fileName.startswith(hemisphere + "."):
+      continue
+    overlayPath = os.path.join(surfaceDirectory, fileName)
+    if os.path.isfile(overlayPath) and isFreeSurferCurvFile(overlayPath):
+      overlayPaths.append(overlayPath)
+  return overlayPaths
+
+def getFreeSurferOverlayName(path):
+  """
+  Returns the overlay name from the file name (ex. "lh.curv" -> "curv").
+  """
+  fileName = os.path.basename(path)
+  if "." in fileName:
+    return fileName.split(".", 1)[1]
+  return fileName
+
+class NeuroSegmentOverlayCache():
+  """
+  Lazily loads FreeSurfer point overlays (curv, sulc, thickness, ...) into the point data of the surfaces.
+  Overlay files are only memory-mapped when they are registered, and are converted into VTK arrays when they are
+  first requested. The same array is shared by all of the surfaces of a hemisphere.
+  When the total size of the loaded overlays exceeds the memory budget, the least recently used overlays that are not
+  pinned are removed from the surfaces. They are loaded again the next time they are requested.
+  """
+
+  def __init__(self, memoryBudget=256 * 1024 * 1024):
+    self.memoryBudget = memoryBudget # Maximum size of the loaded overlays in bytes
+    self.pinnedOverlayNames = set()
+    # Key is a tuple of the model node IDs and overlay name, value is a dictionary containing the path and loaded array
+    # Entries are ordered from least to most recently used
+    self.overlays = collections.OrderedDict()
+
+  def setMemoryBudget(self, memoryBudget):
+    self.memoryBudget = memoryBudget
+    self.evictOverlays()
+
+  def setOverlayPinned(self, overlayName, pinned):
+    """
+    Pinned overlays are never evicted once they are loaded.
+    """
+    if pinned:
+      self.pinnedOverlayNames.add(overlayName)
+    else:
+      self.pinnedOverlayNames.discard(overlayName)
+
+  def registerOverlay(self, modelNodes, path, overlayName=None):
+    """
+    Register an overlay file for the surfaces of a hemisphere. The overlay is not loaded until it is requested.
+    If the overlay is already in the point data of one of the surfaces (ex. loaded by the FreeSurfer importer), the
+    array is shared by all of the surfaces and is managed by the cache, so it counts towards the memory budget.
+    :param modelNodes: Model nodes of the hemisphere surfaces (orig, pial, inflated) that share the same vertices
+    :param path: Path to the overlay file
+    :param overlayName: Name of the overlay. By default, the name is taken from the file name.
+    """
+    if overlayName is None:
+      overlayName = getFreeSurferOverlayName(path)
+    modelNodes = [modelNode for modelNode in modelNodes if modelNode]
+    modelNodeIDs = tuple([modelNode.GetID() for modelNode in modelNodes])
+
+    loadedArray = None
+    for key in list(self.overlays.keys()):
+      keyModelNodeIDs, keyOverlayName = key
+      if keyOverlayName != overlayName or not set(keyModelNodeIDs).intersection(modelNodeIDs):
+        continue
+      # The previous registration of the surfaces is replaced, but its loaded array is kept
+      overlayArray = self.overlays[key]["array"]
+      if overlayArray is not None:
+        removedModelNodeIDs = [modelNodeID for modelNodeID in keyModelNodeIDs if not modelNodeID in modelNodeIDs]
+        self.removeOverlayArray(removedModelNodeIDs, overlayName, overlayArray)
+        loadedArray = overlayArray
+      del self.overlays[key]
+
+    if loadedArray is None:
+      for modelNode in modelNodes:
+        polyData = modelNode.GetPolyData()
+        if polyData is not None and polyData.GetPointData().GetArray(overlayName) is not None:
+          loadedArray = polyData.GetPointData().GetArray(overlayName)
+          break
+
+    key = (modelNodeIDs, overlayName)
+    self.overlays[key] = {
+      "path": path,
+      "array": None,
+      }
+    if loadedArray is not None:
+      self.addOverlayArray(key, loadedArray)
+      self.evictOverlays(keepKey=key)
+
+  def removeOverlay(self, modelNodeIDs, overlayName):
+    key = (modelNodeIDs, overlayName)
+    if not key in self.overlays:
+      return
+    self.unloadOverlay(key)
+    del self.overlays[key]
+
+  def getOverlayNames(self, modelNode):
+    """
+    Returns the names of the overlays that are registered for the model node, including overlays that are not loaded.
+    """
+    if modelNode is None:
+      return []
+    return [overlayName for (modelNodeIDs, overlayName) in self.overlays.keys() if modelNode.GetID() in modelNodeIDs]
+
+  def requestOverlay(self, modelNode, overlayName):
+    """
+    Ensure that the overlay is loaded in the point data of the model node.
+    :return: True if the overlay is available in the point data, otherwise false
+    """
+    if modelNode is None:
+      return False
+
+    for key in list(self.overlays.keys()):
+      modelNodeIDs, keyOverlayName = key
+      if keyOverlayName != overlayName or not modelNode.GetID() in modelNodeIDs:
+        continue
+      self.overlays.move_to_end(key)
+      if self.overlays[key]["array"] is None and not self.loadOverlay(key):
+        return False
+      self.evictOverlays(keepKey=key)
+      return True
+
+    # Not a registered overlay, check if the array was loaded in another way
+    polyData = modelNode.GetPolyData()
+    return polyData is not None and polyData.GetPointData().GetArray(overlayName) is not None
+
+  def loadOverlay(self, key):
+    modelNodeIDs, overlayName = key
+    overlay = self.overlays[key]
+    try:
+      values = readFreeSurferCurvBlock(overlay["path"])
+    except (IOError, OSError, ValueError) as e:
+      logging.error("loadOverlay: Could not read %s: %s" % (overlay["path"], str(e)))
+      return False
+
+    # astype creates a native byte order copy, which is referenced by the VTK array rather than copied again
+    overlayArray = numpy_support.numpy_to_vtk(values.astype(np.float32), deep=False)
+    overlayArray.SetName(overlayName)
+    self.addOverlayArray(key, overlayArray)
+    return True
+
+  def addOverlayArray(self, key, overlayArray):
+    """
+    Add the overlay array to the point data of all of the surfaces of the overlay.
+    """
+    modelNodeIDs, overlayName = key
+    for modelNodeID in modelNodeIDs:
+      modelNode = slicer.mrmlScene.GetNodeByID(modelNodeID)
+      if modelNode is None or modelNode.GetPolyData() is None:
+        continue
+      polyData = modelNode.GetPolyData()
+      if polyData.GetNumberOfPoints() != overlayArray.GetNumberOfTuples():
+        logging.error("addOverlayArray: %s does not match the number of points in %s" % (overlayName, modelNode.GetName()))
+        continue
+      polyData.GetPointData().AddArray(overlayArray)
+      polyData.GetPointData().Modified()
+    self.overlays[key]["array"] = overlayArray
+
+  def unloadOverlay(self, key):
+    modelNodeIDs, overlayName = key
+    overlay = self.overlays[key]
+    overlayArray = overlay["array"]
+    if overlayArray is None:
+      return
+    self.removeOverlayArray(modelNodeIDs, overlayName, overlayArray)
+    overlay["array"] = None
+
+  def removeOverlayArray(self, modelNodeIDs, overlayName, overlayArray):
+    for modelNodeID in modelNodeIDs:
+      modelNode = slicer.mrmlScene.GetNodeByID(modelNodeID)
+      if modelNode is None or modelNode.GetPolyData() is None:
+        continue
+      pointData = modelNode.GetPolyData().GetPointData()
+      # Only remove the array if it hasn't been replaced
+      if pointData.GetArray(overlayName) is overlayArray:
+        pointData.RemoveArray(overlayName)
+        pointData.Modified()
+
+  def getLoadedSize(self):
+    loadedSize = 0
+    for overlay in self.overlays.values():
+      if overlay["array"] is not None:
+        loadedSize += overlay["array"].GetNumberOfValues() * overlay["array"].GetDataTypeSize()
+    return loadedSize
+
+  def evictOverlays(self, keepKey=None):
+    """
+    Unload the least recently used overlays until the loaded overlays fit in the memory budget.
+    """
+    loadedSize = self.getLoadedSize()
+    for key, overlay in list(self.overlays.items()):
+      if loadedSize <= self.memoryBudget:
+        break
+      if key == keepKey or overlay["array"] is None or key[1] in self.pinnedOverlayNames:
+        continue
+      loadedSize -= overlay["array"].GetNumberOfValues() * overlay["array"].GetDataTypeSize()
+      logging.debug("Evicting overlay " + key[1])
+      self.unloadOverlay(key)
@@ -2,8 +2,47 @@ import vtk, qt, ctk, slicer
 import logging
 from slicer.util import VTKObservationMixin
 import numpy as np
+from vtk.util import numpy_support
 import json
 
+def getPolylinePlaneIntersections_XY(polylines_RAS, planeOrigin_RAS, planeNormal_RAS, rasToXYMatrix):
+  """
+  Intersect all of the segments of many polylines with a plane at once.
+  A segment intersects the plane if the signed distance of its end points to the plane changes sign, and the
+  intersection point is linearly interpolated between the end points.
+  :param polylines_RAS: List of numpy arrays (N x 3) containing the points of each polyline in RAS coordinates
+  :param planeOrigin_RAS: Origin of the plane in RAS coordinates
+  :param planeNormal_RAS: Normal of the plane in RAS coordinates
+  :param rasToXYMatrix: numpy array (4 x 4) of the RAS to XY transform of the slice view
+  :return: List containing a numpy array (K x 3) of the intersection points in XY coordinates for each polyline
+  """
+  numberOfPolylines = len(polylines_RAS)
+  if numberOfPolylines == 0:
+    return []
+
+  points_RAS = np.concatenate([np.asarray(polyline, dtype=np.float64).reshape(-1, 3) for polyline in polylines_RAS])
+  numberOfPoints = np.array([len(polyline) for polyline in polylines_RAS])
+  polylineIds = np.repeat(np.arange(numberOfPolylines), numberOfPoints)
+
+  # Segments between the last point of one polyline and the first point of the next are excluded
+  segmentStartIds = np.arange(len(points_RAS) - 1)
+  segmentStartIds = segmentStartIds[polylineIds[:-1] == polylineIds[1:]]
+
+  signedDistances = np.dot(points_RAS - np.asarray(planeOrigin_RAS[:3]), np.asarray(planeNormal_RAS[:3]))
+  startDistances = signedDistances[segmentStartIds]
+  endDistances = signedDistances[segmentStartIds + 1]
+  crossingIds = np.nonzero((startDistances > 0.0) != (endDistances > 0.0))[0]
+
+  startIds = segmentStartIds[crossingIds]
+  t = startDistances[crossingIds] / (startDistances[crossingIds] - endDistances[crossingIds])
+  intersectionPoints_RAS = points_RAS[startIds] + t[:, np.newaxis] * (points_RAS[startIds + 1] - points_RAS[startIds])
+
+  rasToXYMatrix = np.asarray(rasToXYMatrix)
+  intersectionPoints_XY = np.dot(intersectionPoints_RAS, rasToXYMatrix[:3, :3].T) + rasToXYMatrix[:3, 3]
+
+  intersectionCounts = np.bincount(polylineIds[startIds], minlength=numberOfPolylines)
+  return np.split(intersectionPoints_XY, np.cumsum(intersectionCounts)[:-1])
+
 class NeuroSegmentMarkupsIntersectionPipeline(VTKObservationMixin):
 
   def __init__(self, curveNode, sliceNode):
@@ -41,6 +80,16 @@ class NeuroSegmentMarkupsIntersectionPipeline(VTKObservationMixin):
     self.curveNode = curveNode
     self.sliceNode = sliceNode
 
+    # Cached slice plane, curve bounds and intersection, used to avoid recomputing the intersection
+    # when neither the curve nor the slice have changed, and to skip curves that are not near the slice.
+    self.sliceNormal_RAS = None
+    self.sliceOrigin_RAS = None
+    self.rasToXYMatrix = None
+    self.xyToRASMTime = None
+    self.curveBoundsCorners_World = None
+    self.curveMTime = None
+    self.intersectionMTime = None
+
   def setGlyphType(self, glyphType):
     self.glyphSource.SetGlyphType(glyphType)
     sliceView = self.getSliceView()
@@ -64,7 +113,8 @@ class NeuroSegmentMarkupsIntersectionPipeline(VTKObservationMixin):
 
     renderer.AddActor2D(self.actor)
 
-    self.addObserver(self.sliceNode, vtk.vtkCommand.ModifiedEvent, self.updateActorFromMRML)
+    # Slice node modifications are handled by NeuroSegmentMarkupsIntersectionDisplayManager, which updates all of the
+    # pipelines in the view at once.
     self.addObserver(self.curveNode, vtk.vtkCommand.ModifiedEvent, self.updateActorFromMRML)
     self.addObserver(self.curveNode, slicer.vtkMRMLMarkupsNode.PointModifiedEvent, self.updateActorFromMRML)
     self.addObserver(self.curveNode, slicer.vtkMRMLDisplayableNode.DisplayModifiedEvent , self.updateActorFromMRML)
@@ -83,15 +133,7 @@ class NeuroSegmentMarkupsIntersectionPipeline(VTKObservationMixin):
     self.removeObservers(self.updateActorFromMRML)
 
   def getViewIDs(self):
-    viewsAttribute = self.curveNode.GetAttribute(NeuroSegmentMarkupsIntersectionDisplayManager.INTERSECTION_VIEWS_ATTRIBUTE)
-    if not viewsAttribute or viewsAttribute == "":
-      return []
-    try:
-      viewIDs = json.loads(viewsAttribute)
-    except json.JSONDecodeError as error:
-      logging.error("Error decoding json: {0}\n{1}".format(viewsAttribute, error)     )
-      return []
-    return viewIDs
+    return NeuroSegmentMarkupsIntersectionDisplayManager.getIntersectionViewIDs(self.curveNode)
 
   def getVisibility(self):
     viewIDs = self.getViewIDs()
@@ -99,50 +141,81 @@ class NeuroSegmentMarkupsIntersectionPipeline(VTKObservationMixin):
       self.sliceNode.GetName() in viewIDs)
 
   def updateActorFromMRML(self, caller=None, event=None):
+    if not self.updateCachesFromMRML():
+      return
+
+    if self.isIntersectionModified():
+      intersectionPoints_XY = getPolylinePlaneIntersections_XY(
+        [self.getCurvePoints_World()], self.sliceOrigin_RAS, self.sliceNormal_RAS, self.rasToXYMatrix)
+      self.setIntersectionPoints_XY(intersectionPoints_XY[0])
+
+    self.updateDisplayFromMRML()
+
+  def updateCachesFromMRML(self):
+    """
+    Update the cached slice plane and curve bounds, and the visibility of the actor.
+    :return: True if the curve is visible and may intersect the slice, False otherwise
+    """
     if not self.getVisibility():
       self.actor.SetVisibility(False)
-      return
+      return False
 
     if self.sliceNode is None or self.curveNode is None:
       self.actor.SetVisibility(False)
-      return
+      return False
 
     if self.curveNode.GetNumberOfControlPoints() <= 0 or not self.curveNode.GetDisplayVisibility():
       self.actor.SetVisibility(False)
-      return
-
-    self.actor.SetVisibility(True)
+      return False
 
     xyToRASMatrix = self.sliceNode.GetXYToRAS()
+    if xyToRASMatrix.GetMTime() != self.xyToRASMTime:
+      self.updateSlicePlane(xyToRASMatrix)
 
-    sliceNormal_RAS = np.array([0.0, 0.0, 1.0, 0.0])
-    xyToRASMatrix.MultiplyPoint(sliceNormal_RAS, sliceNormal_RAS)
-
-    sliceOrigin_RAS = np.array([0.0, 0.0, 0.0, 1.0])
-    xyToRASMatrix.MultiplyPoint(sliceOrigin_RAS, sliceOrigin_RAS)
-
-    slicePlane_RAS = vtk.vtkPlane()
-    slicePlane_RAS.SetNormal(sliceNormal_RAS[:3])
-    slicePlane_RAS.SetOrigin(sliceOrigin_RAS[:3])
-
-    intersectionPoints_RAS = vtk.vtkPoints()
-    self.curveNode.GetPointsOnPlaneWorld(slicePlane_RAS, intersectionPoints_RAS)
-
-    rasToXYMatrix = vtk.vtkMatrix4x4()
-    vtk.vtkMatrix4x4.Invert(xyToRASMatrix, rasToXYMatrix)
-
-    rasToXYTransform = vtk.vtkTransform()
-    rasToXYTransform.SetMatrix(rasToXYMatrix)
+    curvePoints_World = self.curveNode.GetCurvePointsWorld()
+    if curvePoints_World is None or curvePoints_World.GetNumberOfPoints() == 0:
+      self.actor.SetVisibility(False)
+      return False
 
-    intersectionPolyData_RAS = vtk.vtkPolyData()
-    intersectionPolyData_RAS.SetPoints(intersectionPoints_RAS)
+    curveMTime = (self.curveNode.GetMTime(), curvePoints_World.GetMTime())
+    if curveMTime != self.curveMTime:
+      self.updateCurveBounds(curvePoints_World)
+      self.curveMTime = curveMTime
 
-    transformFilter = vtk.vtkTransformPolyDataFilter()
-    transformFilter.SetTransform(rasToXYTransform)
-    transformFilter.SetInputData(intersectionPolyData_RAS)
-    transformFilter.Update()
-    self.intersectionPoints_XY.DeepCopy(transformFilter.GetOutput())
+    if not self.canIntersectSlicePlane():
+      self.actor.SetVisibility(False)
+      return False
 
+    self.actor.SetVisibility(True)
+    return True
+
+  def isIntersectionModified(self):
+    """
+    Returns True if the curve or slice have changed since the intersection points were last set.
+    """
+    return (self.curveMTime, self.xyToRASMTime) != self.intersectionMTime
+
+  def getCurvePoints_World(self):
+    """
+    Returns the interpolated curve points in world coordinates as a numpy array.
+    For closed curves, the first point is appended to the end of the array so that the closing segment is included.
+    """
+    curvePoints_World = numpy_support.vtk_to_numpy(self.curveNode.GetCurvePointsWorld().GetData())
+    if self.curveNode.GetCurveClosed() and len(curvePoints_World) > 1:
+      curvePoints_World = np.vstack([curvePoints_World, curvePoints_World[:1]])
+    return curvePoints_World
+
+  def setIntersectionPoints_XY(self, intersectionPoints_XY):
+    """
+    Set the positions of the intersection glyphs.
+    :param intersectionPoints_XY: numpy array of intersection points in XY coordinates
+    """
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(intersectionPoints_XY, deep=True))
+    self.intersectionPoints_XY.SetPoints(points)
+    self.intersectionMTime = (self.curveMTime, self.xyToRASMTime)
+
+  def updateDisplayFromMRML(self):
     renderWindow = self.getRenderWindow()
     screenSize = renderWindow.GetScreenSize()
     screenSizePixel = np.sqrt(screenSize[0] * screenSize[0] + screenSize[1] * screenSize[1])
@@ -155,6 +228,45 @@ class NeuroSegmentMarkupsIntersectionPipeline(VTKObservationMixin):
       color = displayNode.GetSelectedColor()
       self.property.SetColor(color)
 
+  def updateSlicePlane(self, xyToRASMatrix):
+    """
+    Update the cached slice plane and RAS to XY matrix from the current XY to RAS matrix.
+    :param xyToRASMatrix: vtkMatrix4x4 from the slice node
+    """
+    sliceNormal_RAS = np.array([0.0, 0.0, 1.0, 0.0])
+    xyToRASMatrix.MultiplyPoint(sliceNormal_RAS, sliceNormal_RAS)
+
+    sliceOrigin_RAS = np.array([0.0, 0.0, 0.0, 1.0])
+    xyToRASMatrix.MultiplyPoint(sliceOrigin_RAS, sliceOrigin_RAS)
+
+    self.sliceNormal_RAS = sliceNormal_RAS[:3]
+    self.sliceOrigin_RAS = sliceOrigin_RAS[:3]
+
+    rasToXYMatrix = vtk.vtkMatrix4x4()
+    vtk.vtkMatrix4x4.Invert(xyToRASMatrix, rasToXYMatrix)
+    self.rasToXYMatrix = slicer.util.arrayFromVTKMatrix(rasToXYMatrix)
+
+    self.xyToRASMTime = xyToRASMatrix.GetMTime()
+
+  def updateCurveBounds(self, curvePoints_World):
+    """
+    Update the cached corners of the world bounding box of the curve.
+    :param curvePoints_World: vtkPoints containing the interpolated curve points in world coordinates
+    """
+    bounds = curvePoints_World.GetBounds()
+    self.curveBoundsCorners_World = np.array([
+      [bounds[i], bounds[2 + j], bounds[4 + k]] for i in range(2) for j in range(2) for k in range(2)
+      ])
+
+  def canIntersectSlicePlane(self):
+    """
+    Returns False if the bounding box of the curve lies entirely on one side of the slice plane.
+    """
+    if self.curveBoundsCorners_World is None or self.sliceNormal_RAS is None:
+      return True
+    signedDistances = np.dot(self.curveBoundsCorners_World - self.sliceOrigin_RAS, self.sliceNormal_RAS)
+    return signedDistances.min() <= 0.0 and signedDistances.max() >= 0.0
+
   def getSliceView(self):
     if self.sliceNode is None:
       return None
@@ -183,11 +295,15 @@ class NeuroSegmentMarkupsIntersectionDisplayManager(VTKObservationMixin):
   INTERSECTION_GLYPH_TYPE_ATTRIBUTE = "NeuroSegmentMarkupsIntersection.GlyphType"
   INTERSECTION_GLYPH_SCALE_ATTRIBUTE = "NeuroSegmentMarkupsIntersection.GlyphScale"
 
+  MAXIMUM_NUMBER_OF_CACHED_VIEW_IDS = 64
+  viewIDsCache = {} # Key is the value of the views attribute, value is the parsed list of view names
+
   def __init__(self):
     VTKObservationMixin.__init__(self)
 
     self.viewPipelines = {} # Key is view name, value is dict containing pipelines
                             # Key of nested dict is markups node, value is pipeline object
+    self.viewSliceNodes = {} # Key is view name, value is slice node
 
     self.glyphScale = 0.5
     self.glyphType = slicer.vtkMRMLMarkupsDisplayNode.Cross2D
@@ -196,41 +312,50 @@ class NeuroSegmentMarkupsIntersectionDisplayManager(VTKObservationMixin):
     self.addObserver(slicer.mrmlScene, slicer.vtkMRMLScene.NodeRemovedEvent, self.onNodeRemoved)
 
     layoutManager = slicer.app.layoutManager()
-    layoutManager.connect('layoutChanged(int)', self.updatePipelines)
+    if layoutManager:
+      # There is no layout manager when running without the main window (ex. batch processing)
+      layoutManager.connect('layoutChanged(int)', self.updatePipelines)
 
     self.updatePipelines()
 
-  def setGlyphType(self, glyphType):
-    self.glyphType = glyphType
+  @staticmethod
+  def getGlyphSourceType(glyphType):
+    """
+    Returns the vtkMarkupsGlyphSource2D glyph type that is used to display the vtkMRMLMarkupsDisplayNode glyph type.
+    """
     if glyphType == slicer.vtkMRMLMarkupsDisplayNode.StarBurst2D:
-      glyphType = slicer.vtkMarkupsGlyphSource2D.GlyphStarBurst
+      return slicer.vtkMarkupsGlyphSource2D.GlyphStarBurst
     elif glyphType == slicer.vtkMRMLMarkupsDisplayNode.Cross2D:
-       glyphType = slicer.vtkMarkupsGlyphSource2D.GlyphCross
+      return slicer.vtkMarkupsGlyphSource2D.GlyphCross
     elif glyphType == slicer.vtkMRMLMarkupsDisplayNode.CrossDot2D:
-      glyphType = slicer.vtkMarkupsGlyphSource2D.GlyphCrossDot
+      return slicer.vtkMarkupsGlyphSource2D.GlyphCrossDot
     elif glyphType == slicer.vtkMRMLMarkupsDisplayNode.ThickCross2D:
-       glyphType = slicer.vtkMarkupsGlyphSource2D.GlyphThickCross
+      return slicer.vtkMarkupsGlyphSource2D.GlyphThickCross
     elif glyphType == slicer.vtkMRMLMarkupsDisplayNode.Dash2D:
-      glyphType = slicer.vtkMarkupsGlyphSource2D.GlyphDash
+      return slicer.vtkMarkupsGlyphSource2D.GlyphDash
     elif glyphType == slicer.vtkMRMLMarkupsDisplayNode.Sphere3D:
-       glyphType = slicer.vtkMarkupsGlyphSource2D.GlyphCircle
+      return slicer.vtkMarkupsGlyphSource2D.GlyphCircle
     elif glyphType == slicer.vtkMRMLMarkupsDisplayNode.Vertex2D:
-       glyphType = slicer.vtkMarkupsGlyphSource2D.GlyphVertex
+      return slicer.vtkMarkupsGlyphSource2D.GlyphVertex
     elif glyphType == slicer.vtkMRMLMarkupsDisplayNode.Circle2D:
-       glyphType = slicer.vtkMarkupsGlyphSource2D.GlyphCircle
+      return slicer.vtkMarkupsGlyphSource2D.GlyphCircle
     elif glyphType == slicer.vtkMRMLMarkupsDisplayNode.Triangle2D:
-       glyphType = slicer.vtkMarkupsGlyphSource2D.GlyphTriangle
+      return slicer.vtkMarkupsGlyphSource2D.GlyphTriangle
     elif glyphType == slicer.vtkMRMLMarkupsDisplayNode.Square2D:
-       glyphType = slicer.vtkMarkupsGlyphSource2D.GlyphSquare
+      return slicer.vtkMarkupsGlyphSource2D.GlyphSquare
     elif glyphType == slicer.vtkMRMLMarkupsDisplayNode.Diamond2D:
-       glyphType = slicer.vtkMarkupsGlyphSource2D.GlyphDiamond
+      return slicer.vtkMarkupsGlyphSource2D.GlyphDiamond
     elif glyphType == slicer.vtkMRMLMarkupsDisplayNode.Arrow2D:
-       glyphType = slicer.vtkMarkupsGlyphSource2D.GlyphArrow
+      return slicer.vtkMarkupsGlyphSource2D.GlyphArrow
     elif glyphType == slicer.vtkMRMLMarkupsDisplayNode.ThickArrow2D:
-       glyphType = slicer.vtkMarkupsGlyphSource2D.GlyphThickArrow
+      return slicer.vtkMarkupsGlyphSource2D.GlyphThickArrow
     elif glyphType == slicer.vtkMRMLMarkupsDisplayNode.HookedArrow2D:
-       glyphType = slicer.vtkMarkupsGlyphSource2D.GlyphHookedArrow
+      return slicer.vtkMarkupsGlyphSource2D.GlyphHookedArrow
+    return glyphType
 
+  def setGlyphType(self, glyphType):
+    self.glyphType = glyphType
+    glyphType = self.getGlyphSourceType(glyphType)
     for sliceViewName, currentViewPipelines in self.viewPipelines.items():
       for curveNode, pipeline in currentViewPipelines.items():
         pipeline.setGlyphType(glyphType)
@@ -242,50 +367,163 @@ class NeuroSegmentMarkupsIntersectionDisplayManager(VTKObservationMixin):
         pipeline.setGlyphScale(glyphScale)
 
   def updatePipelines(self):
-    self.removeAllActors()
-
+    """
+    Update the pipelines to match the slice views in the current layout.
+    Pipelines are only created or removed for slice views that have been added or removed since the last update.
+    """
     layoutManager = slicer.app.layoutManager()
-    for sliceViewName in layoutManager.sliceViewNames():
+    if layoutManager is None:
+      return
+    sliceViewNames = set(layoutManager.sliceViewNames())
+    currentSliceViewNames = set(self.viewPipelines.keys())
+
+    for sliceViewName in currentSliceViewNames - sliceViewNames:
+      self.removeViewActors(sliceViewName)
+
+    addedSliceViewNames = sliceViewNames - currentSliceViewNames
+    for sliceViewName in addedSliceViewNames:
       self.viewPipelines[sliceViewName] = {}
+      sliceNode = layoutManager.sliceWidget(sliceViewName).mrmlSliceNode()
+      self.viewSliceNodes[sliceViewName] = sliceNode
+      self.addObserver(sliceNode, vtk.vtkCommand.ModifiedEvent, self.onSliceNodeModified)
 
     curveNodes = slicer.mrmlScene.GetNodesByClass("vtkMRMLMarkupsCurveNode")
     curveNodes.UnRegister(None)
     for curveIndex in range(curveNodes.GetNumberOfItems()):
       curveNode = curveNodes.GetItemAsObject(curveIndex)
-      self.addViewActors(curveNode)
+      if not self.hasObserver(curveNode, vtk.vtkCommand.ModifiedEvent, self.onCurveNodeModified):
+        self.addObserver(curveNode, vtk.vtkCommand.ModifiedEvent, self.onCurveNodeModified)
+        self.addViewActors(curveNode)
+      elif len(addedSliceViewNames) > 0:
+        self.addViewActors(curveNode, addedSliceViewNames)
 
   def removeAllActors(self):
-    for sliceViewName, currentViewPipelines in self.viewPipelines.items():
-      for curveNode, pipeline in currentViewPipelines.items():
-        pipeline.removeActor()
-    self.viewPipelines = {}
+    for sliceViewName in list(self.viewPipelines.keys()):
+      self.removeViewActors(sliceViewName)
+
+  def removeViewActors(self, sliceViewName):
+    """
+    Remove all of the pipelines for the specified slice view.
+    :param sliceViewName: Name of the slice view
+    """
+    currentViewPipelines = self.viewPipelines.pop(sliceViewName, {})
+    for pipeline in currentViewPipelines.values():
+      pipeline.removeActor()
+    sliceNode = self.viewSliceNodes.pop(sliceViewName, None)
+    if sliceNode:
+      self.removeObserver(sliceNode, vtk.vtkCommand.ModifiedEvent, self.onSliceNodeModified)
+
+  @staticmethod
+  def getIntersectionViewIDs(curveNode):
+    """
+    Returns the list of slice view names in which the intersection of the curve should be displayed.
+    The parsed list is cached by the attribute value, since it is checked every time that the curve is modified.
+    """
+    viewsAttribute = curveNode.GetAttribute(NeuroSegmentMarkupsIntersectionDisplayManager.INTERSECTION_VIEWS_ATTRIBUTE)
+    if not viewsAttribute or viewsAttribute == "":
+      return []
+    viewIDsCache = NeuroSegmentMarkupsIntersectionDisplayManager.viewIDsCache
+    viewIDs = viewIDsCache.get(viewsAttribute)
+    if viewIDs is not None:
+      return viewIDs
+    try:
+      viewIDs = json.loads(viewsAttribute)
+    except json.JSONDecodeError as error:
+      logging.error("Error decoding json: {0}\n{1}".format(viewsAttribute, error)     )
+      return []
+    if len(viewIDsCache) >= NeuroSegmentMarkupsIntersectionDisplayManager.MAXIMUM_NUMBER_OF_CACHED_VIEW_IDS:
+      viewIDsCache.clear()
+    viewIDsCache[viewsAttribute] = viewIDs
+    return viewIDs
+
+  def onCurveNodeModified(self, curveNode, event=None):
+    # Create the pipelines for any views in which the curve intersection has become visible.
+    self.addViewActors(curveNode)
+
+  def onSliceNodeModified(self, sliceNode, event=None):
+    self.updateViewIntersections(sliceNode.GetLayoutName())
+
+  def updateAllViewIntersections(self):
+    """
+    Update the curve intersections in all slice views.
+    """
+    for sliceViewName in self.viewPipelines.keys():
+      self.updateViewIntersections(sliceViewName)
+
+  def updateViewIntersections(self, sliceViewName):
+    """
+    Update the intersections of all curves in the specified slice view.
+    The intersection points for all of the curves that have been modified are computed in a single call.
+    :param sliceViewName: Name of the slice view to be updated
+    """
+    currentViewPipelines = self.viewPipelines.get(sliceViewName)
+    if not currentViewPipelines:
+      return
+
+    modifiedPipelines = []
+    for pipeline in currentViewPipelines.values():
+      if not pipeline.updateCachesFromMRML():
+        continue
+      if pipeline.isIntersectionModified():
+        modifiedPipelines.append(pipeline)
+      pipeline.updateDisplayFromMRML()
+
+    if len(modifiedPipelines) > 0:
+      # All pipelines in the view share the same slice node, and the same slice plane.
+      slicePipeline = modifiedPipelines[0]
+      curvePoints_World = [pipeline.getCurvePoints_World() for pipeline in modifiedPipelines]
+      intersectionPoints_XY = getPolylinePlaneIntersections_XY(curvePoints_World,
+        slicePipeline.sliceOrigin_RAS, slicePipeline.sliceNormal_RAS, slicePipeline.rasToXYMatrix)
+      for pipeline, pipelineIntersectionPoints_XY in zip(modifiedPipelines, intersectionPoints_XY):
+        pipeline.setIntersectionPoints_XY(pipelineIntersectionPoints_XY)
+
+    sliceWidget = slicer.app.layoutManager().sliceWidget(sliceViewName)
+    if sliceWidget:
+      sliceWidget.sliceView().scheduleRender()
 
   @vtk.calldata_type(vtk.VTK_OBJECT)
   def onNodeAdded(self, scene, event, node):
     if not node or not node.IsA("vtkMRMLMarkupsCurveNode"):
       return
+    self.addObserver(node, vtk.vtkCommand.ModifiedEvent, self.onCurveNodeModified)
     self.addViewActors(node)
 
   @vtk.calldata_type(vtk.VTK_OBJECT)
   def onNodeRemoved(self, scene, event, node):
     if not node or not node.IsA("vtkMRMLMarkupsCurveNode"):
       return
+    self.removeObserver(node, vtk.vtkCommand.ModifiedEvent, self.onCurveNodeModified)
     self.removeCurveActors(node)
 
-  def addViewActors(self, curveNode):
-    layoutManager = slicer.app.layoutManager()
+  def addViewActors(self, curveNode, sliceViewNames=None):
+    """
+    Create the pipelines for the curve in each of the slice views where the curve intersection is visible.
+    Pipelines are not created for views where the intersection is hidden.
+    :param curveNode: Curve node that the pipelines will be created for
+    :param sliceViewNames: Names of the slice views to be checked. If None, all slice views are checked.
+    """
+    if curveNode.GetAttribute(self.INTERSECTION_VISIBLE_ATTRIBUTE) != str(True):
+      return
 
-    for sliceViewName, currentViewPipelines in self.viewPipelines.items():
+    viewIDs = self.getIntersectionViewIDs(curveNode)
+    if len(viewIDs) == 0:
+      return
+
+    if sliceViewNames is None:
+      sliceViewNames = self.viewPipelines.keys()
+
+    for sliceViewName in sliceViewNames:
+      currentViewPipelines = self.viewPipelines[sliceViewName]
       if curveNode in currentViewPipelines.keys():
         continue
 
-      widget = layoutManager.sliceWidget(sliceViewName)
-      sliceLogic = widget.sliceLogic()
-      sliceNode = sliceLogic.GetSliceNode()
+      sliceNode = self.viewSliceNodes[sliceViewName]
+      if not sliceNode.GetName() in viewIDs:
+        continue
 
       pipeline = NeuroSegmentMarkupsIntersectionPipeline(curveNode, sliceNode)
       currentViewPipelines[curveNode] = pipeline
-      pipeline.setGlyphType(self.glyphType)
+      pipeline.setGlyphType(self.getGlyphSourceType(self.glyphType))
       pipeline.setGlyphScale(self.glyphScale)
       pipeline.addActor()
 
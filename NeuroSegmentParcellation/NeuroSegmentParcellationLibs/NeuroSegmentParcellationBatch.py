@@ -0,0 +1,42 @@
+"""
+Batch parcellation of the subjects in a manifest file.
+
+Usage:
+  Slicer --no-main-window --python-script NeuroSegmentParcellationBatch.py --manifest manifest.json --output outputDirectory [--workers N]
+
+See NeuroSegmentParcellationLogic.loadBatchManifest for the manifest format.
+When --subject is specified, only that subject is processed in the current process. This is used by the worker processes.
+Subjects and stages that were completed with the same inputs are skipped unless --no-resume is specified.
+"""
+
+import argparse
+import logging
+import sys
+import slicer
+
+from NeuroSegmentParcellationLibs.NeuroSegmentParcellationLogic import NeuroSegmentParcellationLogic
+
+def main(argv):
+  parser = argparse.ArgumentParser(description="NeuroSegment parcellation batch processing")
+  parser.add_argument("--manifest", required=True, help="Manifest file listing the subjects to process")
+  parser.add_argument("--output", required=True, help="Output directory")
+  parser.add_argument("--workers", type=int, default=1, help="Number of subjects that are processed concurrently")
+  parser.add_argument("--subject", default=None, help="Only process the subject with the specified name in the current process")
+  parser.add_argument("--no-resume", dest="resume", action="store_false", help="Process all stages again, ignoring existing checkpoints")
+  args = parser.parse_args(argv)
+
+  logic = NeuroSegmentParcellationLogic()
+  if args.subject is None:
+    results = logic.runBatch(args.manifest, args.output, args.workers, args.resume)
+    success = all([result["success"] for result in results])
+  else:
+    subjects = [subject for subject in logic.loadBatchManifest(args.manifest) if subject["name"] == args.subject]
+    if len(subjects) == 0:
+      logging.error("Subject %s not found in manifest" % args.subject)
+      return 1
+    result = logic.processBatchSubject(subjects[0], args.output, args.resume)
+    success = result["success"]
+  return 0 if success else 1
+
+if __name__ == "__main__":
+  slicer.util.exit(main(sys.argv[1:]))
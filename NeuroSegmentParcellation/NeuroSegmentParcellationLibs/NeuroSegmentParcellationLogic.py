@@ -1,13 +1,21 @@
 import os
 import ast
+import numpy as np
 import vtk, slicer
+from vtk.util import numpy_support
 from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
 import logging
 import json
+import hashlib
+import subprocess
+import sys
+import time
 
 from NeuroSegmentParcellationLibs.NeuroSegmentParcellationVisitor import NeuroSegmentParcellationVisitor
 from NeuroSegmentParcellationLibs.NeuroSegmentMarkupsIntersectionDisplayManager import NeuroSegmentMarkupsIntersectionDisplayManager
+from NeuroSegmentParcellationLibs.NeuroSegmentDerivedMarkupsDisplayManager import NeuroSegmentDerivedMarkupsDisplayManager
+from NeuroSegmentParcellationLibs.NeuroSegmentFreeSurferReader import NeuroSegmentOverlayCache, createFreeSurferSurfacePolyData, findFreeSurferOverlayPaths, getFreeSurferOverlayName
 
 class NeuroSegmentParcellationLogic(ScriptedLoadableModuleLogic, VTKObservationMixin):
   """Perform filtering
@@ -70,6 +78,7 @@ class NeuroSegmentParcellationLogic(ScriptedLoadableModuleLogic, VTKObservationM
   INTERSECTION_VISIBILITY_YELLOW_VIEW = "IntersectionVisibilityYellowView"
 
   CONTROL_POINT_VIIBILITY = "ControlPointVisibility"
+  VIRTUAL_DERIVED_MARKUPS_NAME = "VirtualDerivedMarkups"
   LABEL_TEXT_VISIBILITY = "LabelTextVisibility"
 
   PLANE_INTERSECTION_VISIBILITY_NAME = "PlaneIntersectionVisibility"
@@ -81,6 +90,41 @@ class NeuroSegmentParcellationLogic(ScriptedLoadableModuleLogic, VTKObservationM
 
   LABEL_OUTLINE_VISIBILITY_NAME = "LabelOutlineVisibility"
 
+  COST_FUNCTION_ARRAY_PREFIX = "NeuroSegmentCost_"
+  COST_FUNCTION_NUMPY_FUNCTIONS = {
+    "abs": np.abs,
+    "exp": np.exp,
+    "ln": np.log,
+    "log": np.log,
+    "log10": np.log10,
+    "sqrt": np.sqrt,
+    "sin": np.sin,
+    "cos": np.cos,
+    "tan": np.tan,
+    "min": np.minimum,
+    "max": np.maximum,
+    "pow": np.power,
+    }
+
+  COST_FUNCTION_AST_NODE_TYPES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Load,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.USub, ast.UAdd) + ((ast.Num,) if sys.version_info < (3, 8) else (ast.Constant,))
+
+  SUBJECT_CACHE_VERSION = 2
+  SUBJECT_CACHE_SURFACE_KEYS = ["orig", "pial", "inflated"]
+
+  BATCH_SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "NeuroSegmentParcellationBatch.py")
+  BATCH_DEFAULT_OVERLAYS = ["curv", "sulc"]
+  BATCH_SURFACE_KEYS = ["orig", "pial", "inflated"]
+  BATCH_LOG_FILE_NAME = "log.txt"
+  BATCH_RESULT_FILE_NAME = "result.json"
+  BATCH_SUMMARY_FILE_NAME = "summary.tsv"
+  BATCH_LABEL_MODEL_FILE_NAME = "labels.vtk"
+  BATCH_LABEL_TABLE_FILE_NAME = "labels.tsv"
+  BATCH_SEGMENTATION_FILE_NAME = "segmentation.seg.vtm"
+  BATCH_CHECKPOINT_FILE_NAME = "checkpoint.json"
+  BATCH_CHECKPOINT_VERSION = 1
+  BATCH_CUTS_DIRECTORY_NAME = "cuts"
+
   def __init__(self, parent=None):
     ScriptedLoadableModuleLogic.__init__(self, parent)
     VTKObservationMixin.__init__(self)
@@ -90,19 +134,43 @@ class NeuroSegmentParcellationLogic(ScriptedLoadableModuleLogic, VTKObservationM
     self.origPointLocator = vtk.vtkPointLocator()
     self.pialPointLocator = vtk.vtkPointLocator()
     self.inflatedPointLocator = vtk.vtkPointLocator()
+    # Key is the (source, destination) surface name, value is the point correspondence between the surfaces
+    self.surfaceCorrespondences = {}
     self.inputMarkupObservers = []
     self.parameterNode = None
     self.updatingFromMasterMarkup = False
     self.updatingFromDerivedMarkup = False
     self.updatingSeedNodes = False
 
+    self.compiledCostFunctions = {} # Key is the weighting function, value is the compiled expression and array names
+    self.costFunctionArrayCache = {} # Key is the model node ID and array name, value is the state of the input arrays
+    # Key is the model node ID, value is a dictionary with the parameter node ID as the key and the names of the cost
+    # function arrays used by the curves of the parameter node as the value
+    self.costFunctionArrayUsers = {}
+    # Kept between queries so that its compiled plans are reused
+    self.queryVisitor = NeuroSegmentParcellationVisitor(self)
+
+    self.overlayCache = NeuroSegmentOverlayCache()
+    # Overlays used by the surface cost function must stay loaded
+    self.overlayCache.setOverlayPinned("curv", True)
+    self.overlayCache.setOverlayPinned("sulc", True)
+
     try:
       slicer.intersectionDisplayManager
     except AttributeError as error:
       slicer.intersectionDisplayManager = NeuroSegmentMarkupsIntersectionDisplayManager()
 
+    try:
+      slicer.derivedMarkupsDisplayManager
+    except AttributeError as error:
+      slicer.derivedMarkupsDisplayManager = NeuroSegmentDerivedMarkupsDisplayManager()
+    slicer.derivedMarkupsDisplayManager.setPointsFunction(self.getDerivedMarkupPointsWorld)
+
     self.addObserver(slicer.mrmlScene, slicer.mrmlScene.EndImportEvent, self.updateParameterNodeObservers)
     self.addObserver(slicer.mrmlScene, slicer.vtkMRMLScene.NodeAddedEvent, self.onNodeAdded)
+    # Cost function arrays can be computed from the overlays, so they are not saved with the surface
+    self.addObserver(slicer.mrmlScene, slicer.vtkMRMLScene.StartSaveEvent, self.onSceneStartSave)
+    self.addObserver(slicer.mrmlScene, slicer.vtkMRMLScene.EndSaveEvent, self.onSceneEndSave)
     scriptedModuleNodes = slicer.util.getNodesByClass("vtkMRMLScriptedModuleNode")
     for node in scriptedModuleNodes:
       if node.GetAttribute("ModuleName") == self.moduleName:
@@ -120,6 +188,8 @@ class NeuroSegmentParcellationLogic(ScriptedLoadableModuleLogic, VTKObservationM
     if self.getQueryNode() is None:
       self.loadQuery(self.queryNodeFileName)
     self.updateModelNodes()
+    self.updateSharedSurfaceTopology(parameterNode)
+    self.updateSurfaceCorrespondences(parameterNode)
     self.onParameterNodeModified(parameterNode)
 
   def getParameterNode(self):
@@ -245,6 +315,9 @@ class NeuroSegmentParcellationLogic(ScriptedLoadableModuleLogic, VTKObservationM
       if displayNode is None:
         continue
 
+      if attributeType != vtk.vtkDataObject.CELL:
+        self.requestScalarOverlay(modelNode, scalarName)
+
       if attributeType == -1:
         displayNode.SetActiveScalarName(scalarName)
       else:
@@ -271,33 +344,200 @@ class NeuroSegmentParcellationLogic(ScriptedLoadableModuleLogic, VTKObservationM
 
   def updateInputMarkupSurfaceCostFunction(self, parameterNode):
     origModelNode = parameterNode.GetNodeReference(self.ORIG_MODEL_REFERENCE)
+    self.requestScalarOverlay(origModelNode, "sulc")
+    self.requestScalarOverlay(origModelNode, "curv")
+
+    sulcArray = None
+    curvArray = None
+    if origModelNode and origModelNode.GetPolyData() and origModelNode.GetPolyData().GetPointData():
+      sulcArray = origModelNode.GetPolyData().GetPointData().GetArray("sulc")
+      curvArray = origModelNode.GetPolyData().GetPointData().GetArray("curv")
+
+    # Key is the weighting function from the curve attribute, value is the weighting function passed to the curve
+    surfaceWeightingFunctions = {}
+    usedCostFunctionArrayNames = set()
     numberOfMarkupNodes = parameterNode.GetNumberOfNodeReferences(self.INPUT_MARKUPS_REFERENCE)
     for i in range(numberOfMarkupNodes):
       inputCurveNode = parameterNode.GetNthNodeReference(self.INPUT_MARKUPS_REFERENCE, i)
       if inputCurveNode.IsA("vtkMRMLMarkupsCurveNode"):
-        inputCurveNode.SetAndObserveShortestDistanceSurfaceNode(origModelNode)
-        inputCurveNode.SetSurfaceConstraintMaximumSearchRadiusTolerance(0.0)
-
-        sulcArray = None
-        curvArray = None
-        if origModelNode and origModelNode.GetPolyData() and origModelNode.GetPolyData().GetPointData():
-          sulcArray = origModelNode.GetPolyData().GetPointData().GetArray("sulc")
-          curvArray = origModelNode.GetPolyData().GetPointData().GetArray("curv")
+        if inputCurveNode.GetShortestDistanceSurfaceNode() != origModelNode:
+          inputCurveNode.SetAndObserveShortestDistanceSurfaceNode(origModelNode)
+        if inputCurveNode.GetSurfaceConstraintMaximumSearchRadiusTolerance() != 0.0:
+          inputCurveNode.SetSurfaceConstraintMaximumSearchRadiusTolerance(0.0)
 
         distanceWeightingFunction = inputCurveNode.GetAttribute("DistanceWeightingFunction")
         if distanceWeightingFunction and distanceWeightingFunction != "" and sulcArray and curvArray:
-          sulcRange = sulcArray.GetRange()
-          curvRange = curvArray.GetRange()
-          distanceWeightingFunction = distanceWeightingFunction.replace("sulcMin", str(sulcRange[0]))
-          distanceWeightingFunction = distanceWeightingFunction.replace("curvMin", str(curvRange[0]))
-          distanceWeightingFunction = distanceWeightingFunction.replace("sulcMax", str(sulcRange[1]))
-          distanceWeightingFunction = distanceWeightingFunction.replace("curvMax", str(curvRange[1]))
+          surfaceWeightingFunction = surfaceWeightingFunctions.get(distanceWeightingFunction)
+          if surfaceWeightingFunction is None:
+            sulcRange = sulcArray.GetRange()
+            curvRange = curvArray.GetRange()
+            surfaceWeightingFunction = distanceWeightingFunction.replace("sulcMin", str(sulcRange[0]))
+            surfaceWeightingFunction = surfaceWeightingFunction.replace("curvMin", str(curvRange[0]))
+            surfaceWeightingFunction = surfaceWeightingFunction.replace("sulcMax", str(sulcRange[1]))
+            surfaceWeightingFunction = surfaceWeightingFunction.replace("curvMax", str(curvRange[1]))
+            # If possible, the function is evaluated once for the surface, and the curves only reference the resulting array
+            costFunctionArrayName = self.updateCostFunctionArray(origModelNode, surfaceWeightingFunction)
+            if costFunctionArrayName:
+              surfaceWeightingFunction = costFunctionArrayName
+            surfaceWeightingFunctions[distanceWeightingFunction] = surfaceWeightingFunction
+          if surfaceWeightingFunction.startswith(self.COST_FUNCTION_ARRAY_PREFIX):
+            usedCostFunctionArrayNames.add(surfaceWeightingFunction)
+
           inverseSquaredType = inputCurveNode.GetSurfaceCostFunctionTypeFromString('inverseSquared')
-          inputCurveNode.SetSurfaceCostFunctionType(inverseSquaredType)
-          inputCurveNode.SetSurfaceDistanceWeightingFunction(distanceWeightingFunction)
+          if inputCurveNode.GetSurfaceCostFunctionType() != inverseSquaredType:
+            inputCurveNode.SetSurfaceCostFunctionType(inverseSquaredType)
+          if inputCurveNode.GetSurfaceDistanceWeightingFunction() != surfaceWeightingFunction:
+            inputCurveNode.SetSurfaceDistanceWeightingFunction(surfaceWeightingFunction)
         else:
           distanceType = inputCurveNode.GetSurfaceCostFunctionTypeFromString('distance')
-          inputCurveNode.SetSurfaceCostFunctionType(distanceType)
+          if inputCurveNode.GetSurfaceCostFunctionType() != distanceType:
+            inputCurveNode.SetSurfaceCostFunctionType(distanceType)
+
+    self.removeUnusedCostFunctionArrays(origModelNode, parameterNode, usedCostFunctionArrayNames)
+
+  def compileCostFunction(self, function):
+    """
+    Compile a surface distance weighting function into a python expression that can be evaluated using numpy arrays.
+    Only arithmetic operators, numbers, point array names and the functions in COST_FUNCTION_NUMPY_FUNCTIONS are supported.
+    :param function: Distance weighting function, using the function parser syntax (ex. "1.0 + abs(curv)^2")
+    :return: Tuple containing the compiled expression and the names of the arrays used, or None if the function is not supported
+    """
+    if function in self.compiledCostFunctions:
+      return self.compiledCostFunctions[function]
+
+    compiledFunction = None
+    try:
+      expression = ast.parse(function.replace("^", "**"), mode="eval")
+      arrayNames = set()
+      for node in ast.walk(expression):
+        if isinstance(node, ast.Call):
+          if not isinstance(node.func, ast.Name) or not node.func.id in self.COST_FUNCTION_NUMPY_FUNCTIONS or node.keywords:
+            raise ValueError("Unsupported function")
+        elif isinstance(node, ast.Name):
+          if not node.id in self.COST_FUNCTION_NUMPY_FUNCTIONS:
+            arrayNames.add(node.id)
+        elif not isinstance(node, self.COST_FUNCTION_AST_NODE_TYPES):
+          raise ValueError("Unsupported expression")
+      compiledFunction = (compile(expression, "<cost function>", "eval"), sorted(arrayNames))
+    except (SyntaxError, ValueError):
+      logging.debug("compileCostFunction: Function is evaluated by the curve: " + function)
+    self.compiledCostFunctions[function] = compiledFunction
+    return compiledFunction
+
+  def updateCostFunctionArray(self, modelNode, function):
+    """
+    Evaluate the distance weighting function for every point of the model, and store the result in a point array.
+    The array is only recomputed if one of the arrays used by the function has been modified.
+    :return: Name of the point array containing the result, or None if the function could not be evaluated
+    """
+    if modelNode is None or modelNode.GetPolyData() is None:
+      return None
+    compiledFunction = self.compileCostFunction(function)
+    if compiledFunction is None:
+      return None
+    expression, arrayNames = compiledFunction
+
+    polyData = modelNode.GetPolyData()
+    pointData = polyData.GetPointData()
+    numberOfPoints = polyData.GetNumberOfPoints()
+    dependencies = [numberOfPoints]
+    for arrayName in arrayNames:
+      dataArray = pointData.GetArray(arrayName)
+      if dataArray is None or dataArray.GetNumberOfComponents() != 1:
+        return None
+      dependencies.append((arrayName, dataArray.GetMTime()))
+
+    costFunctionArrayName = self.COST_FUNCTION_ARRAY_PREFIX + hashlib.sha1(function.encode("utf-8")).hexdigest()[:12]
+    cacheKey = (modelNode.GetID(), costFunctionArrayName)
+    if self.costFunctionArrayCache.get(cacheKey) == dependencies and pointData.GetArray(costFunctionArrayName):
+      return costFunctionArrayName
+
+    variables = dict(self.COST_FUNCTION_NUMPY_FUNCTIONS)
+    for arrayName in arrayNames:
+      variables[arrayName] = numpy_support.vtk_to_numpy(pointData.GetArray(arrayName)).astype(np.float64)
+    try:
+      with np.errstate(all="ignore"):
+        values = eval(expression, {"__builtins__": {}}, variables)
+      # Single precision is sufficient for the path costs, and halves the size of the array
+      values = np.array(np.broadcast_to(values, (numberOfPoints,)), dtype=np.float32)
+    except (ArithmeticError, TypeError, ValueError) as e:
+      logging.debug("updateCostFunctionArray: Could not evaluate %s: %s" % (function, str(e)))
+      return None
+
+    costFunctionArray = numpy_support.numpy_to_vtk(values, deep=False)
+    costFunctionArray.SetName(costFunctionArrayName)
+    pointData.AddArray(costFunctionArray)
+    self.costFunctionArrayCache[cacheKey] = dependencies
+    return costFunctionArrayName
+
+  def removeUnusedCostFunctionArrays(self, modelNode, parameterNode, usedArrayNames):
+    """
+    Record the cost function arrays that are used by the curves of the parameter node, and remove the cost function
+    arrays that are not used by any parameter node from the model.
+    Arrays of models that the parameter node no longer uses are also removed if no other parameter node uses them.
+    :param modelNode: Model that the curves of the parameter node are constrained to
+    :param parameterNode: Parameter node of the curves
+    :param usedArrayNames: Names of the cost function arrays used by the curves of the parameter node
+    """
+    parameterNodeID = parameterNode.GetID() if parameterNode else None
+    modelNodeID = modelNode.GetID() if modelNode else None
+    if modelNodeID:
+      self.costFunctionArrayUsers.setdefault(modelNodeID, {})[parameterNodeID] = set(usedArrayNames)
+
+    for userModelNodeID, users in list(self.costFunctionArrayUsers.items()):
+      if userModelNodeID != modelNodeID:
+        users.pop(parameterNodeID, None)
+      # Parameter nodes that were removed from the scene no longer use any arrays
+      for userParameterNodeID in list(users.keys()):
+        if userParameterNodeID and slicer.mrmlScene.GetNodeByID(userParameterNodeID) is None:
+          del users[userParameterNodeID]
+
+      userModelNode = slicer.mrmlScene.GetNodeByID(userModelNodeID)
+      if userModelNode is None:
+        del self.costFunctionArrayUsers[userModelNodeID]
+        continue
+      if userModelNode.GetPolyData() is None:
+        continue
+
+      allUsedArrayNames = set()
+      for userArrayNames in users.values():
+        allUsedArrayNames.update(userArrayNames)
+      pointData = userModelNode.GetPolyData().GetPointData()
+      for arrayIndex in reversed(range(pointData.GetNumberOfArrays())):
+        arrayName = pointData.GetArrayName(arrayIndex)
+        if arrayName and arrayName.startswith(self.COST_FUNCTION_ARRAY_PREFIX) and not arrayName in allUsedArrayNames:
+          pointData.RemoveArray(arrayName)
+          self.costFunctionArrayCache.pop((userModelNodeID, arrayName), None)
+      if not users:
+        del self.costFunctionArrayUsers[userModelNodeID]
+
+  def removeAllCostFunctionArrays(self):
+    """
+    Remove the cost function arrays from all of the models. The arrays are computed again by
+    updateInputMarkupSurfaceCostFunction.
+    """
+    for modelNodeID in list(self.costFunctionArrayUsers.keys()):
+      modelNode = slicer.mrmlScene.GetNodeByID(modelNodeID)
+      if modelNode is None or modelNode.GetPolyData() is None:
+        continue
+      pointData = modelNode.GetPolyData().GetPointData()
+      for arrayIndex in reversed(range(pointData.GetNumberOfArrays())):
+        arrayName = pointData.GetArrayName(arrayIndex)
+        if arrayName and arrayName.startswith(self.COST_FUNCTION_ARRAY_PREFIX):
+          pointData.RemoveArray(arrayName)
+          self.costFunctionArrayCache.pop((modelNodeID, arrayName), None)
+
+  def onSceneStartSave(self, caller=None, eventId=None):
+    self.removeAllCostFunctionArrays()
+
+  def onSceneEndSave(self, caller=None, eventId=None):
+    parameterNodeIDs = set()
+    for users in self.costFunctionArrayUsers.values():
+      parameterNodeIDs.update(users.keys())
+    for parameterNodeID in parameterNodeIDs:
+      parameterNode = slicer.mrmlScene.GetNodeByID(parameterNodeID) if parameterNodeID else None
+      if parameterNode:
+        self.updateInputMarkupSurfaceCostFunction(parameterNode)
 
   def updateAllModelViews(self, parameterNode):
     if parameterNode is None:
@@ -372,14 +612,14 @@ class NeuroSegmentParcellationLogic(ScriptedLoadableModuleLogic, VTKObservationM
         inputMarkupNode.SetAttribute(self.NODE_TYPE_ATTRIBUTE_NAME, self.ORIG_NODE_ATTRIBUTE_VALUE)
         self.onMarkupLockStateModified(inputMarkupNode)
 
-        pialControlPoints = self.getDerivedControlPointsNode(inputMarkupNode, self.PIAL_NODE_ATTRIBUTE_VALUE)
+        pialControlPoints = self.getDerivedControlPointsNode(inputMarkupNode, self.PIAL_NODE_ATTRIBUTE_VALUE, False)
         if pialControlPoints:
           tag = pialControlPoints.AddObserver(slicer.vtkMRMLMarkupsNode.PointModifiedEvent, self.onDerivedControlPointsModified)
           self.inputMarkupObservers.append((pialControlPoints, tag))
           tag = pialControlPoints.AddObserver(slicer.vtkMRMLMarkupsNode.PointRemovedEvent, self.onDerivedControlPointsModified)
           self.inputMarkupObservers.append((pialControlPoints, tag))
 
-        inflatedControlPoints = self.getDerivedControlPointsNode(inputMarkupNode, self.INFLATED_NODE_ATTRIBUTE_VALUE)
+        inflatedControlPoints = self.getDerivedControlPointsNode(inputMarkupNode, self.INFLATED_NODE_ATTRIBUTE_VALUE, False)
         if inflatedControlPoints:
           tag = inflatedControlPoints.AddObserver(slicer.vtkMRMLMarkupsNode.PointModifiedEvent, self.onDerivedControlPointsModified)
           self.inputMarkupObservers.append((inflatedControlPoints, tag))
@@ -439,31 +679,37 @@ class NeuroSegmentParcellationLogic(ScriptedLoadableModuleLogic, VTKObservationM
       if not inputMarkupNode.IsA("vtkMRMLMarkupsCurveNode"):
         continue
 
-      pialControlPoints = self.getDerivedControlPointsNode(inputMarkupNode, self.PIAL_NODE_ATTRIBUTE_VALUE)
+      for nodeType in [self.PIAL_NODE_ATTRIBUTE_VALUE, self.INFLATED_NODE_ATTRIBUTE_VALUE]:
+        if not self.isDerivedMarkupVirtual(parameterNode, nodeType):
+          self.materializeDerivedMarkups(inputMarkupNode, nodeType, updateObservers=False)
+
+      pialControlPoints = self.getDerivedControlPointsNode(inputMarkupNode, self.PIAL_NODE_ATTRIBUTE_VALUE, False)
       if pialControlPoints:
         pialControlPoints.CreateDefaultDisplayNodes()
         pialControlPoints.GetDisplayNode().SetViewNodeIDs(pialMarkupViews)
 
-      inflatedControlPoints = self.getDerivedControlPointsNode(inputMarkupNode, self.INFLATED_NODE_ATTRIBUTE_VALUE)
+      inflatedControlPoints = self.getDerivedControlPointsNode(inputMarkupNode, self.INFLATED_NODE_ATTRIBUTE_VALUE, False)
       if inflatedControlPoints:
         inflatedControlPoints.CreateDefaultDisplayNodes()
         inflatedControlPoints.GetDisplayNode().SetViewNodeIDs(inflatedMarkupViews)
 
-      pialCurveNode = self.getDerivedCurveNode(inputMarkupNode, self.PIAL_NODE_ATTRIBUTE_VALUE)
+      pialCurveNode = self.getDerivedCurveNode(inputMarkupNode, self.PIAL_NODE_ATTRIBUTE_VALUE, False)
       if pialCurveNode:
         pialCurveNode.CreateDefaultDisplayNodes()
         pialCurveNode.GetDisplayNode().SetViewNodeIDs(pialMarkupViews)
 
-      inflatedCurveNode = self.getDerivedCurveNode(inputMarkupNode, self.INFLATED_NODE_ATTRIBUTE_VALUE)
+      inflatedCurveNode = self.getDerivedCurveNode(inputMarkupNode, self.INFLATED_NODE_ATTRIBUTE_VALUE, False)
       if inflatedCurveNode:
         inflatedCurveNode.CreateDefaultDisplayNodes()
         inflatedCurveNode.GetDisplayNode().SetViewNodeIDs(inflatedMarkupViews)
 
       currentAndDerivedMarkups = [inputMarkupNode, pialControlPoints, pialCurveNode, inflatedControlPoints, inflatedCurveNode]
       for markupsNode in currentAndDerivedMarkups:
+        if markupsNode is None:
+          continue
         markupsNode.GetDisplayNode().SetPropertiesLabelVisibility(labelVisibility)
 
-      controlPointMarkups = [inputMarkupNode, pialControlPoints, inflatedControlPoints]
+      controlPointMarkups = [markupsNode for markupsNode in [inputMarkupNode, pialControlPoints, inflatedControlPoints] if markupsNode]
 
       numberOfToolNodes = parameterNode.GetNumberOfNodeReferences(self.TOOL_NODE_REFERENCE)
       for i in range(numberOfToolNodes):
@@ -478,6 +724,35 @@ class NeuroSegmentParcellationLogic(ScriptedLoadableModuleLogic, VTKObservationM
           for i in range(markupsNode.GetNumberOfControlPoints()):
             markupsNode.SetNthControlPointVisibility(i, controlPointlVisibility)
 
+    self.updateDerivedMarkupsDisplay(parameterNode)
+
+  def updateDerivedMarkupsDisplay(self, parameterNode):
+    """
+    Update the views in which the derived markups that are not materialized as nodes are displayed.
+    """
+    if parameterNode is None:
+      return
+
+    derivedMarkupsDisplayManager = slicer.derivedMarkupsDisplayManager
+    derivedMarkupsDisplayManager.setControlPointVisibility(self.getControlPointVisibility())
+    derivedMarkupsDisplayManager.setCurveNodes(self.getInputMarkupNodes(parameterNode))
+    for nodeType in [self.PIAL_NODE_ATTRIBUTE_VALUE, self.INFLATED_NODE_ATTRIBUTE_VALUE]:
+      viewIDs = []
+      if self.isDerivedMarkupVirtual(parameterNode, nodeType):
+        viewIDs = self.getMarkupViewIDs(parameterNode, nodeType)
+      derivedMarkupsDisplayManager.setNodeTypeViewIDs(nodeType, viewIDs)
+
+  def getOrigPointIds(self, origModel, points):
+    """
+    Returns the IDs of the orig surface points closest to each of the points.
+    """
+    pointIds = []
+    for i in range(points.GetNumberOfPoints()):
+      origPointLocal = list(points.GetPoint(i))
+      origModel.TransformPointFromWorld(origPointLocal, origPointLocal)
+      pointIds.append(self.origPointLocator.FindClosestPoint(origPointLocal))
+    return pointIds
+
   def onMasterMarkupModified(self, inputMarkupNode, eventId=None, callData=None):
     if self.updatingFromMasterMarkup or self.parameterNode is None:
       return
@@ -499,64 +774,30 @@ class NeuroSegmentParcellationLogic(ScriptedLoadableModuleLogic, VTKObservationM
       wasUpdatingFromMasterMarkup = self.updatingFromMasterMarkup
       self.updatingFromMasterMarkup = True
 
-      pointIds = []
-      for i in range(curvePoints.GetNumberOfPoints()):
-        origPointLocal = list(curvePoints.GetPoint(i))
-        origModel.TransformPointFromWorld(origPointLocal, origPointLocal)
-        pointIds.append(self.origPointLocator.FindClosestPoint(origPointLocal))
-
-      pialMarkup = self.getDerivedCurveNode(inputMarkupNode, self.PIAL_NODE_ATTRIBUTE_VALUE)
-      if pialMarkup:
-        with slicer.util.NodeModify(pialMarkup):
-          pialModel = self.parameterNode.GetNodeReference(self.PIAL_MODEL_REFERENCE)
-          if pialModel and pialModel.GetPolyData() and pialModel.GetPolyData().GetPoints():
-            pialPoints = vtk.vtkPoints()
-            pointIndex = 0
-            pialPoints.SetNumberOfPoints(len(pointIds))
-            for pointId in pointIds:
-              if pointId >= pialModel.GetPolyData().GetNumberOfPoints():
-                logging.warning(f"onMasterMarkupModified: Pial input point out of range ({pointId})")
-                continue
-              pialPoint = list(pialModel.GetPolyData().GetPoints().GetPoint(pointId))
-              pialModel.TransformPointToWorld(pialPoint, pialPoint)
-              pialPoints.SetPoint(pointIndex, pialPoint)
-              pointIndex += 1
-            pialMarkup.SetControlPointPositionsWorld(pialPoints)
-            for pointIndex in range(len(pointIds)):
-              pialMarkup.SetNthControlPointVisibility(pointIndex, False)
-
-      inflatedMarkup = self.getDerivedCurveNode(inputMarkupNode, self.INFLATED_NODE_ATTRIBUTE_VALUE)
-      if inflatedMarkup:
-        with slicer.util.NodeModify(inflatedMarkup):
-          inflatedModel = self.parameterNode.GetNodeReference(self.INFLATED_MODEL_REFERENCE)
-          if inflatedModel and inflatedModel.GetPolyData() and inflatedModel.GetPolyData().GetPoints():
-            inflatedPoints = vtk.vtkPoints()
-            inflatedPoints.SetNumberOfPoints(len(pointIds))
-            pointIndex = 0
-            for pointId in pointIds:
-              if pointId >= inflatedModel.GetPolyData().GetNumberOfPoints():
-                logging.warning(f"onMasterMarkupModified: Inflated input point out of range ({pointId})")
-                continue
-              inflatedPoint = list(inflatedModel.GetPolyData().GetPoints().GetPoint(pointId))
-              inflatedModel.TransformPointToWorld(inflatedPoint, inflatedPoint)
-              inflatedPoints.SetPoint(pointIndex, inflatedPoint)
-              pointIndex += 1
-            inflatedMarkup.SetControlPointPositionsWorld(inflatedPoints)
-            for pointIndex in range(len(pointIds)):
-              inflatedMarkup.SetNthControlPointVisibility(pointIndex, False)
+      pointIds = self.getOrigPointIds(origModel, curvePoints)
 
-      if not self.updatingFromDerivedMarkup:
-        pialControlPoints = self.getDerivedControlPointsNode(inputMarkupNode, self.PIAL_NODE_ATTRIBUTE_VALUE)
-        if pialControlPoints is None:
-          logging.error("Could not find pial markup!")
-        else:
-          self.copyControlPoints(inputMarkupNode, origModel, self.origPointLocator, pialControlPoints, pialModel)
+      pialModel = self.parameterNode.GetNodeReference(self.PIAL_MODEL_REFERENCE)
+      inflatedModel = self.parameterNode.GetNodeReference(self.INFLATED_MODEL_REFERENCE)
+      derivedSurfaces = [(pialModel, self.PIAL_NODE_ATTRIBUTE_VALUE), (inflatedModel, self.INFLATED_NODE_ATTRIBUTE_VALUE)]
+      for derivedModel, nodeType in derivedSurfaces:
+        # Virtual derived markups are displayed by the derived markups display manager
+        derivedMarkup = self.getDerivedCurveNode(inputMarkupNode, nodeType, not self.isDerivedMarkupVirtual(self.parameterNode, nodeType))
+        if derivedMarkup is None:
+          continue
+        derivedPoints = self.getCorrespondingPointsWorld(self.parameterNode, origModel, pointIds, derivedModel)
+        if derivedPoints is None:
+          continue
+        with slicer.util.NodeModify(derivedMarkup):
+          derivedMarkup.SetControlPointPositionsWorld(derivedPoints)
+          for pointIndex in range(len(pointIds)):
+            derivedMarkup.SetNthControlPointVisibility(pointIndex, False)
 
-        inflatedControlPoints = self.getDerivedControlPointsNode(inputMarkupNode, self.INFLATED_NODE_ATTRIBUTE_VALUE)
-        if inflatedControlPoints is None:
-          logging.error("Could not find inflated markup!")
-        else:
-          self.copyControlPoints(inputMarkupNode, origModel, self.origPointLocator, inflatedControlPoints, inflatedModel)
+      if not self.updatingFromDerivedMarkup:
+        for derivedModel, nodeType in derivedSurfaces:
+          derivedControlPoints = self.getDerivedControlPointsNode(inputMarkupNode, nodeType, not self.isDerivedMarkupVirtual(self.parameterNode, nodeType))
+          if derivedControlPoints is None:
+            continue
+          self.copyControlPoints(inputMarkupNode, origModel, self.origPointLocator, derivedControlPoints, derivedModel)
 
     finally:
       self.updatingFromMasterMarkup = wasUpdatingFromMasterMarkup
@@ -593,25 +834,47 @@ class NeuroSegmentParcellationLogic(ScriptedLoadableModuleLogic, VTKObservationM
       seedNode.SetNthControlPointPosition(i, controlPoint[0], controlPoint[1], controlPoint[2])
 
   def copyControlPoints(self, sourceMarkup, sourceModel, sourceLocator, destinationMarkup, destinationModel, copyUndefinedControlPoints=True):
+    """
+    Copy the control points of the source markup to the corresponding points on the destination surface.
+    :param copyUndefinedControlPoints: If False, only the control points of the source with a defined position are
+      copied. Each copied control point is written to the same index in the destination markup, and the other control
+      points of the destination markup are not modified.
+    """
     if sourceMarkup is None or sourceModel is None or destinationMarkup is None or destinationModel is None:
       return
     if destinationModel and destinationModel.GetPolyData() and destinationModel.GetPolyData().GetPoints():
-      with slicer.util.NodeModify(destinationModel):
-        destinationControlPoints_World = vtk.vtkPoints()
-        destinationControlPoints_World.SetNumberOfPoints(sourceMarkup.GetNumberOfControlPoints())
-        destinationMarkup.RemoveAllControlPoints()
-        for i in range(sourceMarkup.GetNumberOfControlPoints()):
-          if not copyUndefinedControlPoints and sourceMarkup.GetNthControlPointPositionStatus(i) != sourceMarkup.PositionDefined:
-            continue
-          sourcePoint = [0,0,0]
-          sourceMarkup.GetNthControlPointPositionWorld(i, sourcePoint)
-          sourceModel.TransformPointFromWorld(sourcePoint, sourcePoint)
-          pointId = sourceLocator.FindClosestPoint(sourcePoint)
-          destinationPoint_World = list(destinationModel.GetPolyData().GetPoints().GetPoint(pointId))
-          destinationModel.TransformPointToWorld(destinationPoint_World, destinationPoint_World)
-
-          destinationControlPoints_World.SetPoint(i, destinationPoint_World)
-        destinationMarkup.SetControlPointPositionsWorld(destinationControlPoints_World)
+      sourceIndices = []
+      sourcePointIds = []
+      for i in range(sourceMarkup.GetNumberOfControlPoints()):
+        if not copyUndefinedControlPoints and sourceMarkup.GetNthControlPointPositionStatus(i) != sourceMarkup.PositionDefined:
+          continue
+        sourcePoint = [0,0,0]
+        sourceMarkup.GetNthControlPointPositionWorld(i, sourcePoint)
+        sourceModel.TransformPointFromWorld(sourcePoint, sourcePoint)
+        sourceIndices.append(i)
+        sourcePointIds.append(sourceLocator.FindClosestPoint(sourcePoint))
+
+      destinationControlPoints_World = self.getCorrespondingPointsWorld(self.parameterNode, sourceModel, sourcePointIds, destinationModel)
+      if destinationControlPoints_World is None:
+        return
+      numberOfControlPoints = sourceMarkup.GetNumberOfControlPoints()
+      with slicer.util.NodeModify(destinationMarkup):
+        if copyUndefinedControlPoints:
+          destinationMarkup.RemoveAllControlPoints()
+          destinationMarkup.SetControlPointPositionsWorld(destinationControlPoints_World)
+          return
+
+        while destinationMarkup.GetNumberOfControlPoints() > numberOfControlPoints:
+          destinationMarkup.RemoveNthControlPoint(destinationMarkup.GetNumberOfControlPoints() - 1)
+        while destinationMarkup.GetNumberOfControlPoints() < numberOfControlPoints:
+          # Control points that were not copied have the same position status as in the source
+          controlPointIndex = destinationMarkup.AddControlPoint(vtk.vtkVector3d(0, 0, 0))
+          positionStatus = sourceMarkup.GetNthControlPointPositionStatus(controlPointIndex)
+          destinationMarkup.SetNthControlPointPosition(controlPointIndex, 0, 0, 0, positionStatus)
+        for pointIndex, controlPointIndex in enumerate(sourceIndices):
+          destinationPoint_World = destinationControlPoints_World.GetPoint(pointIndex)
+          destinationMarkup.SetNthControlPointPositionWorld(controlPointIndex,
+            destinationPoint_World[0], destinationPoint_World[1], destinationPoint_World[2])
 
   def onDerivedControlPointsModified(self, derivedMarkupNode, eventId=None, node=None):
     if self.updatingFromMasterMarkup or self.updatingFromDerivedMarkup:
@@ -634,13 +897,13 @@ class NeuroSegmentParcellationLogic(ScriptedLoadableModuleLogic, VTKObservationM
         locator = self.pialPointLocator
         derivedModelNode = self.parameterNode.GetNodeReference(self.PIAL_MODEL_REFERENCE)
 
-        otherMarkupNode = self.getDerivedControlPointsNode(origMarkup, self.INFLATED_NODE_ATTRIBUTE_VALUE)
+        otherMarkupNode = self.getDerivedControlPointsNode(origMarkup, self.INFLATED_NODE_ATTRIBUTE_VALUE, False)
         otherModelNode = self.parameterNode.GetNodeReference(self.INFLATED_MODEL_REFERENCE)
       elif nodeType == self.INFLATED_NODE_ATTRIBUTE_VALUE:
         locator = self.inflatedPointLocator
         derivedModelNode = self.parameterNode.GetNodeReference(self.INFLATED_MODEL_REFERENCE)
 
-        otherMarkupNode = self.getDerivedControlPointsNode(origMarkup, self.PIAL_NODE_ATTRIBUTE_VALUE)
+        otherMarkupNode = self.getDerivedControlPointsNode(origMarkup, self.PIAL_NODE_ATTRIBUTE_VALUE, False)
         otherModelNode = self.parameterNode.GetNodeReference(self.PIAL_MODEL_REFERENCE)
       if locator == None or derivedModelNode == None:
         self.updatingFromDerivedMarkup = False
@@ -665,14 +928,14 @@ class NeuroSegmentParcellationLogic(ScriptedLoadableModuleLogic, VTKObservationM
     # TODO: We should be able to reverse engineer where this point should be inserted to be added to the self.ORIG_NODE_ATTRIBUTE_VALUE curve
     return
 
-  def getDerivedCurveNode(self, origMarkupNode, nodeType):
+  def getDerivedCurveNode(self, origMarkupNode, nodeType, create=True):
     if origMarkupNode is None:
       return None
     if not origMarkupNode.IsA("vtkMRMLMarkupsCurveNode"):
       return None
     nodeReference = nodeType+"Curve"
     derivedMarkup = origMarkupNode.GetNodeReference(nodeReference)
-    if derivedMarkup:
+    if derivedMarkup or not create:
       return derivedMarkup
 
     derivedMarkup = slicer.mrmlScene.AddNewNodeByClass(origMarkupNode.GetClassName())
@@ -687,14 +950,14 @@ class NeuroSegmentParcellationLogic(ScriptedLoadableModuleLogic, VTKObservationM
     derivedMarkup.SetNodeReferenceID("OrigMarkup", origMarkupNode.GetID())
     return derivedMarkup
 
-  def getDerivedControlPointsNode(self, origMarkupNode, nodeType):
+  def getDerivedControlPointsNode(self, origMarkupNode, nodeType, create=True):
     if origMarkupNode is None:
       return None
     if not origMarkupNode.IsA("vtkMRMLMarkupsCurveNode"):
       return None
     nodeReference = nodeType+"ControlPoints"
     derivedMarkup = origMarkupNode.GetNodeReference(nodeReference)
-    if derivedMarkup:
+    if derivedMarkup or not create:
       return derivedMarkup
 
     derivedMarkup = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode")
@@ -707,6 +970,109 @@ class NeuroSegmentParcellationLogic(ScriptedLoadableModuleLogic, VTKObservationM
 
     return derivedMarkup
 
+  def getVirtualDerivedMarkups(self, parameterNode):
+    if parameterNode is None:
+      return False
+    return parameterNode.GetParameter(self.VIRTUAL_DERIVED_MARKUPS_NAME) == "TRUE"
+
+  def setVirtualDerivedMarkups(self, parameterNode, virtual):
+    """
+    If virtual derived markups are enabled, the pial and inflated markups are not created as nodes.
+    They are displayed by mapping the orig markups to the surfaces, and are only materialized as nodes when they are
+    needed (see materializeDerivedMarkups). Enabling virtual derived markups removes the existing derived nodes.
+    """
+    if parameterNode is None:
+      return
+    with slicer.util.NodeModify(parameterNode):
+      parameterNode.SetParameter(self.VIRTUAL_DERIVED_MARKUPS_NAME, "TRUE" if virtual else "FALSE")
+      if not virtual:
+        return
+      for inputMarkupNode in self.getInputMarkupNodes(parameterNode):
+        for nodeType in [self.PIAL_NODE_ATTRIBUTE_VALUE, self.INFLATED_NODE_ATTRIBUTE_VALUE]:
+          if self.isDerivedMarkupVirtual(parameterNode, nodeType):
+            self.removeDerivedMarkups(inputMarkupNode, nodeType)
+
+  def isDerivedMarkupVirtual(self, parameterNode, nodeType):
+    """
+    Returns True if the derived markups of the surface type should not be created as nodes.
+    Markups in slice views are displayed by the markups displayable managers, so they always require nodes.
+    """
+    if not self.getVirtualDerivedMarkups(parameterNode):
+      return False
+    return not self.getMarkupSliceViewVisibility(parameterNode, nodeType)
+
+  def materializeDerivedMarkups(self, origMarkupNode, nodeType, updateObservers=True):
+    """
+    Create the derived curve and control points nodes of the markup for the surface type if they do not exist.
+    Derived nodes are required to place or edit control points on the pial or inflated surface.
+    :return: The derived control points node
+    """
+    if origMarkupNode is None or not origMarkupNode.IsA("vtkMRMLMarkupsCurveNode"):
+      return None
+
+    derivedControlPoints = self.getDerivedControlPointsNode(origMarkupNode, nodeType, False)
+    if derivedControlPoints and self.getDerivedCurveNode(origMarkupNode, nodeType, False):
+      return derivedControlPoints
+
+    self.getDerivedCurveNode(origMarkupNode, nodeType)
+    derivedControlPoints = self.getDerivedControlPointsNode(origMarkupNode, nodeType)
+    derivedControlPoints.SetLocked(origMarkupNode.GetLocked())
+    self.onMasterMarkupModified(origMarkupNode)
+    slicer.derivedMarkupsDisplayManager.invalidate()
+    if updateObservers:
+      self.onParameterNodeModified(self.parameterNode)
+    return derivedControlPoints
+
+  def removeDerivedMarkups(self, origMarkupNode, nodeType):
+    """
+    Remove the derived curve and control points nodes of the markup for the surface type.
+    """
+    if origMarkupNode is None:
+      return
+    for nodeReference in [nodeType+"Curve", nodeType+"ControlPoints"]:
+      derivedMarkup = origMarkupNode.GetNodeReference(nodeReference)
+      origMarkupNode.SetNodeReferenceID(nodeReference, None)
+      if derivedMarkup:
+        slicer.mrmlScene.RemoveNode(derivedMarkup)
+    slicer.derivedMarkupsDisplayManager.invalidate()
+
+  def getDerivedMarkupPointsWorld(self, origMarkupNode, nodeType):
+    """
+    Map the curve and control points of the orig markup to the pial or inflated surface.
+    Used to display derived markups that are not materialized as nodes.
+    :return: Tuple containing the curve points and the control points (N x 3 numpy arrays in world coordinates), or
+      None if the derived markup is materialized or the surfaces are not available
+    """
+    if self.parameterNode is None or origMarkupNode is None or origMarkupNode.GetNodeReference(nodeType+"Curve"):
+      return None
+
+    origModel = self.getOrigModelNode(self.parameterNode)
+    derivedModel = None
+    if nodeType == self.PIAL_NODE_ATTRIBUTE_VALUE:
+      derivedModel = self.getPialModelNode(self.parameterNode)
+    elif nodeType == self.INFLATED_NODE_ATTRIBUTE_VALUE:
+      derivedModel = self.getInflatedModelNode(self.parameterNode)
+    if origModel is None or derivedModel is None:
+      return None
+
+    self.updateInputModelPointLocators(self.parameterNode)
+    if self.origPointLocator.GetDataSet() is None:
+      return None
+
+    controlPoints_World = vtk.vtkPoints()
+    origMarkupNode.GetControlPointPositionsWorld(controlPoints_World)
+    derivedPoints = []
+    for points_World in [origMarkupNode.GetCurvePointsWorld(), controlPoints_World]:
+      pointIds = self.getOrigPointIds(origModel, points_World) if points_World else []
+      derivedPoints_World = self.getCorrespondingPointsWorld(self.parameterNode, origModel, pointIds, derivedModel)
+      if derivedPoints_World is None:
+        return None
+      if derivedPoints_World.GetNumberOfPoints() == 0:
+        derivedPoints.append(np.zeros((0, 3)))
+      else:
+        derivedPoints.append(numpy_support.vtk_to_numpy(derivedPoints_World.GetData()))
+    return tuple(derivedPoints)
+
   def setDefaultParameters(self, parameterNode):
     """
     Initialize parameter node with default settings.
@@ -715,6 +1081,7 @@ class NeuroSegmentParcellationLogic(ScriptedLoadableModuleLogic, VTKObservationM
       return
 
     parameterNode.SetParameter(self.CONTROL_POINT_VIIBILITY, str(True))
+    parameterNode.SetParameter(self.VIRTUAL_DERIVED_MARKUPS_NAME, "TRUE")
 
     parameterNode.SetParameter(self.CURVE_VISIBILITY_RED_VIEW, "TRUE")
     parameterNode.SetParameter(self.CURVE_VISIBILITY_GREEN_VIEW, "FALSE")
@@ -745,13 +1112,9 @@ class NeuroSegmentParcellationLogic(ScriptedLoadableModuleLogic, VTKObservationM
       logging.debug("Attempting to parse parcellation string:\n_________________\n{0}\n_________________".format(queryString))
 
       with slicer.util.NodeModify(parameterNode):
-        astNode = ast.parse(queryString)
-        eq = NeuroSegmentParcellationVisitor(self)
-        eq.setParameterNode(parameterNode)
-        parameterNode.RemoveNodeReferenceIDs(self.INPUT_MARKUPS_REFERENCE)
-        parameterNode.RemoveNodeReferenceIDs(self.OUTPUT_MODEL_REFERENCE)
-        parameterNode.RemoveNodeReferenceIDs(self.TOOL_NODE_REFERENCE)
-        eq.visit(astNode)
+        plan = self.queryVisitor.compileQuery(queryString)
+        self.queryVisitor.setParameterNode(parameterNode)
+        self.queryVisitor.applyPlan(plan)
         success = True
 
     except Exception as e:
@@ -898,10 +1261,10 @@ class NeuroSegmentParcellationLogic(ScriptedLoadableModuleLogic, VTKObservationM
       wasUpdatingFromMasterMarkup = self.updatingFromMasterMarkup
       self.updatingFromMasterMarkup = True
 
-      pialControlPoints = self.getDerivedControlPointsNode(markupNode, self.PIAL_NODE_ATTRIBUTE_VALUE)
+      pialControlPoints = self.getDerivedControlPointsNode(markupNode, self.PIAL_NODE_ATTRIBUTE_VALUE, False)
       if pialControlPoints:
         pialControlPoints.SetLocked(markupNode.GetLocked())
-      inflatedControlPoints = self.getDerivedControlPointsNode(markupNode, self.INFLATED_NODE_ATTRIBUTE_VALUE)
+      inflatedControlPoints = self.getDerivedControlPointsNode(markupNode, self.INFLATED_NODE_ATTRIBUTE_VALUE, False)
       if inflatedControlPoints:
         inflatedControlPoints.SetLocked(markupNode.GetLocked())
 
@@ -930,10 +1293,10 @@ class NeuroSegmentParcellationLogic(ScriptedLoadableModuleLogic, VTKObservationM
       self.updatingFromMasterMarkup = True
 
       derivedNodes = [
-        self.getDerivedControlPointsNode(markupNode, self.PIAL_NODE_ATTRIBUTE_VALUE),
-        self.getDerivedCurveNode(markupNode,         self.PIAL_NODE_ATTRIBUTE_VALUE),
-        self.getDerivedControlPointsNode(markupNode, self.INFLATED_NODE_ATTRIBUTE_VALUE),
-        self.getDerivedCurveNode(markupNode,         self.INFLATED_NODE_ATTRIBUTE_VALUE),
+        self.getDerivedControlPointsNode(markupNode, self.PIAL_NODE_ATTRIBUTE_VALUE,     False),
+        self.getDerivedCurveNode(markupNode,         self.PIAL_NODE_ATTRIBUTE_VALUE,     False),
+        self.getDerivedControlPointsNode(markupNode, self.INFLATED_NODE_ATTRIBUTE_VALUE, False),
+        self.getDerivedCurveNode(markupNode,         self.INFLATED_NODE_ATTRIBUTE_VALUE, False),
       ]
 
       for derivedNode in derivedNodes:
@@ -996,6 +1359,9 @@ class NeuroSegmentParcellationLogic(ScriptedLoadableModuleLogic, VTKObservationM
       id = modelNode.GetID()
     parameterNode.SetNodeReferenceID(self.ORIG_MODEL_REFERENCE, id)
     self.initializePedigreeIds(parameterNode)
+    self.updateSharedSurfaceTopology(parameterNode)
+    self.updateSurfaceCorrespondences(parameterNode)
+    self.registerSurfaceFileOverlays(parameterNode)
 
   def getPialModelNode(self, parameterNode):
     """
@@ -1012,6 +1378,9 @@ class NeuroSegmentParcellationLogic(ScriptedLoadableModuleLogic, VTKObservationM
     if modelNode:
       id = modelNode.GetID()
     parameterNode.SetNodeReferenceID(self.PIAL_MODEL_REFERENCE, id)
+    self.updateSharedSurfaceTopology(parameterNode)
+    self.updateSurfaceCorrespondences(parameterNode)
+    self.registerSurfaceFileOverlays(parameterNode)
 
   def getInflatedModelNode(self, parameterNode):
     """
@@ -1028,6 +1397,205 @@ class NeuroSegmentParcellationLogic(ScriptedLoadableModuleLogic, VTKObservationM
     if modelNode:
       id = modelNode.GetID()
     parameterNode.SetNodeReferenceID(self.INFLATED_MODEL_REFERENCE, id)
+    self.updateSharedSurfaceTopology(parameterNode)
+    self.updateSurfaceCorrespondences(parameterNode)
+    self.registerSurfaceFileOverlays(parameterNode)
+
+  def hasSameTopology(self, polyDataA, polyDataB):
+    """
+    Returns True if both polydata have the same number of points and identical polys.
+    """
+    if polyDataA is None or polyDataB is None:
+      return False
+    if polyDataA.GetNumberOfPoints() != polyDataB.GetNumberOfPoints():
+      return False
+    polysA = polyDataA.GetPolys()
+    polysB = polyDataB.GetPolys()
+    if polysA is polysB:
+      return True
+    if polysA.GetNumberOfCells() != polysB.GetNumberOfCells():
+      return False
+    offsetsA = numpy_support.vtk_to_numpy(polysA.GetOffsetsArray())
+    offsetsB = numpy_support.vtk_to_numpy(polysB.GetOffsetsArray())
+    if not np.array_equal(offsetsA, offsetsB):
+      return False
+    connectivityA = numpy_support.vtk_to_numpy(polysA.GetConnectivityArray())
+    connectivityB = numpy_support.vtk_to_numpy(polysB.GetConnectivityArray())
+    return np.array_equal(connectivityA, connectivityB)
+
+  def updateSharedSurfaceTopology(self, parameterNode):
+    """
+    The orig, pial and inflated surfaces generated by FreeSurfer have identical triangles.
+    If the pial or inflated surface has the same topology as the orig surface, replace its polys with the cell array
+    of the orig surface, so that only one copy of the triangles is kept in memory.
+    """
+    origModelNode = self.getOrigModelNode(parameterNode)
+    if origModelNode is None or origModelNode.GetPolyData() is None:
+      return
+    origPolyData = origModelNode.GetPolyData()
+    for modelNode in [self.getPialModelNode(parameterNode), self.getInflatedModelNode(parameterNode)]:
+      if modelNode is None or modelNode.GetPolyData() is None:
+        continue
+      polyData = modelNode.GetPolyData()
+      if polyData.GetPolys() is origPolyData.GetPolys():
+        continue
+      if not self.hasSameTopology(origPolyData, polyData):
+        logging.debug("updateSharedSurfaceTopology: %s topology differs from orig model" % modelNode.GetName())
+        continue
+      polyData.SetPolys(origPolyData.GetPolys())
+
+  def getSurfaceCoordinates(self, modelNode):
+    """
+    Returns a numpy view (N x 3) of the point coordinates of the surface, without copying.
+    Since the orig, pial and inflated surfaces share the same topology, the coordinates are enough to map points
+    between surfaces: point i of one surface corresponds to point i of the others.
+    """
+    if modelNode is None or modelNode.GetPolyData() is None or modelNode.GetPolyData().GetPoints() is None:
+      return None
+    return numpy_support.vtk_to_numpy(modelNode.GetPolyData().GetPoints().GetData())
+
+  def getSurfaceName(self, parameterNode, modelNode):
+    """
+    Returns the name of the surface ("orig", "pial" or "inflated") that the model node is assigned to, or None.
+    """
+    if parameterNode is None or modelNode is None:
+      return None
+    for surfaceName, surfaceModelNode, _ in self.getSubjectCacheSurfaces(parameterNode):
+      if surfaceModelNode is not None and surfaceModelNode.GetID() == modelNode.GetID():
+        return surfaceName
+    return None
+
+  def updateSurfaceCorrespondences(self, parameterNode):
+    """
+    Precompute the point correspondence between each pair of the orig, pial and inflated surfaces.
+    See computeSurfaceCorrespondence.
+    """
+    self.surfaceCorrespondences = {}
+    slicer.derivedMarkupsDisplayManager.invalidate()
+    if parameterNode is None:
+      return
+    surfaces = [(surfaceName, modelNode) for surfaceName, modelNode, _ in self.getSubjectCacheSurfaces(parameterNode)
+      if self.getSurfaceCoordinates(modelNode) is not None]
+    for sourceName, sourceModelNode in surfaces:
+      for destinationName, destinationModelNode in surfaces:
+        if sourceName == destinationName:
+          continue
+        self.surfaceCorrespondences[(sourceName, destinationName)] = self.computeSurfaceCorrespondence(
+          sourceModelNode, destinationModelNode)
+
+  def computeSurfaceCorrespondence(self, sourceModelNode, destinationModelNode):
+    """
+    Compute the mapping from the point IDs of the source surface to the point IDs of the destination surface.
+    Surfaces with the same number of points correspond by point ID, so no table is stored. Otherwise, each source point
+    is mapped to the nearest destination point.
+    :return: Dictionary containing the point ID table ("pointIds", None for identity) and the state of the surface points
+      that the table was computed from
+    """
+    sourcePoints = sourceModelNode.GetPolyData().GetPoints()
+    destinationPoints = destinationModelNode.GetPolyData().GetPoints()
+    correspondence = {
+      "sourceModelNodeID": sourceModelNode.GetID(),
+      "destinationModelNodeID": destinationModelNode.GetID(),
+      "sourcePointsMTime": sourcePoints.GetMTime(),
+      "destinationPointsMTime": destinationPoints.GetMTime(),
+      "numberOfSourcePoints": sourcePoints.GetNumberOfPoints(),
+      "pointIds": None,
+      }
+    if sourcePoints.GetNumberOfPoints() == destinationPoints.GetNumberOfPoints():
+      return correspondence
+
+    logging.warning("computeSurfaceCorrespondence: %s and %s have a different number of points, using nearest points" %
+      (sourceModelNode.GetName(), destinationModelNode.GetName()))
+    correspondence["pointIds"] = self.findClosestPointIds(destinationPoints, sourcePoints)
+    return correspondence
+
+  def findClosestPointIds(self, destinationPoints, sourcePoints):
+    """
+    Find the closest destination point for each of the source points, using a single multi-threaded query.
+    :param destinationPoints: vtkPoints that are searched
+    :param sourcePoints: vtkPoints to find the closest points for
+    :return: numpy array containing the ID of the closest destination point for each source point
+    """
+    pointIdsArrayName = "PointIds"
+    destinationPolyData = vtk.vtkPolyData()
+    destinationPolyData.SetPoints(destinationPoints)
+    pointIdsArray = numpy_support.numpy_to_vtk(np.arange(destinationPoints.GetNumberOfPoints()), deep=True, array_type=vtk.VTK_ID_TYPE)
+    pointIdsArray.SetName(pointIdsArrayName)
+    destinationPolyData.GetPointData().AddArray(pointIdsArray)
+    sourcePolyData = vtk.vtkPolyData()
+    sourcePolyData.SetPoints(sourcePoints)
+
+    # The Voronoi kernel copies the values of the closest destination point
+    pointInterpolator = vtk.vtkPointInterpolator()
+    pointInterpolator.SetInputData(sourcePolyData)
+    pointInterpolator.SetSourceData(destinationPolyData)
+    pointInterpolator.SetKernel(vtk.vtkVoronoiKernel())
+    pointInterpolator.SetLocator(vtk.vtkStaticPointLocator())
+    pointInterpolator.PassPointArraysOff()
+    pointInterpolator.PassCellArraysOff()
+    pointInterpolator.PassFieldArraysOff()
+    pointInterpolator.Update()
+    closestPointIdsArray = pointInterpolator.GetOutput().GetPointData().GetArray(pointIdsArrayName)
+    return numpy_support.vtk_to_numpy(closestPointIdsArray).astype(np.int64)
+
+  def isSurfaceCorrespondenceValid(self, correspondence, sourceModelNode, destinationModelNode):
+    """
+    Returns True if the correspondence was computed from the current points of the surfaces.
+    """
+    if correspondence is None:
+      return False
+    if correspondence["sourceModelNodeID"] != sourceModelNode.GetID():
+      return False
+    if correspondence["destinationModelNodeID"] != destinationModelNode.GetID():
+      return False
+    sourcePoints = sourceModelNode.GetPolyData().GetPoints()
+    destinationPoints = destinationModelNode.GetPolyData().GetPoints()
+    return (correspondence["sourcePointsMTime"] == sourcePoints.GetMTime()
+      and correspondence["destinationPointsMTime"] == destinationPoints.GetMTime()
+      and correspondence["numberOfSourcePoints"] == sourcePoints.GetNumberOfPoints())
+
+  def getSurfaceCorrespondence(self, parameterNode, sourceModelNode, destinationModelNode):
+    """
+    Returns the point correspondence between two of the input surfaces.
+    The correspondence is recomputed if the points of either surface were changed since it was computed.
+    """
+    if self.getSurfaceCoordinates(sourceModelNode) is None or self.getSurfaceCoordinates(destinationModelNode) is None:
+      return None
+    key = (self.getSurfaceName(parameterNode, sourceModelNode), self.getSurfaceName(parameterNode, destinationModelNode))
+    if None in key:
+      logging.error("getSurfaceCorrespondence: Model is not an input surface")
+      return None
+    correspondence = self.surfaceCorrespondences.get(key)
+    if not self.isSurfaceCorrespondenceValid(correspondence, sourceModelNode, destinationModelNode):
+      correspondence = self.computeSurfaceCorrespondence(sourceModelNode, destinationModelNode)
+      self.surfaceCorrespondences[key] = correspondence
+    return correspondence
+
+  def getCorrespondingPointsWorld(self, parameterNode, sourceModelNode, sourcePointIds, destinationModelNode):
+    """
+    Map point IDs of the source surface through the surface correspondence and gather the world positions of the
+    corresponding points on the destination surface.
+    :return: vtkPoints containing one world position for each source point ID, or None if the surfaces are not available
+    """
+    correspondence = self.getSurfaceCorrespondence(parameterNode, sourceModelNode, destinationModelNode)
+    if correspondence is None:
+      return None
+
+    pointsWorld = vtk.vtkPoints()
+    if len(sourcePointIds) == 0:
+      return pointsWorld
+
+    destinationPointIds = np.asarray(sourcePointIds, dtype=np.int64)
+    if correspondence["pointIds"] is not None:
+      destinationPointIds = correspondence["pointIds"][destinationPointIds]
+    destinationCoordinates = self.getSurfaceCoordinates(destinationModelNode)[destinationPointIds]
+
+    pointsLocal = vtk.vtkPoints()
+    pointsLocal.SetData(numpy_support.numpy_to_vtk(destinationCoordinates, deep=True))
+    modelToWorldTransform = vtk.vtkGeneralTransform()
+    slicer.vtkMRMLTransformNode.GetTransformBetweenNodes(destinationModelNode.GetParentTransformNode(), None, modelToWorldTransform)
+    modelToWorldTransform.TransformPoints(pointsLocal, pointsWorld)
+    return pointsWorld
 
   def getNumberOfOutputModels(self):
     if self.parameterNode is None:
@@ -1095,6 +1663,68 @@ class NeuroSegmentParcellationLogic(ScriptedLoadableModuleLogic, VTKObservationM
       scalarOverlays.append(pointData.GetArray(i))
     return scalarOverlays
 
+  def getPointScalarOverlayNames(self, modelNode):
+    """
+    Returns the names of the point scalars in the polydata, and of the registered overlays that have not been loaded yet
+    """
+    overlayNames = [overlay.GetName() for overlay in self.getPointScalarOverlays(modelNode)]
+    # Cost function arrays are internal to the path finding and are not shown as overlays
+    overlayNames = [overlayName for overlayName in overlayNames
+      if overlayName and not overlayName.startswith(self.COST_FUNCTION_ARRAY_PREFIX)]
+    for overlayName in self.overlayCache.getOverlayNames(modelNode):
+      if not overlayName in overlayNames:
+        overlayNames.append(overlayName)
+    return overlayNames
+
+  def requestScalarOverlay(self, modelNode, scalarName):
+    """
+    Ensure that the overlay is loaded in the point data of the model if it was registered using registerScalarOverlays.
+    :return: True if the point scalars are available
+    """
+    return self.overlayCache.requestOverlay(modelNode, scalarName)
+
+  def registerScalarOverlays(self, parameterNode, overlayPaths):
+    """
+    Register FreeSurfer overlay files (ex. lh.curv, lh.sulc, lh.thickness) for the orig, pial and inflated surfaces.
+    The overlays are loaded when they are first displayed or used, and may be unloaded when they haven't been used
+    recently to stay within the memory budget of the overlay cache.
+    """
+    modelNodes = [
+      self.getOrigModelNode(parameterNode),
+      self.getPialModelNode(parameterNode),
+      self.getInflatedModelNode(parameterNode),
+      ]
+    for overlayPath in overlayPaths:
+      self.overlayCache.registerOverlay(modelNodes, overlayPath)
+
+  def registerSurfaceFileOverlays(self, parameterNode):
+    """
+    Register the FreeSurfer overlay files next to the file that the orig surface was loaded from (ex. by the FreeSurfer
+    importer), so that they are available in the overlay cache. Overlays that were already loaded into the point data
+    of the surfaces are shared by the surfaces and may be unloaded to stay within the memory budget.
+    """
+    origModelNode = self.getOrigModelNode(parameterNode)
+    if origModelNode is None or origModelNode.GetStorageNode() is None:
+      return
+    self.registerScalarOverlays(parameterNode, findFreeSurferOverlayPaths(origModelNode.GetStorageNode().GetFileName()))
+
+  def loadFreeSurferSurface(self, path):
+    """
+    Load a FreeSurfer surface file using memory-mapped vertex and face blocks.
+    The FreeSurfer file type attribute is set from the file extension so that the surface is detected by updateModelNodes.
+    :param path: Path to the surface file (ex. lh.orig, lh.pial, lh.inflated)
+    :return: Model node containing the surface
+    """
+    polyData = createFreeSurferSurfacePolyData(path)
+    modelNode = slicer.vtkMRMLModelNode()
+    modelNode.SetName(os.path.basename(path))
+    fileTypeAttributeName = slicer.vtkMRMLFreeSurferModelStorageNode.GetFreeSurferFileTypeAttributeName()
+    modelNode.SetAttribute(fileTypeAttributeName, os.path.splitext(path)[1])
+    modelNode.SetAndObservePolyData(polyData)
+    slicer.mrmlScene.AddNode(modelNode)
+    modelNode.CreateDefaultDisplayNodes()
+    return modelNode
+
   def getScalarOverlay(self, parameterNode):
     if parameterNode is None:
       return ""
@@ -1356,9 +1986,36 @@ class NeuroSegmentParcellationLogic(ScriptedLoadableModuleLogic, VTKObservationM
       return
 
     seedRelativeRole = self.RELATIVE_NODE_REFERENCE + "." + relativeRole
-    seedNode.AddNodeReferenceID(seedRelativeRole, relativeNode.GetID())
+    if not seedNode.HasNodeReferenceID(seedRelativeRole, relativeNode.GetID()):
+      seedNode.AddNodeReferenceID(seedRelativeRole, relativeNode.GetID())
 
-    relativeNode.AddNodeReferenceID(self.RELATIVE_NODE_REFERENCE, seedNode.GetID())
+    if not relativeNode.HasNodeReferenceID(self.RELATIVE_NODE_REFERENCE, seedNode.GetID()):
+      relativeNode.AddNodeReferenceID(self.RELATIVE_NODE_REFERENCE, seedNode.GetID())
+
+  def removeRelativeSeed(self, seedNode, relativeNode, relativeRole):
+    """
+    Remove the relative node of the specified role from the seed node.
+    The reference from the relative node to the seed node is also removed if the seed node doesn't use the relative
+    node for any other role.
+    """
+    if seedNode is None:
+      logging.error("removeRelativeSeed: Invalid seed node")
+      return
+    if relativeNode is None:
+      logging.error("removeRelativeSeed: Invalid relative node")
+      return
+
+    seedRelativeRole = self.RELATIVE_NODE_REFERENCE + "." + relativeRole
+    for i in reversed(range(seedNode.GetNumberOfNodeReferences(seedRelativeRole))):
+      if seedNode.GetNthNodeReferenceID(seedRelativeRole, i) == relativeNode.GetID():
+        seedNode.RemoveNthNodeReferenceID(seedRelativeRole, i)
+
+    for role in self.RELATIVE_SEED_ROLES:
+      if seedNode.HasNodeReferenceID(self.RELATIVE_NODE_REFERENCE + "." + role, relativeNode.GetID()):
+        return
+    for i in reversed(range(relativeNode.GetNumberOfNodeReferences(self.RELATIVE_NODE_REFERENCE))):
+      if relativeNode.GetNthNodeReferenceID(self.RELATIVE_NODE_REFERENCE, i) == seedNode.GetID():
+        relativeNode.RemoveNthNodeReferenceID(self.RELATIVE_NODE_REFERENCE, i)
 
   def getRelativeSeedNodes(self, relativeNode):
     """
@@ -1782,15 +2439,18 @@ class NeuroSegmentParcellationLogic(ScriptedLoadableModuleLogic, VTKObservationM
     origModelNode = self.getOrigModelNode(parameterNode)
     pialModelNode = self.getPialModelNode(parameterNode)
     inflatedModelNode = self.getInflatedModelNode(parameterNode)
+    # The outlines share the same lines. The points are copied, so that the outlines don't change if the surface
+    # points are modified.
+    outlineLines = origOutlinePolyData.GetLines() if origOutlinePolyData.GetNumberOfLines() > 0 else vtk.vtkCellArray()
     modelAndOutlines = [(origModelNode, origOutlineNode), (pialModelNode, pialOutlineNode), (inflatedModelNode, inflatedOutlineNode)]
     for surfaceModelNode, outlineModelNode in modelAndOutlines:
       if not surfaceModelNode or not outlineModelNode:
         continue
       outlinePolyData = vtk.vtkPolyData()
-      outlinePolyData.DeepCopy(origOutlinePolyData)
       points = vtk.vtkPoints()
       points.DeepCopy(surfaceModelNode.GetPolyData().GetPoints())
       outlinePolyData.SetPoints(points)
+      outlinePolyData.SetLines(outlineLines)
       outlinePolyData.GetPointData().AddArray(newLabelArray)
       outlineModelNode.SetAndObservePolyData(outlinePolyData)
       if surfaceModelNode.GetParentTransformNode():
@@ -2002,15 +2662,18 @@ class NeuroSegmentParcellationLogic(ScriptedLoadableModuleLogic, VTKObservationM
 
     pialModelNode = self.getPialModelNode(parameterNode)
     inflatedModelNode = self.getInflatedModelNode(parameterNode)
+    # The intersections share the same lines. The points are copied, so that the intersections don't change if the surface
+    # points are modified.
+    intersectionLines = origIntersectionPolyData.GetLines() if origIntersectionPolyData.GetNumberOfLines() > 0 else vtk.vtkCellArray()
     modelAndIntersections = [(origModelNode, origIntersectionNode), (pialModelNode, pialIntersectionNode), (inflatedModelNode, inflatedIntersectionNode)]
     for surfaceModelNode, intersectionModelNode in modelAndIntersections:
       if not surfaceModelNode or not intersectionModelNode:
         continue
       intersectionPolyData = vtk.vtkPolyData()
-      intersectionPolyData.DeepCopy(origIntersectionPolyData)
       points = vtk.vtkPoints()
       points.DeepCopy(surfaceModelNode.GetPolyData().GetPoints())
       intersectionPolyData.SetPoints(points)
+      intersectionPolyData.SetLines(intersectionLines)
       intersectionModelNode.SetAndObservePolyData(intersectionPolyData)
       if surfaceModelNode.GetParentTransformNode():
         intersectionModelNode.SetAndObserveTransformNodeID(surfaceModelNode.GetParentTransformNode().GetID())
@@ -2120,6 +2783,7 @@ class NeuroSegmentParcellationLogic(ScriptedLoadableModuleLogic, VTKObservationM
     Replaces the contents of the destination node polydata
     """
 
+    self.requestScalarOverlay(overlayModelNode, importOverlay)
     if overlayModelNode and overlayModelNode.GetPolyData() and overlayModelNode.GetPolyData().GetCellData():
       if overlayModelNode.GetPolyData().GetCellData().GetArray(importOverlay):
         self.convertCellDataOverlayToModelNode(overlayModelNode, importOverlay, destinationNode, insideLabelValue)
@@ -2129,3 +2793,679 @@ class NeuroSegmentParcellationLogic(ScriptedLoadableModuleLogic, VTKObservationM
       if overlayModelNode.GetPolyData().GetPointData().GetArray(importOverlay):
         self.convertPointDataOverlayToModelNode(overlayModelNode, importOverlay, destinationNode, insideLabelValue)
         return
+
+  def getSubjectCacheSurfaces(self, parameterNode):
+    return [
+      ("orig", self.getOrigModelNode(parameterNode), self.setOrigModelNode),
+      ("pial", self.getPialModelNode(parameterNode), self.setPialModelNode),
+      ("inflated", self.getInflatedModelNode(parameterNode), self.setInflatedModelNode),
+      ]
+
+  def getTriangleArray(self, polyData):
+    """
+    Returns the triangles of the polydata as an (N x 3) numpy array, or None if the polys are not all triangles.
+    """
+    polys = polyData.GetPolys()
+    offsets = numpy_support.vtk_to_numpy(polys.GetOffsetsArray())
+    if not np.all(np.diff(offsets) == 3):
+      return None
+    connectivity = numpy_support.vtk_to_numpy(polys.GetConnectivityArray())
+    return connectivity.reshape(-1, 3)
+
+  def saveSubjectCache(self, parameterNode, cachePath, inputHash=""):
+    """
+    Write the orig, pial and inflated surfaces to a single binary (.npz) subject cache.
+    The triangle connectivity is shared by the surfaces and is only stored once, followed by the point coordinates
+    and the point and cell data (curv, sulc, pedigree ids, labels, ...) of each surface.
+    Overlays that are registered but not loaded are not stored, so they should be requested before saving.
+    Point locators, cell links and intersections are not stored, since VTK can't restore them from arrays. They are
+    built when they are first used.
+    :param parameterNode: Parameter node referencing the surfaces
+    :param cachePath: Path of the cache file
+    :param inputHash: Hash of the files that the surfaces were read from (see isSubjectCacheValid)
+    :return: True if successful, otherwise false
+    """
+    origModelNode = self.getOrigModelNode(parameterNode)
+    if origModelNode is None or origModelNode.GetPolyData() is None:
+      logging.error("saveSubjectCache: Invalid orig model")
+      return False
+
+    self.initializePedigreeIds(parameterNode)
+
+    triangles = self.getTriangleArray(origModelNode.GetPolyData())
+    if triangles is None:
+      logging.error("saveSubjectCache: Orig model must only contain triangles")
+      return False
+
+    arrays = {
+      "version": np.array(self.SUBJECT_CACHE_VERSION),
+      "inputHash": np.array(inputHash),
+      "triangles": triangles,
+      }
+    metadata = {}
+    for surfaceKey, modelNode, _ in self.getSubjectCacheSurfaces(parameterNode):
+      if modelNode is None or modelNode.GetPolyData() is None:
+        continue
+      polyData = modelNode.GetPolyData()
+      if modelNode != origModelNode:
+        surfaceTriangles = self.getTriangleArray(polyData)
+        if surfaceTriangles is None or not np.array_equal(surfaceTriangles, triangles):
+          logging.error("saveSubjectCache: Topology of %s does not match orig model" % modelNode.GetName())
+          return False
+
+      fileTypeAttributeName = slicer.vtkMRMLFreeSurferModelStorageNode.GetFreeSurferFileTypeAttributeName()
+      surfaceMetadata = {
+        "name": modelNode.GetName(),
+        "fileType": modelNode.GetAttribute(fileTypeAttributeName),
+        "pointData": [],
+        "cellData": [],
+        }
+      arrays[surfaceKey + ".points"] = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())
+      for dataKey, data in [("pointData", polyData.GetPointData()), ("cellData", polyData.GetCellData())]:
+        for i in range(data.GetNumberOfArrays()):
+          dataArray = data.GetArray(i)
+          # Cost function arrays are recomputed from the overlays when they are needed
+          if dataArray is None or (dataArray.GetName() or "").startswith(self.COST_FUNCTION_ARRAY_PREFIX):
+            continue
+          arrays["%s.%s.%d" % (surfaceKey, dataKey, len(surfaceMetadata[dataKey]))] = numpy_support.vtk_to_numpy(dataArray)
+          surfaceMetadata[dataKey].append(dataArray.GetName())
+      metadata[surfaceKey] = surfaceMetadata
+    arrays["metadata"] = np.array(json.dumps(metadata))
+
+    with open(cachePath, "wb") as cacheFile:
+      np.savez(cacheFile, **arrays)
+    return True
+
+  def isSubjectCacheValid(self, cachePath, inputHash=None):
+    """
+    Check if the subject cache exists, and was written by the current version from the same input files.
+    :param cachePath: Path of the cache file
+    :param inputHash: Hash of the input files. If None, the input files are not checked.
+    :return: True if the cache can be loaded
+    """
+    if not cachePath or not os.path.exists(cachePath):
+      return False
+    try:
+      with np.load(cachePath) as cache:
+        if int(cache["version"]) != self.SUBJECT_CACHE_VERSION:
+          return False
+        return inputHash is None or str(cache["inputHash"]) == inputHash
+    except (IOError, OSError, ValueError, KeyError):
+      logging.warning("isSubjectCacheValid: Could not read " + cachePath)
+      return False
+
+  def loadSubjectCache(self, parameterNode, cachePath):
+    """
+    Create the orig, pial and inflated model nodes from a subject cache written by saveSubjectCache, and set
+    them as the input surfaces of the parameter node.
+    The surfaces share a single cell array containing the triangles.
+    :param parameterNode: Parameter node that the surfaces are added to
+    :param cachePath: Path of the cache file
+    :return: True if successful, otherwise false
+    """
+    if parameterNode is None:
+      logging.error("loadSubjectCache: Invalid parameter node")
+      return False
+    if not os.path.exists(cachePath):
+      logging.error("loadSubjectCache: Could not find " + cachePath)
+      return False
+
+    with np.load(cachePath) as cache:
+      if int(cache["version"]) != self.SUBJECT_CACHE_VERSION:
+        logging.error("loadSubjectCache: Unsupported cache version")
+        return False
+      metadata = json.loads(str(cache["metadata"]))
+
+      triangles = cache["triangles"]
+      offsets = np.arange(0, triangles.size + 1, 3, dtype=numpy_support.ID_TYPE_CODE)
+      connectivity = np.ascontiguousarray(triangles.ravel(), dtype=numpy_support.ID_TYPE_CODE)
+      polys = vtk.vtkCellArray()
+      polys.SetData(numpy_support.numpy_to_vtkIdTypeArray(offsets, deep=True),
+        numpy_support.numpy_to_vtkIdTypeArray(connectivity, deep=True))
+
+      fileTypeAttributeName = slicer.vtkMRMLFreeSurferModelStorageNode.GetFreeSurferFileTypeAttributeName()
+      with slicer.util.NodeModify(parameterNode):
+        for surfaceKey, _, setModelNode in self.getSubjectCacheSurfaces(parameterNode):
+          surfaceMetadata = metadata.get(surfaceKey)
+          if surfaceMetadata is None:
+            continue
+
+          points = vtk.vtkPoints()
+          points.SetData(numpy_support.numpy_to_vtk(cache[surfaceKey + ".points"], deep=True))
+          polyData = vtk.vtkPolyData()
+          polyData.SetPoints(points)
+          polyData.SetPolys(polys)
+          for dataKey, data in [("pointData", polyData.GetPointData()), ("cellData", polyData.GetCellData())]:
+            for i, arrayName in enumerate(surfaceMetadata[dataKey]):
+              dataArray = numpy_support.numpy_to_vtk(cache["%s.%s.%d" % (surfaceKey, dataKey, i)], deep=True)
+              dataArray.SetName(arrayName)
+              data.AddArray(dataArray)
+
+          modelNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode", surfaceMetadata["name"])
+          if surfaceMetadata["fileType"]:
+            modelNode.SetAttribute(fileTypeAttributeName, surfaceMetadata["fileType"])
+          modelNode.SetAndObservePolyData(polyData)
+          modelNode.CreateDefaultDisplayNodes()
+          setModelNode(parameterNode, modelNode)
+    return True
+
+  def loadBatchManifest(self, manifestPath):
+    """
+    Read the list of subjects from a batch manifest.
+    The manifest is a json file with the following format. Relative paths are relative to the manifest file.
+    {
+      "query": "parcellation.qry",  # Default query file for all subjects
+      "subjects": [
+        {
+          "name": "subject01",
+          "orig": "subject01/surf/lh.orig",
+          "pial": "subject01/surf/lh.pial",
+          "inflated": "subject01/surf/lh.inflated",
+          "overlays": ["subject01/surf/lh.curv", "subject01/surf/lh.sulc"],  # Optional, defaults to curv and sulc next to the orig surface
+          "markups": ["subject01/markups/CentralSulcus.mrk.json", ...],
+          "query": "subject01/parcellation.qry",  # Optional, overrides the default query
+          "cache": "subject01/surfaces.npz"  # Optional, subject cache that is used instead of the surface files if they haven't changed
+        },
+        ...
+      ]
+    }
+    :param manifestPath: Path to the manifest file
+    :return: List of subject dictionaries with absolute paths
+    """
+    with open(manifestPath, "r") as manifestFile:
+      manifest = json.load(manifestFile)
+
+    manifestDirectory = os.path.dirname(os.path.abspath(manifestPath))
+    def getAbsolutePath(path):
+      if path is None:
+        return None
+      return os.path.normpath(os.path.join(manifestDirectory, path))
+
+    defaultQuery = manifest.get("query")
+    subjects = []
+    for subject in manifest.get("subjects", []):
+      if not "name" in subject:
+        raise ValueError("Subject in manifest is missing a name")
+      batchSubject = {
+        "name": subject["name"],
+        "query": getAbsolutePath(subject.get("query", defaultQuery)),
+        "markups": [getAbsolutePath(path) for path in subject.get("markups", [])],
+        "cache": getAbsolutePath(subject.get("cache")),
+      }
+      for surfaceKey in self.BATCH_SURFACE_KEYS:
+        batchSubject[surfaceKey] = getAbsolutePath(subject.get(surfaceKey))
+      if "overlays" in subject:
+        batchSubject["overlays"] = [getAbsolutePath(path) for path in subject["overlays"]]
+      else:
+        batchSubject["overlays"] = self.getDefaultBatchOverlayPaths(batchSubject["orig"])
+      subjects.append(batchSubject)
+    return subjects
+
+  def getDefaultBatchOverlayPaths(self, origPath):
+    """
+    Returns the paths of the default overlays that exist next to the orig surface (ex. lh.orig -> lh.curv, lh.sulc).
+    """
+    if origPath is None:
+      return []
+    surfaceDirectory = os.path.dirname(origPath)
+    hemisphere = os.path.basename(origPath).split(".")[0]
+    overlayPaths = []
+    for overlayName in self.BATCH_DEFAULT_OVERLAYS:
+      overlayPath = os.path.join(surfaceDirectory, hemisphere + "." + overlayName)
+      if os.path.exists(overlayPath):
+        overlayPaths.append(overlayPath)
+    return overlayPaths
+
+  def getBatchSlicerExecutable(self):
+    """
+    Returns the path of the executable used to start the batch worker processes.
+    """
+    try:
+      launcherPath = slicer.app.launcherExecutableFilePath
+      if launcherPath:
+        return launcherPath
+    except AttributeError:
+      pass
+    return slicer.app.applicationFilePath()
+
+  def runBatch(self, manifestPath, outputDirectory, numberOfWorkers=1, resume=True):
+    """
+    Run the parcellation for all subjects in the manifest.
+    Each subject is processed in a separate Slicer process (see processBatchSubject) and up to numberOfWorkers
+    subjects are processed concurrently. The output, log and results of each subject are written to a directory
+    with the subject name in the output directory, and a summary table is written to the output directory.
+    Can be run from the command line using:
+      Slicer --no-main-window --python-script NeuroSegmentParcellationBatch.py --manifest manifest.json --output outputDirectory --workers 4
+    :param manifestPath: Path to the manifest file (see loadBatchManifest)
+    :param outputDirectory: Directory where the outputs are written
+    :param numberOfWorkers: Maximum number of subjects that are processed at the same time
+    :param resume: If True, subjects and stages that were completed with the same inputs are not processed again
+    :return: List of subject results
+    """
+    subjects = self.loadBatchManifest(manifestPath)
+    if not os.path.exists(outputDirectory):
+      os.makedirs(outputDirectory)
+
+    pendingSubjects = []
+    runningProcesses = []
+    results = {}
+    for subject in subjects:
+      result = None
+      if resume and self.isBatchSubjectComplete(subject, outputDirectory):
+        result = self.readBatchSubjectResult(outputDirectory, subject)
+      if result is None:
+        pendingSubjects.append(subject)
+        continue
+      logging.info("Skipping subject %s, outputs are up to date" % subject["name"])
+      result["skipped"] = True
+      results[subject["name"]] = result
+
+    while pendingSubjects or runningProcesses:
+      while pendingSubjects and len(runningProcesses) < max(1, numberOfWorkers):
+        subject = pendingSubjects.pop(0)
+        runningProcesses.append(self.startBatchWorker(manifestPath, outputDirectory, subject, resume))
+
+      for process, subject, logFile, startTime in list(runningProcesses):
+        if process.poll() is None:
+          continue
+        logFile.close()
+        runningProcesses.remove((process, subject, logFile, startTime))
+        result = self.readBatchSubjectResult(outputDirectory, subject)
+        if result is None:
+          result = {
+            "name": subject["name"],
+            "success": False,
+            "errorMessage": "Worker exited with code %d without writing results" % process.returncode,
+            "stageTimes": {},
+            }
+        elif process.returncode != 0 and result.get("success", False):
+          # The worker crashed or was terminated after the subject was processed
+          result["success"] = False
+          result["errorMessage"] = "Worker exited with code %d" % process.returncode
+        result["elapsedTime"] = time.time() - startTime
+        result["skipped"] = False
+        results[subject["name"]] = result
+        logging.info("Finished subject %s (%s)" % (subject["name"], "success" if result["success"] else "failed"))
+      time.sleep(0.1)
+
+    results = [results[subject["name"]] for subject in subjects]
+    self.writeBatchSummary(outputDirectory, results)
+    return results
+
+  def startBatchWorker(self, manifestPath, outputDirectory, subject, resume=True):
+    """
+    Start a Slicer process that processes the specified subject from the manifest.
+    The standard output and error of the process are written to the log file in the subject output directory.
+    """
+    subjectOutputDirectory = os.path.join(outputDirectory, subject["name"])
+    if not os.path.exists(subjectOutputDirectory):
+      os.makedirs(subjectOutputDirectory)
+
+    # Remove the result of a previous run, so that it is not read if the worker exits without writing a new one
+    resultPath = os.path.join(subjectOutputDirectory, self.BATCH_RESULT_FILE_NAME)
+    if os.path.exists(resultPath):
+      os.remove(resultPath)
+
+    command = [
+      self.getBatchSlicerExecutable(),
+      "--no-splash",
+      "--no-main-window",
+      "--python-script", self.BATCH_SCRIPT_PATH,
+      "--manifest", os.path.abspath(manifestPath),
+      "--output", os.path.abspath(outputDirectory),
+      "--subject", subject["name"],
+      ]
+    if not resume:
+      command.append("--no-resume")
+    logging.info("Starting subject %s" % subject["name"])
+    logFile = open(os.path.join(subjectOutputDirectory, self.BATCH_LOG_FILE_NAME), "w")
+    process = subprocess.Popen(command, stdout=logFile, stderr=subprocess.STDOUT)
+    return (process, subject, logFile, time.time())
+
+  def readBatchSubjectResult(self, outputDirectory, subject):
+    resultPath = os.path.join(outputDirectory, subject["name"], self.BATCH_RESULT_FILE_NAME)
+    if not os.path.exists(resultPath):
+      return None
+    try:
+      with open(resultPath, "r") as resultFile:
+        return json.load(resultFile)
+    except ValueError:
+      logging.error("readBatchSubjectResult: Could not read " + resultPath)
+      return None
+
+  def writeBatchSummary(self, outputDirectory, results):
+    """
+    Write a tab separated summary table with one row for each subject.
+    """
+    summaryPath = os.path.join(outputDirectory, self.BATCH_SUMMARY_FILE_NAME)
+    with open(summaryPath, "w") as summaryFile:
+      summaryFile.write("\t".join(["Subject", "Status", "Time (s)", "Structures", "Log", "Error"]) + "\n")
+      for result in results:
+        status = "success" if result["success"] else "failed"
+        if result.get("skipped", False):
+          status = "skipped"
+        summaryFile.write("\t".join([
+          result["name"],
+          status,
+          "%.1f" % result.get("elapsedTime", 0.0),
+          str(result.get("numberOfStructures", 0)),
+          os.path.join(result["name"], self.BATCH_LOG_FILE_NAME),
+          result.get("errorMessage", "").replace("\t", " ").replace("\n", " "),
+          ]) + "\n")
+    numberOfFailedSubjects = len([result for result in results if not result["success"]])
+    logging.info("Batch finished: %d subjects, %d failed. Summary: %s" % (len(results), numberOfFailedSubjects, summaryPath))
+
+  def getBatchStages(self):
+    """
+    Returns the stages that are run for each subject in order.
+    Each stage is a tuple containing the name, run function and restore function.
+    The run function returns the list of files that were written, relative to the subject output directory.
+    Stages without a restore function only modify the scene, and are run every time the subject is processed.
+    Stages with a restore function are checkpointed, and if they were completed with the same inputs the restore
+    function is used to recreate their results from the written files instead.
+    """
+    return [
+      ("load", self.loadBatchSubject, None),
+      ("pedigree", self.initializeBatchPedigreeIds, None),
+      ("seeds", self.updateBatchSeeds, None),
+      ("cuts", self.runBatchCuts, self.restoreBatchCuts),
+      ("labels", self.exportBatchLabels, self.restoreBatchLabels),
+      ("segmentation", self.exportBatchSegmentation, self.restoreBatchFileOutput),
+      ]
+
+  def processBatchSubject(self, subject, outputDirectory, resume=True):
+    """
+    Run the parcellation for a single subject in the current scene.
+    The scene is cleared, and the following stages are run:
+      load: Load the surfaces, parcellation query and markups.
+      pedigree: Initialize the pedigree ids of the orig surface.
+      seeds: Update the position of the seed points relative to the input markups.
+      cuts: Run the boundary cut tools and write the output structures.
+      labels: Export the output structures to the surface label and write the labeled orig surface.
+      segmentation: Export the output structures to a segmentation and write it.
+    Completed stages are recorded in a checkpoint file in the subject output directory, keyed by the hash of the
+    subject input files. If resume is enabled, checkpointed stages with unchanged inputs are restored instead of run.
+    The result is written to a json file in the subject output directory.
+    :param subject: Subject dictionary (see loadBatchManifest)
+    :param outputDirectory: Directory where the subject outputs are written
+    :param resume: If True, completed stages are restored from the checkpoint
+    :return: Result dictionary
+    """
+    subjectOutputDirectory = os.path.join(outputDirectory, subject["name"])
+    if not os.path.exists(subjectOutputDirectory):
+      os.makedirs(subjectOutputDirectory)
+
+    checkpoint = {"stages": {}}
+    if resume:
+      checkpoint = self.readBatchCheckpoint(subjectOutputDirectory)
+
+    result = {
+      "name": subject["name"],
+      "success": False,
+      "errorMessage": "",
+      "stageTimes": {},
+      "restoredStages": [],
+      }
+    startTime = time.time()
+    currentStage = "load"
+    try:
+      inputHash = self.getBatchSubjectInputHash(subject)
+      # Once a checkpointed stage is run again, the checkpoints of the following stages are no longer valid
+      checkpointValid = True
+      for currentStage, runFunction, restoreFunction in self.getBatchStages():
+        stageKey = self.getBatchStageKey(inputHash, currentStage)
+        stageStartTime = time.time()
+        if restoreFunction and checkpointValid and self.isBatchStageComplete(checkpoint, currentStage, stageKey, subjectOutputDirectory):
+          logging.info("Subject %s: %s (restored from checkpoint)" % (subject["name"], currentStage))
+          restoreFunction(subject, subjectOutputDirectory)
+          result["restoredStages"].append(currentStage)
+        else:
+          logging.info("Subject %s: %s" % (subject["name"], currentStage))
+          if restoreFunction:
+            checkpointValid = False
+          outputs = runFunction(subject, subjectOutputDirectory)
+          checkpoint["stages"][currentStage] = {
+            "key": stageKey,
+            "outputs": outputs or [],
+            "completed": time.time(),
+            }
+          self.writeBatchCheckpoint(subjectOutputDirectory, checkpoint)
+        result["stageTimes"][currentStage] = time.time() - stageStartTime
+      result["numberOfStructures"] = self.getNumberOfOutputModels()
+      result["success"] = True
+    except Exception as e:
+      import traceback
+      traceback.print_exc()
+      result["errorMessage"] = "%s: %s" % (currentStage, str(e))
+      logging.error("Subject %s failed in stage %s" % (subject["name"], result["errorMessage"]))
+    result["elapsedTime"] = time.time() - startTime
+
+    with open(os.path.join(subjectOutputDirectory, self.BATCH_RESULT_FILE_NAME), "w") as resultFile:
+      json.dump(result, resultFile, indent=2)
+    return result
+
+  def getBatchSubjectInputHash(self, subject):
+    """
+    Returns a hash of the contents of all of the input files of the subject.
+    """
+    inputPaths = [subject[surfaceKey] for surfaceKey in self.BATCH_SURFACE_KEYS] + [subject["query"]] + subject["markups"] + subject["overlays"]
+    return self.getBatchFileHash(inputPaths)
+
+  def getBatchSubjectSurfaceHash(self, subject):
+    """
+    Returns a hash of the contents of the surface and overlay files of the subject, which are stored in the subject cache.
+    """
+    inputPaths = [subject[surfaceKey] for surfaceKey in self.BATCH_SURFACE_KEYS] + subject["overlays"]
+    return self.getBatchFileHash(inputPaths)
+
+  def getBatchFileHash(self, inputPaths):
+    """
+    Returns a hash of the contents of the files. Paths that are None are hashed as empty files.
+    """
+    inputHash = hashlib.sha256()
+    inputHash.update(str(self.BATCH_CHECKPOINT_VERSION).encode("utf-8"))
+    for inputPath in inputPaths:
+      inputHash.update(b"\0")
+      if inputPath is None:
+        continue
+      with open(inputPath, "rb") as inputFile:
+        for chunk in iter(lambda: inputFile.read(1 << 20), b""):
+          inputHash.update(chunk)
+    return inputHash.hexdigest()
+
+  def getBatchStageKey(self, inputHash, stageName):
+    return hashlib.sha256((inputHash + ":" + stageName).encode("utf-8")).hexdigest()
+
+  def readBatchCheckpoint(self, subjectOutputDirectory):
+    checkpointPath = os.path.join(subjectOutputDirectory, self.BATCH_CHECKPOINT_FILE_NAME)
+    if not os.path.exists(checkpointPath):
+      return {"stages": {}}
+    try:
+      with open(checkpointPath, "r") as checkpointFile:
+        checkpoint = json.load(checkpointFile)
+    except ValueError:
+      logging.warning("readBatchCheckpoint: Could not read " + checkpointPath)
+      return {"stages": {}}
+    if not "stages" in checkpoint:
+      checkpoint["stages"] = {}
+    return checkpoint
+
+  def writeBatchCheckpoint(self, subjectOutputDirectory, checkpoint):
+    # Write to a temporary file first so that the checkpoint is not corrupted if the process is terminated
+    checkpointPath = os.path.join(subjectOutputDirectory, self.BATCH_CHECKPOINT_FILE_NAME)
+    temporaryCheckpointPath = checkpointPath + ".tmp"
+    with open(temporaryCheckpointPath, "w") as checkpointFile:
+      json.dump(checkpoint, checkpointFile, indent=2)
+    os.replace(temporaryCheckpointPath, checkpointPath)
+
+  def isBatchStageComplete(self, checkpoint, stageName, stageKey, subjectOutputDirectory):
+    stage = checkpoint["stages"].get(stageName)
+    if stage is None or stage.get("key") != stageKey:
+      return False
+    for outputPath in stage.get("outputs", []):
+      if not os.path.exists(os.path.join(subjectOutputDirectory, outputPath)):
+        return False
+    return True
+
+  def isBatchSubjectComplete(self, subject, outputDirectory):
+    """
+    Returns True if all stages of the subject were completed successfully with the current inputs.
+    """
+    subjectOutputDirectory = os.path.join(outputDirectory, subject["name"])
+    result = self.readBatchSubjectResult(outputDirectory, subject)
+    if result is None or not result.get("success", False):
+      return False
+    try:
+      inputHash = self.getBatchSubjectInputHash(subject)
+    except (IOError, OSError):
+      return False
+    checkpoint = self.readBatchCheckpoint(subjectOutputDirectory)
+    for stageName, runFunction, restoreFunction in self.getBatchStages():
+      if not self.isBatchStageComplete(checkpoint, stageName, self.getBatchStageKey(inputHash, stageName), subjectOutputDirectory):
+        return False
+    return True
+
+  def loadBatchSubject(self, subject, subjectOutputDirectory):
+    slicer.mrmlScene.Clear(0)
+    self.parameterNode = None
+    self.queryNodeFileName = subject["query"]
+    parameterNode = self.getParameterNode()
+
+    # The cache is rebuilt if any of the surface or overlay files have changed since it was written
+    cachePath = subject.get("cache")
+    surfaceHash = None
+    cacheLoaded = False
+    if cachePath:
+      surfaceHash = self.getBatchSubjectSurfaceHash(subject)
+      if self.isSubjectCacheValid(cachePath, surfaceHash):
+        if not self.loadSubjectCache(parameterNode, cachePath):
+          raise IOError("Could not load subject cache " + cachePath)
+        cacheLoaded = True
+
+    for surfaceKey in self.BATCH_SURFACE_KEYS:
+      if subject[surfaceKey] is None or cacheLoaded:
+        continue
+      modelNode = self.loadFreeSurferSurface(subject[surfaceKey])
+      if surfaceKey == "orig":
+        self.setOrigModelNode(parameterNode, modelNode)
+      elif surfaceKey == "pial":
+        self.setPialModelNode(parameterNode, modelNode)
+      elif surfaceKey == "inflated":
+        self.setInflatedModelNode(parameterNode, modelNode)
+    if self.getOrigModelNode(parameterNode) is None:
+      raise ValueError("Orig surface is required")
+
+    # Overlays loaded from the cache are already in the point data
+    if not cacheLoaded:
+      self.registerScalarOverlays(parameterNode, subject["overlays"])
+      if cachePath:
+        origModelNode = self.getOrigModelNode(parameterNode)
+        for overlayPath in subject["overlays"]:
+          self.requestScalarOverlay(origModelNode, getFreeSurferOverlayName(overlayPath))
+        self.saveSubjectCache(parameterNode, cachePath, surfaceHash)
+
+    if subject["query"] is None:
+      raise ValueError("Parcellation query is required")
+    with open(subject["query"], "r") as queryFile:
+      queryString = queryFile.read()
+    issues = NeuroSegmentParcellationVisitor(self).validateQuery(queryString)
+    for issue in issues:
+      message = "%s line %s: %s" % (os.path.basename(subject["query"]), issue["lineno"], issue["message"])
+      if issue["severity"] == "error":
+        raise ValueError(message)
+      logging.warning(message)
+    success, errorMessage = self.loadQuery(subject["query"])
+    if not success:
+      raise ValueError("Could not parse query: " + errorMessage)
+
+    # Nodes that can receive control points from the saved markups are the query inputs and the seed nodes
+    destinationNodes = {}
+    for markupNode in self.getInputMarkupNodes(parameterNode):
+      destinationNodes[markupNode.GetName()] = markupNode
+    for toolNode in self.getToolNodes():
+      seedNode = self.getInputSeedNode(toolNode)
+      if seedNode:
+        destinationNodes[seedNode.GetName()] = seedNode
+
+    for markupsPath in subject["markups"]:
+      loadedNode = slicer.util.loadMarkups(markupsPath)
+      if loadedNode is None:
+        raise IOError("Could not load markups " + markupsPath)
+      destinationNode = destinationNodes.get(loadedNode.GetName())
+      if destinationNode is None:
+        logging.warning("Markups %s does not match any node in the query" % loadedNode.GetName())
+      else:
+        self.copyMarkupPoints(loadedNode, destinationNode)
+        if destinationNode.IsA("vtkMRMLMarkupsFiducialNode"):
+          # Saved seed points should not be replaced by the automatically placed seeds
+          destinationNode.SetAttribute(self.MANUALLY_PLACED_ATTRIBUTE_NAME, "TRUE")
+      slicer.mrmlScene.RemoveNode(loadedNode)
+
+  def initializeBatchPedigreeIds(self, subject, subjectOutputDirectory):
+    self.initializePedigreeIds(self.parameterNode)
+
+  def updateBatchSeeds(self, subject, subjectOutputDirectory):
+    for toolNode in self.getToolNodes():
+      self.updateRelativeSeedNode(self.getInputSeedNode(toolNode))
+
+  def runBatchCuts(self, subject, subjectOutputDirectory):
+    for toolNode in self.getToolNodes():
+      self.runDynamicModelerTool(toolNode)
+
+    cutsDirectory = os.path.join(subjectOutputDirectory, self.BATCH_CUTS_DIRECTORY_NAME)
+    if not os.path.exists(cutsDirectory):
+      os.makedirs(cutsDirectory)
+    outputs = []
+    for outputModelNode in self.getOutputModelNodes():
+      outputPath = os.path.join(self.BATCH_CUTS_DIRECTORY_NAME, outputModelNode.GetName() + ".vtp")
+      polyData = outputModelNode.GetPolyData()
+      writer = vtk.vtkXMLPolyDataWriter()
+      writer.SetInputData(polyData if polyData else vtk.vtkPolyData())
+      writer.SetFileName(os.path.join(subjectOutputDirectory, outputPath))
+      if not writer.Write():
+        raise IOError("Could not write " + outputPath)
+      outputs.append(outputPath)
+    return outputs
+
+  def restoreBatchCuts(self, subject, subjectOutputDirectory):
+    for outputModelNode in self.getOutputModelNodes():
+      outputPath = os.path.join(self.BATCH_CUTS_DIRECTORY_NAME, outputModelNode.GetName() + ".vtp")
+      reader = vtk.vtkXMLPolyDataReader()
+      reader.SetFileName(os.path.join(subjectOutputDirectory, outputPath))
+      reader.Update()
+      outputModelNode.SetAndObservePolyData(reader.GetOutput())
+
+  def exportBatchLabels(self, subject, subjectOutputDirectory):
+    self.exportOutputToSurfaceLabel(self.parameterNode)
+    origModelNode = self.getOrigModelNode(self.parameterNode)
+    if not slicer.util.saveNode(origModelNode, os.path.join(subjectOutputDirectory, self.BATCH_LABEL_MODEL_FILE_NAME)):
+      raise IOError("Could not write labeled surface")
+
+    with open(os.path.join(subjectOutputDirectory, self.BATCH_LABEL_TABLE_FILE_NAME), "w") as labelFile:
+      labelFile.write("\t".join(["Label", "Name", "R", "G", "B"]) + "\n")
+      for labelValue, outputModelNode in enumerate(self.getOutputModelNodes(), start=1):
+        color = outputModelNode.GetDisplayNode().GetColor()
+        labelFile.write("\t".join([str(labelValue), outputModelNode.GetName()] + ["%.3f" % c for c in color]) + "\n")
+    return [self.BATCH_LABEL_MODEL_FILE_NAME, self.BATCH_LABEL_TABLE_FILE_NAME]
+
+  def restoreBatchLabels(self, subject, subjectOutputDirectory):
+    # The surface labels are required by the segmentation export
+    self.exportOutputToSurfaceLabel(self.parameterNode)
+
+  def restoreBatchFileOutput(self, subject, subjectOutputDirectory):
+    """
+    Stages that only write files do not modify the scene, and do not need to be restored.
+    """
+    pass
+
+  def exportBatchSegmentation(self, subject, subjectOutputDirectory):
+    if self.getPialModelNode(self.parameterNode) is None:
+      logging.info("Pial surface not specified, segmentation export skipped")
+      return
+    segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode", subject["name"] + "_Segmentation")
+    self.setExportSegmentation(segmentationNode)
+    if not self.exportOutputToSegmentation(self.parameterNode):
+      raise ValueError("Could not export segmentation")
+    if not slicer.util.saveNode(segmentationNode, os.path.join(subjectOutputDirectory, self.BATCH_SEGMENTATION_FILE_NAME)):
+      raise IOError("Could not write segmentation")
+    return [self.BATCH_SEGMENTATION_FILE_NAME]
@@ -1,13 +1,54 @@
-
 import ast
+import bisect
+import collections
+import hashlib
 import vtk, slicer
 import logging
 
+class NeuroSegmentParcellationNodeIndex():
+  """
+  Index of nodes by name or role that supports exact and prefix lookups.
+  Keys are kept sorted so that all keys starting with a prefix can be found with a binary search.
+  """
+
+  def __init__(self):
+    self.nodes = {}
+    self.sortedKeys = []
+
+  def addNode(self, key, node):
+    if not key in self.nodes:
+      bisect.insort(self.sortedKeys, key)
+    self.nodes[key] = node
+
+  def getNode(self, key):
+    """
+    Returns the node with the specified key. If there is no exact match, the node with the shortest key
+    starting with the specified key is returned.
+    """
+    foundNode = self.nodes.get(key)
+    if foundNode:
+      return foundNode
+
+    foundKey = None
+    keyIndex = bisect.bisect_left(self.sortedKeys, key)
+    while keyIndex < len(self.sortedKeys) and self.sortedKeys[keyIndex].startswith(key):
+      if foundKey is None or len(self.sortedKeys[keyIndex]) < len(foundKey):
+        foundKey = self.sortedKeys[keyIndex]
+      keyIndex += 1
+    if foundKey is None:
+      return None
+    return self.nodes[foundKey]
+
 class NeuroSegmentParcellationVisitor(ast.NodeVisitor):
   """
   ast NodeVisitor subclass that parses a query string to create the specified input and output MRML Nodes.
   All input/output/tool nodes are added to the parameter node references, and existing input/output/tool node references are removed.
 
+  The query is first compiled into a plan that describes the inputs, tools, seed constraints and attributes without
+  touching the scene. The most recently used plans of each visitor are cached by the hash of the query string. Applying
+  the plan only creates or modifies the MRML nodes whose state differs from the plan. validateQuery can be used to
+  check a query for errors without accessing the scene.
+
   Basic format uses the following syntax:
     _DistanceWeightingValues = [d, c, h, dc, dh, ch, dch, p] # Weighting for pathfinding (d=distance, c=curvature, h=sulcal height, p=direction)
     _DistanceWeightingPenalties = [c, h, dc, dh, ch, dch] # Penalties applied when c or s are < 0.
@@ -17,10 +58,47 @@ class NeuroSegmentParcellationVisitor(ast.NodeVisitor):
     XYZ = A || B || C # Create a vtkMRMLDynamicModelerNode using the "BoundaryCut" tool, and output vtkMRMLModelNode with the name "XYZ", using markups A, B and C
   """
 
+  # Names of the vtkMRMLMarkupsFreeSurferCurveNode properties set by _DistanceWeightingValues and _DistanceWeightingPenalties
+  WEIGHT_PROPERTY_NAMES = [
+    "DistanceWeight",
+    "CurvatureWeight",
+    "SulcalHeightWeight",
+    "DistanceCurvatureWeight",
+    "DistanceSulcalHeightWeight",
+    "CurvatureSulcalHeightWeight",
+    "DistanceCurvatureSulcalHeightWeight",
+    "DirectionWeight",
+  ]
+  PENALTY_PROPERTY_NAMES = [
+    "CurvaturePenalty",
+    "SulcalHeightPenalty",
+    "DistanceCurvaturePenalty",
+    "DistanceSulcalHeightPenalty",
+    "CurvatureSulcalHeightPenalty",
+    "DistanceCurvatureSulcalHeightPenalty",
+  ]
+
+  # Maximum number of compiled plans that are kept in the plan cache
+  MAXIMUM_NUMBER_OF_CACHED_PLANS = 16
+
   def __init__(self, logic):
     self.parameterNode = None
     self.logic = logic
-    self.currentSeedNode = None
+    # Compiled plans, key is the hash of the query string. Entries are ordered from least to most recently used.
+    self.planCache = collections.OrderedDict()
+    self.plan = None
+    self.currentToolPlan = None
+    self.issues = None
+    self.resetCompileState()
+    self.inputMarkupNodeCache = NeuroSegmentParcellationNodeIndex()
+    self.toolNodeCache = NeuroSegmentParcellationNodeIndex()
+    self.outputModelNodeCache = NeuroSegmentParcellationNodeIndex()
+    self.sceneNodeIndex = None
+
+  def resetCompileState(self):
+    """
+    Reset the pathfinding parameters that are modified by assignments in the query to their default values.
+    """
     self.weights = [
       1.0, # d,
       0,   # c
@@ -39,9 +117,6 @@ class NeuroSegmentParcellationVisitor(ast.NodeVisitor):
       10.0, # ch
       10.0, # dch
     ]
-    self.inputMarkupNodeCache = {}
-    self.toolNodeCache = {}
-    self.outputModelNodeCache = {}
     self.invertScalars = False
 
   def setParameterNode(self, parameterNode):
@@ -49,29 +124,199 @@ class NeuroSegmentParcellationVisitor(ast.NodeVisitor):
     self.inputMarkupNodeCache = self.updateNodeCache(self.logic.INPUT_MARKUPS_REFERENCE)
     self.toolNodeCache = self.updateNodeCache(self.logic.TOOL_NODE_REFERENCE)
     self.outputModelNodeCache = self.updateNodeCache(self.logic.OUTPUT_MODEL_REFERENCE)
+    self.sceneNodeIndex = None
 
   def updateNodeCache(self, referenceRole):
-    nodes = {}
+    nodes = NeuroSegmentParcellationNodeIndex()
     numberOfOutputModelNodes = self.parameterNode.GetNumberOfNodeReferences(referenceRole)
     for i in range(numberOfOutputModelNodes):
       outputModelNode = self.parameterNode.GetNthNodeReference(referenceRole, i)
+      if outputModelNode is None:
+        continue
       role = outputModelNode.GetAttribute(self.logic.PARCELLATION_ROLE_ATTRIBUTE)
       if role:
-        nodes[role] = outputModelNode
+        nodes.addNode(role, outputModelNode)
       else:
-        nodes[outputModelNode.GetName()] = outputModelNode
+        nodes.addNode(outputModelNode.GetName(), outputModelNode)
     return nodes
 
   def getCachedNode(self, nodes, role):
-    foundNode = nodes.get(role)
-    if foundNode:
-      return foundNode
-    # Exact match not found. See if there are any partial matches, and use the shortest one.
-    matches = [key for key in nodes if key.startswith(role)]
-    foundKey = min(matches, key=len, default=None)
-    if not foundKey:
-      return None
-    return nodes[foundKey]      
+    # If an exact match is not found, the partial match with the shortest role is used.
+    return nodes.getNode(role)
+
+  def updateSceneNodeIndex(self):
+    """
+    Index all nodes in the scene by name. Used to find nodes that are referenced in the query, but are not created by it.
+    """
+    self.sceneNodeIndex = {}
+    sceneNodes = slicer.mrmlScene.GetNodes()
+    for i in range(sceneNodes.GetNumberOfItems()):
+      node = sceneNodes.GetItemAsObject(i)
+      self.sceneNodeIndex.setdefault(node.GetName(), []).append(node)
+
+  @staticmethod
+  def getQueryHash(queryString):
+    return hashlib.sha256(queryString.encode("utf-8")).hexdigest()
+
+  def compileQuery(self, queryString):
+    """
+    Compile the query string into a plan, or return the cached plan if the same query has already been compiled.
+    The plan is a dictionary with the following lists:
+      inputs: Input markups. Each entry contains the name, class name, line number, and for curves, the index of the weight group.
+      weightGroups: Path finding parameters. Curves with identical weights, penalties and invert scalars share the same group.
+      tools: Output structures. Each entry contains the name, line number, border input names and seed constraints.
+      attributes: Attribute assignments. Each entry contains the node name, attribute name, value and line number.
+    The returned plan is shared with the cache and should not be modified.
+    :param queryString: Parcellation query string
+    :return: Compiled plan
+    """
+    queryHash = self.getQueryHash(queryString)
+    plan = self.planCache.get(queryHash)
+    if plan is not None:
+      self.planCache.move_to_end(queryHash)
+      return plan
+
+    self.resetCompileState()
+    self.plan = {
+      "hash": queryHash,
+      "inputs": [],
+      "weightGroups": [],
+      "tools": [],
+      "attributes": [],
+    }
+    try:
+      self.visit(ast.parse(queryString))
+      plan = self.plan
+    finally:
+      self.plan = None
+    self.planCache[queryHash] = plan
+    while len(self.planCache) > self.MAXIMUM_NUMBER_OF_CACHED_PLANS:
+      self.planCache.popitem(last=False)
+    return plan
+
+  def validateQuery(self, queryString, knownNames=None):
+    """
+    Check the query string for errors without accessing or modifying the scene.
+    The following issues are reported:
+      Syntax errors, invalid assignments and unknown attributes.
+      Seed placement functions that are not in RELATIVE_SEED_ROLES.
+      References to names that are not defined in the query (or in knownNames).
+      Names that are defined more than once.
+      Output structures that depend on themselves through other output structures.
+      Input markups that are not used by any output structure.
+    :param queryString: Parcellation query string
+    :param knownNames: Optional list of node names that are expected to exist in the scene
+    :return: List of issues sorted by line number. Each issue is a dictionary with "lineno", "severity" ("error" or "warning") and "message".
+    """
+    try:
+      tree = ast.parse(queryString)
+    except SyntaxError as e:
+      return [{"lineno": e.lineno, "severity": "error", "message": "Syntax error: " + str(e.msg)}]
+
+    self.resetCompileState()
+    self.issues = []
+    self.plan = {
+      "hash": self.getQueryHash(queryString),
+      "inputs": [],
+      "weightGroups": [],
+      "tools": [],
+      "attributes": [],
+    }
+    try:
+      # Statements are visited separately, so that an unexpected error is reported for its line and the remaining
+      # statements are still checked
+      for statement in tree.body:
+        try:
+          self.visit(statement)
+        except Exception as e:
+          self.currentToolPlan = None
+          self.reportError(statement.lineno, "Invalid statement in line %d: %s" % (statement.lineno, str(e)))
+      plan = self.plan
+      issues = self.issues
+    finally:
+      self.plan = None
+      self.issues = None
+
+    issues += self.validatePlan(plan, knownNames)
+    issues.sort(key=lambda issue: issue["lineno"] if issue["lineno"] is not None else 0)
+    return issues
+
+  @staticmethod
+  def validatePlan(plan, knownNames=None):
+    """
+    Check the references between the inputs, tools and attributes of a compiled plan.
+    See validateQuery for the issues that are reported.
+    :param plan: Plan returned by compileQuery
+    :param knownNames: Optional list of node names that are expected to exist in the scene
+    :return: List of issues
+    """
+    issues = []
+    def addIssue(lineno, severity, message):
+      issues.append({"lineno": lineno, "severity": severity, "message": message})
+
+    definitionLines = {}
+    for definition in plan["inputs"] + plan["tools"]:
+      name = definition["name"]
+      if name in definitionLines:
+        addIssue(definition["lineno"], "warning", "%s is already defined in line %d" % (name, definitionLines[name]))
+        continue
+      definitionLines[name] = definition["lineno"]
+    knownNames = set(knownNames) if knownNames else set()
+
+    toolNames = set(toolPlan["name"] for toolPlan in plan["tools"])
+    usedNames = set()
+    toolDependencies = {}
+    for toolPlan in plan["tools"]:
+      references = [(name, toolPlan["lineno"]) for name in toolPlan["borders"]]
+      references += [(seedPlan["name"], seedPlan["lineno"]) for seedPlan in toolPlan["seeds"]]
+      dependencies = toolDependencies.setdefault(toolPlan["name"], [])
+      for name, lineno in references:
+        usedNames.add(name)
+        if not name in definitionLines and not name in knownNames:
+          addIssue(lineno, "error", "Unknown reference %s in %s" % (name, toolPlan["name"]))
+        if name in toolNames and not name in dependencies:
+          dependencies.append(name)
+
+    for attributePlan in plan["attributes"]:
+      name = attributePlan["name"]
+      if not name in definitionLines and not name in knownNames:
+        addIssue(attributePlan["lineno"], "error", "Unknown reference %s in %s attribute" % (name, attributePlan["attribute"]))
+
+    # Depth first search for cycles between output structures
+    visitedNames = set()
+    for toolPlan in plan["tools"]:
+      if toolPlan["name"] in visitedNames:
+        continue
+      path = [toolPlan["name"]]
+      stack = [(toolPlan["name"], iter(toolDependencies.get(toolPlan["name"], [])))]
+      while stack:
+        name, dependencies = stack[-1]
+        dependency = next(dependencies, None)
+        if dependency is None:
+          visitedNames.add(name)
+          stack.pop()
+          path.pop()
+        elif dependency in path:
+          cycle = path[path.index(dependency):] + [dependency]
+          addIssue(definitionLines.get(dependency), "error", "Cyclic reference: " + " -> ".join(cycle))
+        elif not dependency in visitedNames:
+          stack.append((dependency, iter(toolDependencies.get(dependency, []))))
+          path.append(dependency)
+
+    for inputPlan in plan["inputs"]:
+      if not inputPlan["name"] in usedNames:
+        addIssue(inputPlan["lineno"], "warning", "Input %s is not used by any output structure" % inputPlan["name"])
+
+    return issues
+
+  def reportError(self, lineno, message):
+    """
+    Record the error if the query is being validated, otherwise log it.
+    """
+    if self.issues is not None:
+      self.issues.append({"lineno": lineno, "severity": "error", "message": message})
+    else:
+      logging.error(message)
 
   def visit_Assign(self, node):
     """
@@ -80,7 +325,7 @@ class NeuroSegmentParcellationVisitor(ast.NodeVisitor):
     """
 
     if len(node.targets) > 1:
-        logging.error("Invalid assignment in line %d" % node.lineno)
+        self.reportError(node.lineno, "Invalid assignment in line %d" % node.lineno)
         return
 
     if 'target' in node._fields:
@@ -94,21 +339,17 @@ class NeuroSegmentParcellationVisitor(ast.NodeVisitor):
       return
 
     if not isinstance(target, ast.Name):
-      logging.error("Invalid assignment in line %d" % node.lineno)
+      self.reportError(node.lineno, "Invalid assignment in line %d" % node.lineno)
       return
 
     if target.id == "_Planes":
       self.process_InputNodes(node.value, "vtkMRMLMarkupsPlaneNode")
       return
     elif target.id == "_Curves":
-      curveNodes = self.process_InputNodes(node.value, "vtkMRMLMarkupsFreeSurferCurveNode")
-      for curveNode in curveNodes:
-        curveNode.SetCurveTypeToShortestDistanceOnSurface()
+      self.process_InputNodes(node.value, "vtkMRMLMarkupsFreeSurferCurveNode")
       return
     elif target.id == "_ClosedCurves":
-      curveNodes = self.process_InputNodes(node.value, "vtkMRMLMarkupsClosedCurveNode")
-      for curveNode in curveNodes:
-        curveNode.SetCurveTypeToShortestDistanceOnSurface()
+      self.process_InputNodes(node.value, "vtkMRMLMarkupsClosedCurveNode")
       return
     elif target.id == "_DistanceWeightingValues":
       self.process_DistanceWeightingValues(node.value)
@@ -117,43 +358,18 @@ class NeuroSegmentParcellationVisitor(ast.NodeVisitor):
       self.process__DistanceWeightingPenalties(node.value)
       return
     elif target.id == "_InvertScalars":
-      self.invertScalars = bool(node.value.value)
+      self.process_InvertScalars(node.value)
       return
 
-    outputModel = self.getCachedNode(self.outputModelNodeCache, target.id)
-    if outputModel is None:
-      outputModel = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode", target.id)
-    outputModel.SetAttribute(self.logic.PARCELLATION_ROLE_ATTRIBUTE, target.id)
-    outputModelDisplayNode = outputModel.GetDisplayNode()
-    if outputModelDisplayNode is None:
-      outputModel.CreateDefaultDisplayNodes()
-      outputModelDisplayNode = outputModel.GetDisplayNode()
-      outputModelDisplayNode.SetVisibility(False)
-    self.parameterNode.AddNodeReferenceID(self.logic.OUTPUT_MODEL_REFERENCE, outputModel.GetID())
-
-    toolNodeRole = outputModel.GetName() + "_BoundaryCut"
-    toolNode = self.getCachedNode(self.toolNodeCache, toolNodeRole)
-    if toolNode is None:
-      toolNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLDynamicModelerNode", toolNodeRole)
-    toolNode.SetAttribute(self.logic.PARCELLATION_ROLE_ATTRIBUTE, toolNodeRole)
-    toolNode.SetToolName(slicer.vtkSlicerDynamicModelerBoundaryCutTool().GetName())
-    toolNode.SetNodeReferenceID(self.logic.BOUNDARY_CUT_OUTPUT_MODEL_REFERENCE, outputModel.GetID())
-
-    inputSeed = toolNode.GetNodeReference(self.logic.MANUALLY_PLACED_ATTRIBUTE_NAME)
-    if inputSeed is None:
-      inputSeed = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", target.id + "_SeedPoints")
-      inputSeed.CreateDefaultDisplayNodes()
-      inputSeed.SetAttribute(self.logic.MANUALLY_PLACED_ATTRIBUTE_NAME, "FALSE")
-    toolNode.SetNodeReferenceID(self.logic.BOUNDARY_CUT_INPUT_SEED_REFERENCE, inputSeed.GetID())
-    self.currentSeedNode = inputSeed
-
-    # Reset border node references
-    toolNode.RemoveNodeReferenceIDs(self.logic.BOUNDARY_CUT_INPUT_BORDER_REFERENCE)
-    nodes = self.visit(node.value)
-    for inputNode in nodes:
-      toolNode.AddNodeReferenceID(self.logic.BOUNDARY_CUT_INPUT_BORDER_REFERENCE, inputNode.GetID())
-    toolNode.ContinuousUpdateOff()
-    self.parameterNode.AddNodeReferenceID(self.logic.TOOL_NODE_REFERENCE, toolNode.GetID())
+    self.currentToolPlan = {
+      "name": target.id,
+      "lineno": node.lineno,
+      "borders": [],
+      "seeds": [],
+    }
+    self.currentToolPlan["borders"] = self.visit(node.value) or []
+    self.plan["tools"].append(self.currentToolPlan)
+    self.currentToolPlan = None
 
   def process_AssignAttribute(self, node):
     """
@@ -166,30 +382,28 @@ class NeuroSegmentParcellationVisitor(ast.NodeVisitor):
     if 'targets' in node._fields:
       target = node.targets[0]
 
+    if not isinstance(target.value, ast.Name):
+      self.reportError(node.lineno, "Invalid attribute assignment in line %d" % node.lineno)
+      return
+
     objectName = target.value.id
     attributeName = target.attr
     if attributeName == "color":
-      displayableNode = slicer.util.getFirstNodeByClassByName("vtkMRMLDisplayableNode", objectName)
-      if not displayableNode:
-        logging.error("process_Attribute: Could not get displayable node: " + str(objectName))
-        return
-      displayNode = displayableNode.GetDisplayNode()
-      if displayNode is None:
-        displayableNode.CreateDefaultDisplayNodes()
-        displayNode = displayableNode.GetDisplayNode()
-      if displayNode is None:
-        logging.error("process_Attribute: Could not get display node for: " + str(objectName))
+      colors = self.evaluateNumberList(node.value, [3], "color")
+      if colors is None:
         return
-
-      colors = [e.n for e in node.value.elts]
       if max(colors) > 1:
         colors[0] /= 255
         colors[1] /= 255
         colors[2] /= 255
-      displayNode.SetColor(colors)
-      displayNode.SetSelectedColor(colors)
+      self.plan["attributes"].append({
+        "name": objectName,
+        "attribute": attributeName,
+        "value": colors,
+        "lineno": node.lineno,
+        })
     else:
-      logging.error("process_Attribute: Unknown attribute: " + str(attributeName))
+      self.reportError(node.lineno, "process_Attribute: Unknown attribute: " + str(attributeName))
       return
 
   def process_InputNodes(self, node, className):
@@ -197,63 +411,94 @@ class NeuroSegmentParcellationVisitor(ast.NodeVisitor):
     Process the creation of many MRML nodes of a specific type, given an ast List node.
     :param node: ast.List representing all of the node names to be created
     :param className: String representing the class of the MRML nodes to be created
-    :return: List of created nodes
+    :return: List of input node names
     """
 
     if not isinstance(node, ast.List):
-      logging.error("Expected list of planes in line %d" % node.lineno)
-      return
+      self.reportError(node.lineno, "Expected list of planes in line %d" % node.lineno)
+      return []
+
+    inputNames = []
+    for element in node.elts:
+      if not isinstance(element, ast.Name):
+        self.reportError(element.lineno, "Expected input name in line %d" % element.lineno)
+        continue
+      name = element.id
+      inputNames.append(name)
+      inputPlan = {
+        "name": name,
+        "className": className,
+        "lineno": element.lineno,
+        "shortestDistanceOnSurface": className != "vtkMRMLMarkupsPlaneNode",
+        }
+      # The distance weighting parameters are based on the current distance weighting function
+      if className == "vtkMRMLMarkupsFreeSurferCurveNode":
+        inputPlan["weightGroup"] = self.addToWeightGroup(name)
+      self.plan["inputs"].append(inputPlan)
+    return inputNames
+
+  def addToWeightGroup(self, inputName):
+    """
+    Add the input to the weight group with the current weights, penalties and invert scalars, creating it if needed.
+    :return: Index of the weight group in the plan
+    """
+    for groupIndex, weightGroup in enumerate(self.plan["weightGroups"]):
+      if (weightGroup["weights"] == self.weights and weightGroup["penalties"] == self.penalties
+          and weightGroup["invertScalars"] == self.invertScalars):
+        weightGroup["inputs"].append(inputName)
+        return groupIndex
+
+    propertyValues = list(zip(self.WEIGHT_PROPERTY_NAMES, self.weights)) + list(zip(self.PENALTY_PROPERTY_NAMES, self.penalties))
+    self.plan["weightGroups"].append({
+      "weights": list(self.weights),
+      "penalties": list(self.penalties),
+      "invertScalars": self.invertScalars,
+      "propertyValues": propertyValues,
+      "inputs": [inputName],
+      })
+    return len(self.plan["weightGroups"]) - 1
+
+  def evaluateNumberList(self, node, expectedLengths, description):
+    """
+    Evaluate a list of numeric literals. Errors are reported instead of raised.
+    :param node: ast node of the assigned value
+    :param expectedLengths: List of the allowed number of elements
+    :param description: Name of the value used in the error message
+    :return: List of floats, or None if the value is invalid
+    """
+    try:
+      values = ast.literal_eval(node)
+      if not isinstance(values, (list, tuple)):
+        raise ValueError()
+      values = [float(e) for e in values]
+    except (ValueError, TypeError, SyntaxError):
+      self.reportError(node.lineno, "Expected list of numbers for %s in line %d" % (description, node.lineno))
+      return None
+    if not len(values) in expectedLengths:
+      self.reportError(node.lineno, "Expected %s values for %s in line %d, found %d" % (
+        " or ".join([str(length) for length in expectedLengths]), description, node.lineno, len(values)))
+      return None
+    return values
 
-    planeNames = [e.id for e in node.elts]
-    inputNodes = []
-    for name in planeNames:
-      inputNode = self.getCachedNode(self.inputMarkupNodeCache, name)
-      if not inputNode:
-        inputNode = slicer.mrmlScene.AddNewNodeByClass(className, name)
-        inputNode.SetAttribute(self.logic.PARCELLATION_ROLE_ATTRIBUTE, name)
-        inputNode.CreateDefaultDisplayNodes()
-        displayNode = inputNode.GetDisplayNode()
-        if displayNode:
-          displayNode.SetGlyphScale(4.0)
-          if className == "vtkMRMLMarkupsPlaneNode":
-            displayNode.HandlesInteractiveOn()
-
-      # Update the distance weighting parameter based on the current distance weighting function
-      if inputNode.IsA("vtkMRMLMarkupsFreeSurferCurveNode"):
-        weightFunctions = [
-          inputNode.SetDistanceWeight,
-          inputNode.SetCurvatureWeight,
-          inputNode.SetSulcalHeightWeight,
-          inputNode.SetDistanceCurvatureWeight,
-          inputNode.SetDistanceSulcalHeightWeight,
-          inputNode.SetCurvatureSulcalHeightWeight,
-          inputNode.SetDistanceCurvatureSulcalHeightWeight,
-          inputNode.SetDirectionWeight
-          ]
-        for i in range(len(weightFunctions)):
-          weightFunctions[i](self.weights[i])
-        penaltyFunctions = [
-          inputNode.SetCurvaturePenalty,
-          inputNode.SetSulcalHeightPenalty,
-          inputNode.SetDistanceCurvaturePenalty,
-          inputNode.SetDistanceSulcalHeightPenalty,
-          inputNode.SetCurvatureSulcalHeightPenalty,
-          inputNode.SetDistanceCurvatureSulcalHeightPenalty
-          ]
-        for i in range(len(penaltyFunctions)):
-          penaltyFunctions[i](self.penalties[i])
-        inputNode.SetInvertScalars(self.invertScalars)
-
-      inputNodes.append(inputNode)
-      self.parameterNode.AddNodeReferenceID(self.logic.INPUT_MARKUPS_REFERENCE, inputNode.GetID())
-    return inputNodes
+  def process_InvertScalars(self, node):
+    """
+    Process the invert scalars flag used for FreeSurfer pathfinding
+    """
+    try:
+      invertScalars = ast.literal_eval(node)
+      if not isinstance(invertScalars, (bool, int, float)):
+        raise ValueError()
+    except (ValueError, TypeError, SyntaxError):
+      self.reportError(node.lineno, "Expected True or False for _InvertScalars in line %d" % node.lineno)
+      return
+    self.invertScalars = bool(invertScalars)
 
   def process_DistanceWeightingValues(self, node):
     """
     Process the distance weighting values used for FreeSurfer pathfinding
     """
-    distanceWeightingValues = [e.n for e in node.elts]
-    if len(distanceWeightingValues) != len(self.weights):
+    distanceWeightingValues = self.evaluateNumberList(node, [len(self.weights)], "_DistanceWeightingValues")
+    if distanceWeightingValues is None:
       return
     self.weights = distanceWeightingValues
 
@@ -261,8 +506,8 @@ class NeuroSegmentParcellationVisitor(ast.NodeVisitor):
     """
     Process the distance weighting penalties used for FreeSurfer pathfinding
     """
-    distanceWeightingPenalties = [e.n for e in node.elts]
-    if len(distanceWeightingPenalties) != len(self.penalties):
+    distanceWeightingPenalties = self.evaluateNumberList(node, [len(self.penalties)], "_DistanceWeightingPenalties")
+    if distanceWeightingPenalties is None:
       return
     self.penalties = distanceWeightingPenalties
 
@@ -272,30 +517,36 @@ class NeuroSegmentParcellationVisitor(ast.NodeVisitor):
     :param node: ast.Name for the current node
     :return: Node name in a simple list, ex: [NodeName]
     """
-    slicerNode = slicer.util.getNode(node.id)
-    return [slicerNode]
+    return [node.id]
 
   def visit_Call(self, node):
     """
-    Not handled currently
+    Seed placement functions (anterior_of, posterior_of, etc.)
     """
-    functionName = node.func.id
+    functionName = node.func.id if isinstance(node.func, ast.Name) else ast.dump(node.func)
     if functionName in self.logic.RELATIVE_SEED_ROLES:
       self.process_SeedPlacement(node)
+    elif self.issues is not None:
+      self.reportError(node.lineno, "Invalid seed placement function %s in line %d" % (functionName, node.lineno))
     else:
       raise Exception("visit_Call: Invalid function name " + functionName)
 
   def process_SeedPlacement(self, node):
-    if self.currentSeedNode is None:
-      logging.error("process_SeedPlacement: Current seed node is invalid")
+    if self.currentToolPlan is None:
+      self.reportError(node.lineno, "process_SeedPlacement: Current seed node is invalid")
+      return
 
-    relativeNodes = []
+    relativeNames = []
     for arg in node.args:
-      relativeNodes += self.visit(arg)
+      relativeNames += self.visit(arg) or []
 
     relativeRole = node.func.id
-    for relativeNode in relativeNodes:
-      self.logic.addRelativeSeed(self.currentSeedNode, relativeNode, relativeRole)
+    for relativeName in relativeNames:
+      self.currentToolPlan["seeds"].append({
+        "role": relativeRole,
+        "name": relativeName,
+        "lineno": node.lineno,
+        })
 
   def visit_BinOp(self, node):
     """
@@ -321,4 +572,182 @@ class NeuroSegmentParcellationVisitor(ast.NodeVisitor):
     """
     Not handled currently
     """
-    logging.error("Unary operator not supported!")
\ No newline at end of file
+    self.reportError(node.lineno, "Unary operator not supported!")
+
+  def applyPlan(self, plan):
+    """
+    Create or update the MRML nodes described by the plan, and update the parameter node references.
+    Nodes and properties that already match the plan are not modified.
+    :param plan: Plan returned by compileQuery
+    """
+    plannedNodes = {}
+
+    inputNodeIDs = []
+    for inputPlan in plan["inputs"]:
+      inputNode = self.applyInputPlan(inputPlan, plan["weightGroups"])
+      plannedNodes[inputPlan["name"]] = inputNode
+      inputNodeIDs.append(inputNode.GetID())
+    self.updateNodeReferenceIDs(self.parameterNode, self.logic.INPUT_MARKUPS_REFERENCE, inputNodeIDs)
+
+    outputModelNodeIDs = []
+    toolNodeIDs = []
+    for toolPlan in plan["tools"]:
+      outputModel, toolNode = self.applyToolPlan(toolPlan, plannedNodes)
+      plannedNodes[toolPlan["name"]] = outputModel
+      outputModelNodeIDs.append(outputModel.GetID())
+      toolNodeIDs.append(toolNode.GetID())
+    self.updateNodeReferenceIDs(self.parameterNode, self.logic.OUTPUT_MODEL_REFERENCE, outputModelNodeIDs)
+    self.updateNodeReferenceIDs(self.parameterNode, self.logic.TOOL_NODE_REFERENCE, toolNodeIDs)
+
+    for attributePlan in plan["attributes"]:
+      self.applyAttributePlan(attributePlan, plannedNodes)
+
+  def updateNodeReferenceIDs(self, node, referenceRole, nodeIDs):
+    """
+    Set the node references for the specified role if they are different from the current references.
+    :return: True if the references were changed
+    """
+    currentNodeIDs = [node.GetNthNodeReferenceID(referenceRole, i) for i in range(node.GetNumberOfNodeReferences(referenceRole))]
+    if currentNodeIDs == nodeIDs:
+      return False
+    node.RemoveNodeReferenceIDs(referenceRole)
+    for nodeID in nodeIDs:
+      node.AddNodeReferenceID(referenceRole, nodeID)
+    return True
+
+  def getPlannedNode(self, plannedNodes, name, className="vtkMRMLNode"):
+    """
+    Returns the node that was created for the name in the plan. If there is no such node, the scene is searched by name.
+    """
+    node = plannedNodes.get(name)
+    if node is not None:
+      return node
+
+    if self.sceneNodeIndex is None:
+      self.updateSceneNodeIndex()
+    for sceneNode in self.sceneNodeIndex.get(name, []):
+      if sceneNode.IsA(className):
+        return sceneNode
+    return None
+
+  def applyInputPlan(self, inputPlan, weightGroups):
+    name = inputPlan["name"]
+    className = inputPlan["className"]
+    inputNode = self.getCachedNode(self.inputMarkupNodeCache, name)
+    if not inputNode:
+      inputNode = slicer.mrmlScene.AddNewNodeByClass(className, name)
+      inputNode.SetAttribute(self.logic.PARCELLATION_ROLE_ATTRIBUTE, name)
+      self.inputMarkupNodeCache.addNode(name, inputNode)
+      inputNode.CreateDefaultDisplayNodes()
+      displayNode = inputNode.GetDisplayNode()
+      if displayNode:
+        displayNode.SetGlyphScale(4.0)
+        if className == "vtkMRMLMarkupsPlaneNode":
+          displayNode.HandlesInteractiveOn()
+
+    if inputPlan["shortestDistanceOnSurface"] and inputNode.IsA("vtkMRMLMarkupsCurveNode"):
+      if inputNode.GetCurveType() != slicer.vtkCurveGenerator.CURVE_TYPE_SHORTEST_DISTANCE_ON_SURFACE:
+        inputNode.SetCurveTypeToShortestDistanceOnSurface()
+
+    # Update the distance weighting parameter based on the current distance weighting function
+    if inputNode.IsA("vtkMRMLMarkupsFreeSurferCurveNode") and "weightGroup" in inputPlan:
+      weightGroup = weightGroups[inputPlan["weightGroup"]]
+      for propertyName, value in weightGroup["propertyValues"]:
+        if getattr(inputNode, "Get" + propertyName)() != value:
+          getattr(inputNode, "Set" + propertyName)(value)
+      if inputNode.GetInvertScalars() != weightGroup["invertScalars"]:
+        inputNode.SetInvertScalars(weightGroup["invertScalars"])
+
+    return inputNode
+
+  def applyToolPlan(self, toolPlan, plannedNodes):
+    name = toolPlan["name"]
+
+    outputModel = self.getCachedNode(self.outputModelNodeCache, name)
+    if outputModel is None:
+      outputModel = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode", name)
+      self.outputModelNodeCache.addNode(name, outputModel)
+    if outputModel.GetAttribute(self.logic.PARCELLATION_ROLE_ATTRIBUTE) != name:
+      outputModel.SetAttribute(self.logic.PARCELLATION_ROLE_ATTRIBUTE, name)
+    outputModelDisplayNode = outputModel.GetDisplayNode()
+    if outputModelDisplayNode is None:
+      outputModel.CreateDefaultDisplayNodes()
+      outputModelDisplayNode = outputModel.GetDisplayNode()
+      outputModelDisplayNode.SetVisibility(False)
+
+    toolNodeRole = outputModel.GetName() + "_BoundaryCut"
+    toolNode = self.getCachedNode(self.toolNodeCache, toolNodeRole)
+    if toolNode is None:
+      toolNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLDynamicModelerNode", toolNodeRole)
+      self.toolNodeCache.addNode(toolNodeRole, toolNode)
+    if toolNode.GetAttribute(self.logic.PARCELLATION_ROLE_ATTRIBUTE) != toolNodeRole:
+      toolNode.SetAttribute(self.logic.PARCELLATION_ROLE_ATTRIBUTE, toolNodeRole)
+    boundaryCutToolName = slicer.vtkSlicerDynamicModelerBoundaryCutTool().GetName()
+    if toolNode.GetToolName() != boundaryCutToolName:
+      toolNode.SetToolName(boundaryCutToolName)
+    if toolNode.GetNodeReferenceID(self.logic.BOUNDARY_CUT_OUTPUT_MODEL_REFERENCE) != outputModel.GetID():
+      toolNode.SetNodeReferenceID(self.logic.BOUNDARY_CUT_OUTPUT_MODEL_REFERENCE, outputModel.GetID())
+
+    inputSeed = toolNode.GetNodeReference(self.logic.BOUNDARY_CUT_INPUT_SEED_REFERENCE)
+    if inputSeed is None:
+      inputSeed = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", name + "_SeedPoints")
+      inputSeed.CreateDefaultDisplayNodes()
+      inputSeed.SetAttribute(self.logic.MANUALLY_PLACED_ATTRIBUTE_NAME, "FALSE")
+      toolNode.SetNodeReferenceID(self.logic.BOUNDARY_CUT_INPUT_SEED_REFERENCE, inputSeed.GetID())
+
+    borderNodeIDs = []
+    for borderName in toolPlan["borders"]:
+      borderNode = self.getPlannedNode(plannedNodes, borderName)
+      if borderNode is None:
+        raise Exception("Could not find node: " + borderName)
+      borderNodeIDs.append(borderNode.GetID())
+    self.updateNodeReferenceIDs(toolNode, self.logic.BOUNDARY_CUT_INPUT_BORDER_REFERENCE, borderNodeIDs)
+
+    for relativeRole in self.logic.RELATIVE_SEED_ROLES:
+      relativeNodes = []
+      for seedPlan in toolPlan["seeds"]:
+        if seedPlan["role"] != relativeRole:
+          continue
+        relativeNode = self.getPlannedNode(plannedNodes, seedPlan["name"])
+        if relativeNode is None:
+          raise Exception("Could not find node: " + seedPlan["name"])
+        if not relativeNode in relativeNodes:
+          relativeNodes.append(relativeNode)
+      previousRelativeNodes = self.logic.getRelativeNodesOfRole(inputSeed, relativeRole)
+      if previousRelativeNodes == relativeNodes:
+        continue
+      for previousRelativeNode in previousRelativeNodes:
+        if previousRelativeNode is not None and not previousRelativeNode in relativeNodes:
+          self.logic.removeRelativeSeed(inputSeed, previousRelativeNode, relativeRole)
+      # Clear the remaining references, so that the relative nodes are added in the order of the plan
+      inputSeed.RemoveNodeReferenceIDs(self.logic.RELATIVE_NODE_REFERENCE + "." + relativeRole)
+      for relativeNode in relativeNodes:
+        self.logic.addRelativeSeed(inputSeed, relativeNode, relativeRole)
+
+    if toolNode.GetContinuousUpdate():
+      toolNode.ContinuousUpdateOff()
+    return outputModel, toolNode
+
+  def applyAttributePlan(self, attributePlan, plannedNodes):
+    objectName = attributePlan["name"]
+    attributeName = attributePlan["attribute"]
+    if attributeName == "color":
+      displayableNode = self.getPlannedNode(plannedNodes, objectName, "vtkMRMLDisplayableNode")
+      if not displayableNode:
+        logging.error("process_Attribute: Could not get displayable node: " + str(objectName))
+        return
+      displayNode = displayableNode.GetDisplayNode()
+      if displayNode is None:
+        displayableNode.CreateDefaultDisplayNodes()
+        displayNode = displayableNode.GetDisplayNode()
+      if displayNode is None:
+        logging.error("process_Attribute: Could not get display node for: " + str(objectName))
+        return
+
+      colors = attributePlan["value"]
+      if list(displayNode.GetColor()) != colors[:3]:
+        displayNode.SetColor(colors)
+      if list(displayNode.GetSelectedColor()) != colors[:3]:
+        displayNode.SetSelectedColor(colors)
+    else:
+      logging.error("process_Attribute: Unknown attribute: " + str(attributeName))
@@ -5,6 +5,8 @@ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
 import numpy as np
+from vtk.util import numpy_support
+from NeuroSegmentParcellationLibs.NeuroSegmentFreeSurferReader import readFreeSurferSurfaceBlocks, createFreeSurferSurfacePolyData
 
 #
 # SurfaceAverage
@@ -19,11 +21,14 @@ class SurfaceAverage(ScriptedLoadableModule):
     ScriptedLoadableModule.__init__(self, parent)
     self.parent.title = "Surface Average"
     self.parent.categories = ["HOA 2", "Neuro Segmentation and Parcellation", "Surface Models"]
-    self.parent.dependencies = []
+    self.parent.dependencies = ["NeuroSegmentParcellation"]
     self.parent.contributors = ["Kyle Sunderland (Perk Lab, Queen's University)"]
     self.parent.helpText = """
 This module takes 2 corresponding FreeSurfer surfaces as input and generates an output surface that is the average of the two.
 The input models must have a 1 to 1 correspence between points.
+Any number of models can be averaged, with optional weights, using SurfaceAverageLogic.processModels().
+Large cohorts can be averaged from FreeSurfer or VTK surface files using SurfaceAverageLogic.processFiles(), which also
+computes the per-vertex standard deviation.
 """
     self.parent.acknowledgementText = """
 This file was originally developed by Kyle Sunderland (Perk Lab, Queen's University), and was partially funded by Brigham and Women's Hospital through NIH grant R01MH112748.
@@ -233,6 +238,9 @@ class SurfaceAverageLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  STANDARD_DEVIATION_ARRAY_NAME = "StandardDeviation"
+  VTK_SURFACE_EXTENSIONS = [".vtk", ".vtp"]
+
   def __init__(self):
     """
     Called when the logic class is instantiated. Can be used for initializing member variables.
@@ -245,52 +253,253 @@ class SurfaceAverageLogic(ScriptedLoadableModuleLogic):
     """
     pass
 
-  def process(self, inputModel1, inputModel2, outputModel):
+  def process(self, inputModel1, inputModel2, outputModel, computeNormals=True):
     """
     Run the processing algorithm.
     Can be used without GUI widget.
     :param inputModel1: Input model to be averaged
     :param inputModel2: Input model to be averaged
     :param outputModel: Result model
+    :param computeNormals: If True, point normals are computed for the output model (see setOutputPolyData)
     """
 
     if not inputModel1 or not inputModel2 or not outputModel:
       raise ValueError("Input or output model is invalid")
 
+    self.processModels([inputModel1, inputModel2], outputModel, computeNormals=computeNormals)
+
+  def processModels(self, inputModels, outputModel, weights=None, computeNormals=True):
+    """
+    Average the points of any number of models that have a 1 to 1 correspondence between points.
+    The output model has the topology and parent transform of the first input model.
+    Can be used without GUI widget.
+    :param inputModels: List of input models to be averaged
+    :param outputModel: Result model
+    :param weights: Weight of each input model (ex. [0.5, 0.5] for a mid-thickness surface). If None, all of the
+      models have the same weight.
+    :param computeNormals: If True, point normals are computed for the output model (see setOutputPolyData)
+    """
+
+    if len(inputModels) == 0 or not outputModel:
+      raise ValueError("Input or output model is invalid")
+    for inputModel in inputModels:
+      if not inputModel or not inputModel.GetPolyData() or not inputModel.GetPolyData().GetPoints():
+        raise ValueError("Input model is invalid")
+
     import time
     startTime = time.time()
     logging.info('Processing started')
 
-    outputPolyData = vtk.vtkPolyData()
-    outputPolyData.DeepCopy(inputModel1.GetPolyData())
+    inputPointArrays = [numpy_support.vtk_to_numpy(inputModel.GetPolyData().GetPoints().GetData()) for inputModel in inputModels]
+    averagePoints = self.averagePointArrays(inputPointArrays, weights)
 
-    inputModel1Points = inputModel1.GetPolyData().GetPoints()
-    inputModel2Points = inputModel2.GetPolyData().GetPoints()
+    outputPolyData = vtk.vtkPolyData()
+    outputPolyData.DeepCopy(inputModels[0].GetPolyData())
     outputPoints = outputPolyData.GetPoints()
-
-    numberOfPoints = outputPoints.GetNumberOfPoints()
-    for i in range(numberOfPoints):
-      model1Point = np.array(inputModel1Points.GetPoint(i))
-      model2Point = np.array(inputModel2Points.GetPoint(i))
-      outputModelPoint = (model1Point + model2Point)/2.0
-      outputPoints.SetPoint(i, outputModelPoint)
-
-    normals = vtk.vtkPolyDataNormals()
-    normals.SetInputData(outputPolyData)
-    normals.SetAutoOrientNormals(False)
-    normals.SetFlipNormals(False)
-    normals.SetSplitting(False)
-    normals.Update()
-    outputModel.SetAndObservePolyData(normals.GetOutput()) 
-    if inputModel1.GetParentTransformNode():
-      outputModel.SetAndObserveTransformNodeID(inputModel1.GetParentTransformNode().GetID())
-    else:
-      outputModel.SetAndObserveTransformNodeID(None)
-    outputModel.CreateDefaultDisplayNodes()   
+    outputPoints.SetData(numpy_support.numpy_to_vtk(averagePoints.astype(inputPointArrays[0].dtype), deep=True))
+    self.setOutputPolyData(outputModel, outputPolyData, inputModels[0].GetParentTransformNode(), computeNormals)
 
     stopTime = time.time()
     logging.info(f'Processing completed in {stopTime-startTime:.2f} seconds')
 
+  def averagePointArrays(self, pointArrays, weights=None):
+    """
+    Compute the weighted average of corresponding point arrays.
+    The arrays are accumulated one at a time, so no stacked copy of all of the inputs is created.
+    :param pointArrays: List of numpy arrays (N x 3) with the same number of points
+    :param weights: Weight of each array. If None, all of the arrays have the same weight.
+    :return: numpy array (N x 3) of the average points in float64
+    """
+    if weights is None:
+      weights = [1.0] * len(pointArrays)
+    if len(weights) != len(pointArrays):
+      raise ValueError("The number of weights must match the number of input models")
+    weightSum = float(np.sum(weights))
+    if weightSum == 0.0:
+      raise ValueError("The sum of the weights must not be zero")
+
+    numberOfPoints = len(pointArrays[0])
+    averagePoints = np.zeros((numberOfPoints, 3), dtype=np.float64)
+    for pointArray, weight in zip(pointArrays, weights):
+      if len(pointArray) != numberOfPoints:
+        raise ValueError("The number of points in the input models must be the same")
+      averagePoints += float(weight) * pointArray
+    averagePoints /= weightSum
+    return averagePoints
+
+  def processFiles(self, inputPaths, outputModel, progressCallback=None, computeNormals=True):
+    """
+    Average surfaces that are read from files one at a time, so that the memory use does not depend on the number of
+    surfaces. The mean and variance of each vertex are accumulated in float64 using Welford's algorithm.
+    The output model has the topology of the first surface, and the standard deviation of each vertex position
+    (square root of the summed variance of the x, y and z coordinates) is added as the STANDARD_DEVIATION_ARRAY_NAME
+    point scalars.
+    Can be used without GUI widget.
+    :param inputPaths: Paths of FreeSurfer surface files (ex. lh.pial) or VTK polydata files (.vtk, .vtp) with a
+      1 to 1 correspondence between points. Coordinates are used as they are stored in the files.
+    :param outputModel: Result model
+    :param progressCallback: Function called with the number of surfaces that were read and the total number of
+      surfaces. If the function returns False, processing is stopped and the output model is not modified.
+    :param computeNormals: If True, point normals are computed for the output model (see setOutputPolyData)
+    :return: True if all of the surfaces were averaged, False if processing was stopped
+    """
+
+    if len(inputPaths) == 0 or not outputModel:
+      raise ValueError("Input paths or output model is invalid")
+
+    import time
+    startTime = time.time()
+    logging.info('Processing started')
+
+    outputPolyData = None
+    count = 0
+    mean = None
+    sumOfSquaredDifferences = None
+    for inputPath in inputPaths:
+      if progressCallback and progressCallback(count, len(inputPaths)) is False:
+        logging.info('Processing stopped')
+        return False
+
+      if outputPolyData is None:
+        outputPolyData = self.readSurfacePolyData(inputPath)
+        points = numpy_support.vtk_to_numpy(outputPolyData.GetPoints().GetData())
+        mean = np.zeros((len(points), 3), dtype=np.float64)
+        sumOfSquaredDifferences = np.zeros(len(points), dtype=np.float64)
+      else:
+        points = self.readSurfacePoints(inputPath)
+      if len(points) != len(mean):
+        raise ValueError(f"The number of points in {inputPath} does not match the first surface")
+
+      count += 1
+      delta = points - mean
+      mean += delta / count
+      sumOfSquaredDifferences += np.sum(delta * (points - mean), axis=1)
+
+    if progressCallback:
+      progressCallback(count, len(inputPaths))
+
+    standardDeviation = np.zeros(len(mean))
+    if count > 1:
+      standardDeviation = np.sqrt(sumOfSquaredDifferences / (count - 1))
+
+    outputPoints = vtk.vtkPoints()
+    outputPoints.SetData(numpy_support.numpy_to_vtk(mean.astype(np.float32), deep=True))
+    outputPolyData.SetPoints(outputPoints)
+    standardDeviationArray = numpy_support.numpy_to_vtk(standardDeviation.astype(np.float32), deep=True)
+    standardDeviationArray.SetName(self.STANDARD_DEVIATION_ARRAY_NAME)
+    outputPolyData.GetPointData().AddArray(standardDeviationArray)
+    self.setOutputPolyData(outputModel, outputPolyData, None, computeNormals)
+
+    stopTime = time.time()
+    logging.info(f'Processing {count} surfaces completed in {stopTime-startTime:.2f} seconds')
+    return True
+
+  def isVTKSurfaceFile(self, path):
+    return os.path.splitext(path)[1].lower() in self.VTK_SURFACE_EXTENSIONS
+
+  def readSurfacePolyData(self, path):
+    """
+    Read the points and polygons of a FreeSurfer or VTK surface file.
+    """
+    if not self.isVTKSurfaceFile(path):
+      return createFreeSurferSurfacePolyData(path)
+
+    if os.path.splitext(path)[1].lower() == ".vtp":
+      reader = vtk.vtkXMLPolyDataReader()
+    else:
+      reader = vtk.vtkPolyDataReader()
+    reader.SetFileName(path)
+    reader.Update()
+    polyData = reader.GetOutput()
+    if polyData.GetPoints() is None:
+      raise ValueError(f"Could not read surface from {path}")
+    return polyData
+
+  def readSurfacePoints(self, path):
+    """
+    Read the points of a FreeSurfer or VTK surface file as a numpy array (N x 3).
+    FreeSurfer surfaces are memory-mapped, so the polygons are not read.
+    """
+    if not self.isVTKSurfaceFile(path):
+      vertices, faces = readFreeSurferSurfaceBlocks(path)
+      return vertices
+    polyData = self.readSurfacePolyData(path)
+    return numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())
+
+  def setOutputPolyData(self, outputModel, outputPolyData, transformNode, computeNormals=True):
+    """
+    Set the polydata of the output model.
+    :param computeNormals: If True, point normals are computed for smooth shading. Normals can be skipped if the output
+      is only used for other computations. Triangle meshes use computeTriangleMeshNormals, other meshes use
+      vtkPolyDataNormals.
+    """
+    # Normals copied from the inputs are not valid for the output points
+    inputNormals = outputPolyData.GetPointData().GetNormals()
+    if inputNormals and inputNormals.GetName():
+      outputPolyData.GetPointData().RemoveArray(inputNormals.GetName())
+    outputPolyData.GetPointData().SetNormals(None)
+    if computeNormals:
+      if self.isTriangleMesh(outputPolyData):
+        points = numpy_support.vtk_to_numpy(outputPolyData.GetPoints().GetData())
+        triangles = numpy_support.vtk_to_numpy(outputPolyData.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+        normalsArray = numpy_support.numpy_to_vtk(self.computeTriangleMeshNormals(points, triangles), deep=True)
+        normalsArray.SetName("Normals")
+        outputPolyData.GetPointData().SetNormals(normalsArray)
+      else:
+        normals = vtk.vtkPolyDataNormals()
+        normals.SetInputData(outputPolyData)
+        normals.SetAutoOrientNormals(False)
+        normals.SetFlipNormals(False)
+        normals.SetSplitting(False)
+        normals.Update()
+        outputPolyData = normals.GetOutput()
+
+    outputModel.SetAndObservePolyData(outputPolyData)
+    if transformNode:
+      outputModel.SetAndObserveTransformNodeID(transformNode.GetID())
+    else:
+      outputModel.SetAndObserveTransformNodeID(None)
+    outputModel.CreateDefaultDisplayNodes()
+
+  def isTriangleMesh(self, polyData):
+    """
+    Returns True if the polydata only contains triangles.
+    """
+    if polyData.GetNumberOfVerts() > 0 or polyData.GetNumberOfLines() > 0 or polyData.GetNumberOfStrips() > 0:
+      return False
+    polys = polyData.GetPolys()
+    if polys.GetNumberOfCells() == 0:
+      return False
+    offsets = numpy_support.vtk_to_numpy(polys.GetOffsetsArray())
+    return bool(np.all(np.diff(offsets) == 3))
+
+  def computeTriangleMeshNormals(self, points, triangles):
+    """
+    Compute the point normals of a triangle mesh, as the normalized sum of the unit normals of the triangles that
+    contain each point (the same as vtkPolyDataNormals without splitting or reordering).
+    The triangle normals are accumulated with array operations, so this scales to meshes with millions of points.
+    :param points: numpy array (N x 3) of the point coordinates
+    :param triangles: numpy array (M x 3) of the point IDs of each triangle
+    :return: numpy array (N x 3) of the point normals in float32
+    """
+    points = np.asarray(points, dtype=np.float64)
+    triangles = np.asarray(triangles, dtype=np.int64)
+    triangleNormals = np.cross(points[triangles[:, 1]] - points[triangles[:, 0]], points[triangles[:, 2]] - points[triangles[:, 0]])
+    triangleNormalLengths = np.linalg.norm(triangleNormals, axis=1)
+    validTriangles = triangleNormalLengths > 0.0
+    triangleNormals[validTriangles] /= triangleNormalLengths[validTriangles, np.newaxis]
+
+    numberOfPoints = len(points)
+    pointNormals = np.zeros((numberOfPoints, 3), dtype=np.float64)
+    for corner in range(3):
+      for axis in range(3):
+        pointNormals[:, axis] += np.bincount(triangles[:, corner], weights=triangleNormals[:, axis], minlength=numberOfPoints)
+
+    pointNormalLengths = np.linalg.norm(pointNormals, axis=1)
+    validPoints = pointNormalLengths > 0.0
+    pointNormals[validPoints] /= pointNormalLengths[validPoints, np.newaxis]
+    return pointNormals.astype(np.float32)
+
 #
 # SurfaceAverageTest
 #
@@ -312,19 +521,96 @@ class SurfaceAverageTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_SurfaceAverage1()
+    self.setUp()
+    self.test_SurfaceAverageWeighted()
+    self.setUp()
+    self.test_SurfaceAverageNormals()
+
+  def createTriangleModel(self, name, points):
+    """
+    Create a model node containing a tetrahedron with the specified points.
+    """
+    vtkPoints = vtk.vtkPoints()
+    for point in points:
+      vtkPoints.InsertNextPoint(point)
+    polys = vtk.vtkCellArray()
+    for triangle in [[0, 2, 1], [0, 1, 3], [0, 3, 2], [1, 2, 3]]:
+      polys.InsertNextCell(3, triangle)
+    polyData = vtk.vtkPolyData()
+    polyData.SetPoints(vtkPoints)
+    polyData.SetPolys(polys)
+    modelNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode", name)
+    modelNode.SetAndObservePolyData(polyData)
+    return modelNode
 
   def test_SurfaceAverage1(self):
-    """ Ideally you should have several levels of tests.  At the lowest level
-    tests should exercise the functionality of the logic with different inputs
-    (both valid and invalid).  At higher levels your tests should emulate the
-    way the user would interact with your code and confirm that it still works
-    the way you intended.
-    One of the most important features of the tests is that it should alert other
-    developers when their changes will have an impact on the behavior of your
-    module.  For example, if a developer removes a feature that you depend on,
-    your test should break so they know that the feature is needed.
+    """
+    Average two small models with the same topology, using the same call as the Apply button.
     """
 
     self.delayDisplay("Starting the test")
 
+    inputPoints1 = np.array([[0, 0, 0], [2, 0, 0], [0, 2, 0], [0, 0, 2]], dtype=np.float32)
+    inputPoints2 = inputPoints1 + np.array([2, 4, 6], dtype=np.float32)
+    inputModel1 = self.createTriangleModel("Input1", inputPoints1)
+    inputModel2 = self.createTriangleModel("Input2", inputPoints2)
+    outputModel = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode", "Output")
+
+    logic = SurfaceAverageLogic()
+    logic.process(inputModel1, inputModel2, outputModel)
+
+    outputPoints = slicer.util.arrayFromModelPoints(outputModel)
+    np.testing.assert_allclose(outputPoints, (inputPoints1 + inputPoints2) / 2.0, atol=1e-6)
+    self.assertEqual(outputModel.GetPolyData().GetNumberOfPolys(), 4)
+
+    with self.assertRaises(ValueError):
+      logic.process(inputModel1, None, outputModel)
+
+    self.delayDisplay('Test passed')
+
+  def test_SurfaceAverageWeighted(self):
+    """
+    Average more than two models with weights, and check that invalid weights are rejected.
+    """
+    self.delayDisplay("Starting the weighted test")
+
+    inputPoints = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 0, 1]], dtype=np.float32)
+    inputModels = [self.createTriangleModel("Input%d" % i, inputPoints * (i + 1)) for i in range(3)]
+    outputModel = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode", "Output")
+
+    logic = SurfaceAverageLogic()
+    logic.processModels(inputModels, outputModel, weights=[1.0, 0.0, 3.0], computeNormals=False)
+    np.testing.assert_allclose(slicer.util.arrayFromModelPoints(outputModel), inputPoints * 2.5, atol=1e-6)
+    self.assertIsNone(outputModel.GetPolyData().GetPointData().GetNormals())
+
+    with self.assertRaises(ValueError):
+      logic.processModels(inputModels, outputModel, weights=[1.0, 1.0])
+    with self.assertRaises(ValueError):
+      logic.processModels(inputModels, outputModel, weights=[0.0, 0.0, 0.0])
+
+    self.delayDisplay('Test passed')
+
+  def test_SurfaceAverageNormals(self):
+    """
+    Check that the numpy point normals match vtkPolyDataNormals.
+    """
+    self.delayDisplay("Starting the normals test")
+
+    inputPoints = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 0, 1]], dtype=np.float32)
+    inputModel = self.createTriangleModel("Input", inputPoints)
+    outputModel = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode", "Output")
+
+    logic = SurfaceAverageLogic()
+    logic.processModels([inputModel], outputModel)
+    normals = numpy_support.vtk_to_numpy(outputModel.GetPolyData().GetPointData().GetNormals())
+
+    normalsFilter = vtk.vtkPolyDataNormals()
+    normalsFilter.SetInputData(inputModel.GetPolyData())
+    normalsFilter.SetAutoOrientNormals(False)
+    normalsFilter.SetSplitting(False)
+    normalsFilter.ConsistencyOff()
+    normalsFilter.Update()
+    expectedNormals = numpy_support.vtk_to_numpy(normalsFilter.GetOutput().GetPointData().GetNormals())
+    np.testing.assert_allclose(normals, expectedNormals, atol=1e-5)
+
     self.delayDisplay('Test passed')